@@ -21,14 +21,19 @@ setup(
                             'xnat-ls = xnatutils.ls_:cmd',
                             'xnat-varget = xnatutils.varget_:cmd',
                             'xnat-varput = xnatutils.varput_:cmd',
-                            'xnat-rename = xnatutils.rename_:cmd']},
+                            'xnat-rename = xnatutils.rename_:cmd',
+                            'xnat-merge-manifests = '
+                            'xnatutils.merge_manifests_:cmd',
+                            'xnat-copy = xnatutils.copy_:cmd',
+                            'xnat-sync = xnatutils.sync_:cmd',
+                            'xnat-index = xnatutils.index_:cmd']},
     url='http://github.com/MonashBI/xnatutils',
     license='The MIT License (MIT)',
     description=(
         'A collection of scripts for downloading/uploading and listing '
         'data from XNAT repositories.'),
     long_description=open('README.rst').read(),
-    install_requires=['xnat>=0.3.17',
+    install_requires=['xnat>=0.3.27',
                       'progressbar2>=3.16.0',
                       'future>=0.16'],
     python_requires='>=3.4',
@@ -0,0 +1,52 @@
+import io
+import time
+from unittest import TestCase
+from xnatutils.base import (
+    BandwidthLimiter, parse_bandwidth, interleave, _ThrottledStream)
+from xnatutils.exceptions import XnatUtilsUsageError
+
+
+class XnatBandwidthTest(TestCase):
+
+    def test_parse_bandwidth(self):
+        self.assertEqual(parse_bandwidth('512'), 512)
+        self.assertEqual(parse_bandwidth('50M'), 50 * 2 ** 20)
+        self.assertEqual(parse_bandwidth('1.5g'), 1.5 * 2 ** 30)
+        self.assertEqual(parse_bandwidth('100KB/s'), 100 * 2 ** 10)
+        self.assertEqual(parse_bandwidth(1000), 1000)
+        self.assertIsNone(parse_bandwidth(None))
+        self.assertRaises(XnatUtilsUsageError, parse_bandwidth, 'fast')
+        self.assertRaises(XnatUtilsUsageError, parse_bandwidth, '0')
+
+    def test_limit(self):
+        limiter = BandwidthLimiter(100000, burst=0)
+        start = time.time()
+        for _ in limiter.throttle([b'x' * 10000] * 5):
+            pass
+        self.assertAlmostEqual(time.time() - start, 0.5, delta=0.2)
+
+    def test_throttled_stream(self):
+        limiter = BandwidthLimiter(100000, burst=0)
+        stream = _ThrottledStream(io.BytesIO(b'x' * 20000), limiter)
+        start = time.time()
+        self.assertEqual(len(stream.read()), 20000)
+        self.assertAlmostEqual(time.time() - start, 0.2, delta=0.1)
+        # Other attributes are passed through to the wrapped stream
+        self.assertEqual(stream.tell(), 20000)
+
+    def test_interleave(self):
+        groups = [['a1', 'a2', 'a3', 'a4'], ['b1'], [], ['c1', 'c2']]
+        self.assertEqual(list(interleave(groups)),
+                         ['a1', 'a2', 'b1', 'a3', 'c1', 'a4', 'c2'])
+
+    def test_interleave_lazy(self):
+        consumed = []
+
+        def groups():
+            for name in ('a', 'b', 'c'):
+                consumed.append(name)
+                yield [name + str(i) for i in range(3)]
+
+        items = interleave(groups())
+        self.assertEqual(next(items), 'a0')
+        self.assertEqual(consumed, ['a'])
@@ -0,0 +1,48 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from unittest import TestCase
+from xnatutils.base import (
+    calculate_checksum, calculate_checksums, ChecksumCache)
+
+
+class XnatChecksumTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self._cache_env = os.environ.get('XNATUTILS_CACHE')
+        os.environ['XNATUTILS_CACHE'] = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        if self._cache_env is None:
+            del os.environ['XNATUTILS_CACHE']
+        else:
+            os.environ['XNATUTILS_CACHE'] = self._cache_env
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_cached(self):
+        path = self._write('a.dat', b'abc' * 1000)
+        digest = hashlib.md5(b'abc' * 1000).hexdigest()
+        self.assertEqual(calculate_checksum(path), digest)
+        cache = ChecksumCache.default()
+        self.assertEqual(cache.lookup(ChecksumCache.key(path)), digest)
+        # Modifying the file changes its key so the stale digest isn't used
+        self._write('a.dat', b'xyz')
+        self.assertEqual(calculate_checksum(path),
+                         hashlib.md5(b'xyz').hexdigest())
+
+    def test_parallel(self):
+        paths = [self._write('{}.dat'.format(i), str(i).encode() * 100000)
+                 for i in range(10)]
+        digests = calculate_checksums(paths, num_workers=4)
+        self.assertEqual(
+            digests,
+            dict((p, hashlib.md5(open(p, 'rb').read()).hexdigest())
+                 for p in paths))
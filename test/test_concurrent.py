@@ -0,0 +1,32 @@
+import time
+import threading
+from unittest import TestCase
+from xnatutils.base import iter_concurrent
+
+
+class XnatConcurrentTest(TestCase):
+
+    def test_results(self):
+        results = iter_concurrent(lambda x: x * 2, ((i,) for i in range(20)),
+                                  num_workers=4)
+        self.assertEqual(sorted(results), [i * 2 for i in range(20)])
+
+    def test_serial(self):
+        results = iter_concurrent(lambda x: x * 2, ((i,) for i in range(5)))
+        self.assertEqual(list(results), [0, 2, 4, 6, 8])
+
+    def test_cancel(self):
+        started = []
+        lock = threading.Lock()
+
+        def task(i):
+            with lock:
+                started.append(i)
+            time.sleep(0.05)
+            return i
+
+        results = iter_concurrent(task, ((i,) for i in range(100)),
+                                  num_workers=2)
+        next(results)
+        results.close()
+        self.assertLess(len(started), 10)
@@ -0,0 +1,132 @@
+import os
+import stat
+import time
+import shutil
+import hashlib
+import tempfile
+from unittest import TestCase
+from xnatutils.base import ConversionCache
+from xnatutils.get_ import _download_resource
+
+
+class XnatConversionCacheTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        os.mkdir(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def outputs(self, name, size):
+        path = os.path.join(self.tmpdir, name)
+        os.mkdir(path)
+        with open(os.path.join(path, name + '.nii.gz'), 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def test_lookup(self):
+        cache = ConversionCache(self.cache_dir)
+        key = cache.key({'1.dcm': 'abc'}, converter='dcm2niix',
+                        version='v1.0.20211006')
+        self.assertNotEqual(key, cache.key({'1.dcm': 'abc'},
+                                           converter='dcm2niix',
+                                           version='v1.0.20230411'))
+        target_dir = os.path.join(self.tmpdir, 'target')
+        os.mkdir(target_dir)
+        self.assertFalse(cache.lookup(key, target_dir))
+        cache.store(key, self.outputs('a', 10))
+        self.assertTrue(cache.lookup(key, target_dir))
+        self.assertEqual(os.listdir(target_dir), ['a.nii.gz'])
+
+    def test_evict(self):
+        cache = ConversionCache(self.cache_dir, max_size=250, max_age=1)
+        for i, name in enumerate('abc'):
+            cache.store(name, self.outputs(name, 100))
+            # Make the entries look like they were used in turn
+            entry_path = os.path.join(self.cache_dir, name,
+                                      ConversionCache.ENTRY_FILE)
+            os.utime(entry_path, (time.time() - 10 + i,) * 2)
+        # The least recently used entry is evicted to keep within the size
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['b', 'c'])
+        entry_path = os.path.join(self.cache_dir, 'c',
+                                  ConversionCache.ENTRY_FILE)
+        os.utime(entry_path, (time.time() - 2 * 24 * 60 * 60,) * 2)
+        cache.evict()
+        self.assertEqual(os.listdir(self.cache_dir), ['b'])
+
+    def test_download(self):
+        # A fake converter that counts how many times it is run
+        bin_dir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bin_dir)
+        count_path = os.path.join(self.tmpdir, 'count')
+        mrconvert = os.path.join(bin_dir, 'mrconvert')
+        with open(mrconvert, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'if [ "$1" = "-version" ]; then\n'
+                    '    echo "== mrconvert 3.0.3 =="\n'
+                    '    exit 0\n'
+                    'fi\n'
+                    'echo run >> "{}"\n'
+                    'cp "$1" "$2"\n'.format(count_path))
+        os.chmod(mrconvert, os.stat(mrconvert).st_mode | stat.S_IEXEC)
+        contents = b'dicom'
+        digest = hashlib.md5(contents).hexdigest()
+        downloads = []
+
+        class MockResponse(object):
+
+            status_code = 200
+
+            def json(self):
+                return {'ResultSet': {'Result': [
+                    {'Name': '1.dcm', 'digest': digest}]}}
+
+        class MockResource(object):
+
+            label = 'DICOM'
+            uri = '/data/experiments/E1/scans/1/resources/11'
+
+            def __init__(self):
+                self.xnat_session = self
+
+            def get(self, uri):
+                return MockResponse()
+
+            def download_dir(self, target_dir):
+                downloads.append(target_dir)
+                files_dir = os.path.join(target_dir, 'E1', 'scans', '1',
+                                         'resources', 'DICOM', 'files')
+                os.makedirs(files_dir)
+                with open(os.path.join(files_dir, '1.dcm'), 'wb') as f:
+                    f.write(contents)
+
+        class MockScan(object):
+            id = '1'
+            type = 't1'
+
+        class MockSession(object):
+            label = 'MRH017_001_MR01'
+
+        env = dict(os.environ)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['XNATUTILS_CACHE'] = self.cache_dir
+        try:
+            records = [
+                _download_resource(
+                    MockResource(), MockScan(), MockSession(),
+                    os.path.join(self.tmpdir, d), False, 'mrtrix',
+                    'mrconvert', False, check_digests=True)
+                for d in ('first', 'second')]
+        finally:
+            os.environ.clear()
+            os.environ.update(env)
+        # The second download reuses the cached conversion
+        self.assertEqual(len(downloads), 1)
+        with open(count_path) as f:
+            self.assertEqual(f.read().split(), ['run'])
+        self.assertEqual([r.digest_status for r in records],
+                         ['verified', 'cached'])
+        with open(records[1].path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
@@ -0,0 +1,125 @@
+import io
+import os
+import hashlib
+from unittest import TestCase
+import xnatutils.copy_
+from xnatutils.copy_ import _StreamingRemoteFile, copy
+from xnatutils.base import (
+    SessionRecord, SubjectRecord, ScanRecord, ResourceRecord, ResourceFile)
+from xnatutils.exceptions import XnatUtilsDigestCheckError
+
+
+class XnatCopyRemoteFileTest(TestCase):
+
+    class MockResponse(object):
+
+        def __init__(self, data):
+            self.raw = io.BytesIO(data)
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    class MockSession(object):
+
+        def __init__(self, data):
+            self.data = data
+            self.requests = []
+            self.interface = self
+
+        def get(self, uri, stream=False):
+            self.requests.append(uri)
+            return XnatCopyRemoteFileTest.MockResponse(self.data)
+
+        def _format_uri(self, uri):
+            return 'https://xnat.example.org' + uri
+
+        def _check_response(self, response, uri=None):
+            pass
+
+    def test_read(self):
+        data = os.urandom(100000)
+        login = self.MockSession(data)
+        remote = _StreamingRemoteFile(login,
+                                      '/data/experiments/X/files/a.dcm')
+        # The file isn't requested until it is read
+        self.assertEqual(login.requests, [])
+        chunks = list(iter(lambda: remote.read(4096), b''))
+        self.assertEqual(b''.join(chunks), data)
+        self.assertEqual(login.requests,
+                         ['https://xnat.example.org/data/experiments/X/'
+                          'files/a.dcm'])
+        self.assertTrue(remote._response.closed)
+        self.assertEqual(remote.hexdigest(), hashlib.md5(data).hexdigest())
+
+    def test_digest_mismatch(self):
+        data = os.urandom(10000)
+        login = self.MockSession(data)
+        remote = _StreamingRemoteFile(login,
+                                      '/data/experiments/X/files/a.dcm',
+                                      digest=hashlib.md5(b'other').hexdigest())
+        # The end of the stream isn't signalled if the digest doesn't match
+        self.assertEqual(remote.read(10000), data)
+        self.assertRaises(XnatUtilsDigestCheckError, remote.read, 10000)
+
+
+class XnatCopyTest(TestCase):
+
+    class MockXnatSession(object):
+
+        def __init__(self):
+            self.interface = self
+            self.hooks = {'response': []}
+            self.deleted = []
+
+        def delete(self, uri):
+            self.deleted.append(uri)
+
+    def setUp(self):
+        self.login = self.MockXnatSession()
+        self.dest_login = self.MockXnatSession()
+        resource = ResourceRecord(
+            '10', 'DICOM', 'DICOM', 1, 10,
+            '/data/experiments/E1/scans/1/resources/10', self.login)
+        scan = ScanRecord('1', 't1', '/data/experiments/E1/scans/1',
+                          {'DICOM': resource}, self.login)
+        session = SessionRecord(
+            'E1', 'MRH017_001_MR01', 'MRH017', 'S1', None,
+            '/data/experiments/E1', {'1': scan}, {}, self.login)
+        self.uploads = []
+        self.patched = {
+            'matching_sessions': lambda *args, **kwargs: [session],
+            '_iter_resources': lambda *args: iter(
+                [(resource, scan, session, False)]),
+            'iter_subjects': lambda login, project: [SubjectRecord(
+                'S1', 'MRH017_001', 'MRH017', '/data/subjects/S1',
+                self.login)],
+            '_list_files': lambda resource: [ResourceFile(
+                '1.dcm', '1.dcm', resource.uri + '/files/1.dcm',
+                hashlib.md5(b'data').hexdigest(), 4)],
+            '_upload': self.upload}
+        self.orig = dict((n, getattr(xnatutils.copy_, n))
+                         for n in self.patched)
+        for name, func in self.patched.items():
+            setattr(xnatutils.copy_, name, func)
+
+    def tearDown(self):
+        for name, func in self.orig.items():
+            setattr(xnatutils.copy_, name, func)
+
+    def upload(self, login, session, scan, sources, resource_name,
+               **kwargs):
+        self.uploads.append(kwargs['resume'])
+        raise XnatUtilsDigestCheckError("Corrupt stream")
+
+    def test_corrupt_copy(self):
+        self.assertRaises(
+            XnatUtilsDigestCheckError, copy, 'MRH017_001_MR01',
+            'https://xnat.other.org', connection=self.login,
+            dest_connection=self.dest_login, dest_project_id='MRH018')
+        # Digest errors aren't retried and the partial copy is deleted
+        self.assertEqual(self.uploads, [False])
+        self.assertEqual(
+            self.dest_login.deleted,
+            ['/data/projects/MRH018/experiments/MRH017_001_MR01/scans/1/'
+             'resources/DICOM'])
@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from unittest import TestCase
+import requests
+from xnat.exceptions import XNATResponseError
+from xnatutils.base import (
+    matching_scans, parse_dicom_filters, SessionRecord, ScanRecord,
+    ResourceRecord)
+from xnatutils.ls_ import ls
+from xnatutils.exceptions import XnatUtilsUsageError
+
+
+class XnatDicomFilterTest(TestCase):
+
+    HEADERS = {
+        '1': [('0008', '0008', 'Image Type', 'ORIGINAL\\PRIMARY\\M'),
+              ('0008', '103E', 'Series Description', 't1_mprage_sag')],
+        '2': [('0008', '0008', 'Image Type', 'DERIVED\\PRIMARY\\MPR'),
+              ('0008', '103E', 'Series Description', 't1_mprage_sag_MPR')],
+        '3': [('0008', '0008', 'Image Type', 'ORIGINAL\\PRIMARY\\DIFFUSION'),
+              ('0008', '103E', 'Series Description', 'ep2d_diff')]}
+
+    class MockResponse(object):
+
+        status_code = 500
+        url = 'https://xnat.org/data/services/dicomdump'
+        text = ''
+
+    class MockSession(object):
+
+        server = 'https://xnat.org'
+
+        def __init__(self):
+            self.requests = []
+            self.failing = set()
+            self.dropped = set()
+            self.malformed = set()
+
+        def get_json(self, uri, query=None):
+            self.requests.append(query['src'])
+            scan_id = query['src'].split('/')[-1]
+            if scan_id in self.failing:
+                raise XNATResponseError(
+                    "Invalid response from XNATSession (status 500)",
+                    XnatDicomFilterTest.MockResponse())
+            if scan_id in self.dropped:
+                raise requests.exceptions.ConnectionError(
+                    "Connection aborted")
+            if scan_id in self.malformed:
+                return {'items': []}
+            rows = [{'tag1': '({},{})'.format(g, e), 'tag2': '', 'vr': 'CS',
+                     'value': v, 'desc': d}
+                    for g, e, d, v in XnatDicomFilterTest.HEADERS[scan_id]]
+            # Fields nested in sequences are ignored
+            rows.append({'tag1': '(0008,1140)', 'tag2': '(0008,103E)',
+                         'vr': 'LO', 'value': 'localizer',
+                         'desc': 'Series Description'})
+            return {'ResultSet': {'Result': rows}}
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.env = dict(os.environ)
+        os.environ['XNATUTILS_CACHE'] = self.cache_dir
+        self.login = self.MockSession()
+        scans = OrderedDict()
+        for scan_id, resource in (('1', 'DICOM'), ('2', 'DICOM'),
+                                  ('3', 'DICOM'), ('4', 'SNAPSHOTS')):
+            uri = '/data/experiments/E1/scans/' + scan_id
+            resources = OrderedDict([(resource, ResourceRecord(
+                scan_id + '0', resource, resource, 10, 1000,
+                uri + '/resources/' + scan_id + '0', self.login))])
+            scans[scan_id] = ScanRecord(scan_id, None, uri, resources,
+                                        self.login)
+        self.session = SessionRecord(
+            'E1', 'MRH017_001_MR01', 'MRH017', 'S1', None,
+            '/data/experiments/E1', scans, OrderedDict(), self.login)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.cache_dir)
+
+    def matching_ids(self, dicom_filters):
+        return [s.id for s in matching_scans(self.session, None,
+                                             dicom_filters=dicom_filters)]
+
+    def test_match(self):
+        self.assertEqual(
+            self.matching_ids(['SeriesDescription=t1_mprage.*',
+                               'ImageType=ORIGINAL.*']), ['1'])
+        self.assertEqual(
+            sorted(self.login.requests),
+            ['/archive/projects/MRH017/experiments/E1/scans/' + i
+             for i in ('1', '2', '3')])
+        # Fields can be given by tag and the headers are cached
+        self.assertEqual(self.matching_ids({'0008,103E': '.*diff.*'}), ['3'])
+        self.assertEqual(self.matching_ids(['(0008,0008)=.*PRIMARY.*']),
+                         ['1', '2', '3'])
+        self.assertEqual(len(self.login.requests), 3)
+        # The whole value must match and missing fields don't match
+        self.assertEqual(self.matching_ids(['SeriesDescription=t1']), [])
+        self.assertEqual(self.matching_ids(['EchoTime=.*']), [])
+
+    def test_invalid(self):
+        self.assertEqual(parse_dicom_filters(["Patient's Name=.*"]),
+                         [('patientname', '.*')])
+        self.assertRaises(XnatUtilsUsageError, parse_dicom_filters,
+                          ['SeriesDescription'])
+        self.assertRaises(XnatUtilsUsageError, ls, 'MRH017_001_MR01',
+                          datatype='session',
+                          dicom_filters=['ImageType=.*'])
+        self.assertRaises(XnatUtilsUsageError, ls, 'MRH017_001_MR01',
+                          datatype='scan', index=True,
+                          dicom_filters=['ImageType=.*'])
+
+    def test_failed_header(self):
+        self.login.failing.add('1')
+        # Scans whose headers can't be retrieved don't match
+        self.assertEqual(self.matching_ids(['ImageType=ORIGINAL.*']), ['3'])
+        # and the failures aren't cached
+        self.login.failing.clear()
+        self.assertEqual(self.matching_ids(['ImageType=ORIGINAL.*']),
+                         ['1', '3'])
+        self.assertEqual(len(self.login.requests), 4)
+
+    def test_connection_error(self):
+        self.login.dropped.add('1')
+        self.login.malformed.add('3')
+        # Scans whose headers can't be read don't match, without aborting
+        # the match of the other scans
+        self.assertEqual(self.matching_ids(['ImageType=.*PRIMARY.*']), ['2'])
+        self.login.dropped.clear()
+        self.login.malformed.clear()
+        self.assertEqual(self.matching_ids(['ImageType=.*PRIMARY.*']),
+                         ['1', '2', '3'])
@@ -0,0 +1,124 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from unittest import TestCase
+from xnatutils.get_ import _download_resource, _select_files
+from xnatutils.base import ResourceFile
+
+
+def dicom_name(i):
+    return '1.3.12.2.1107.5.2.43.66044-{}-{}-1jvmk2.dcm'.format(i, 1000 + i)
+
+
+class XnatGetFilesTest(TestCase):
+
+    class MockSession(object):
+
+        class MockResponse(object):
+
+            encoding = None
+
+            def __init__(self, text):
+                self.text = text
+
+            def iter_content(self, chunk_size, decode_unicode=False):
+                yield self.text
+
+            def close(self):
+                pass
+
+        def __init__(self, files):
+            self.files = files
+            self.interface = self
+            self.downloaded = []
+
+        def _format_uri(self, path, format=None, query=None):
+            return path
+
+        def _check_response(self, response, uri=None):
+            pass
+
+        def get(self, uri, stream=False):
+            rows = [{'Name': p.split('/')[-1], 'URI': uri + '/' + p,
+                     'digest': hashlib.md5(c).hexdigest()}
+                    for p, c in sorted(self.files.items())]
+            return self.MockResponse(json.dumps(
+                {'ResultSet': {'Result': rows}}))
+
+        def download_stream(self, uri, target_stream):
+            self.downloaded.append(uri)
+            target_stream.write(self.files[uri.split('/files/')[-1]])
+
+    class MockResource(object):
+
+        label = 'DICOM'
+        uri = '/data/experiments/E1/scans/1/resources/11'
+
+        def __init__(self, xnat_session):
+            self.xnat_session = xnat_session
+
+        def download_dir(self, target_dir):
+            raise AssertionError("Whole resource shouldn't be downloaded")
+
+    class MockScan(object):
+        id = '1'
+        type = 't1'
+
+    class MockXnatSession(object):
+        label = 'MRH017_001_MR01'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_select(self):
+        listing = [ResourceFile(dicom_name(i), dicom_name(i), None, None, None)
+                   for i in (10, 2, 1, 3, 9, 4, 8, 5, 7, 6, 11)]
+        # The middle slice is selected by instance number not name
+        self.assertEqual(_select_files(listing, None, 1),
+                         [listing[9]])
+        self.assertEqual(
+            [f.name for f in _select_files(listing, None, 3)],
+            [dicom_name(2), dicom_name(6), dicom_name(10)])
+        self.assertEqual(_select_files(listing, None, 20), listing)
+        listing.append(ResourceFile('sidecar.json', 'extra/sidecar.json',
+                                    None, None, None))
+        self.assertEqual(_select_files(listing, ['*.json'], None),
+                         listing[-1:])
+        self.assertEqual(_select_files(listing, ['extra/*'], None),
+                         listing[-1:])
+
+    def test_download(self):
+        files = dict((dicom_name(i), str(i).encode()) for i in range(1, 6))
+        files['extra/sidecar.json'] = b'{}'
+        login = self.MockSession(files)
+        record = _download_resource(
+            self.MockResource(login), self.MockScan(), self.MockXnatSession(),
+            self.tmpdir, False, None, None, False, check_digests=True,
+            files=['*.dcm'], sample=2)
+        self.assertEqual(record.digest_status, 'verified')
+        self.assertEqual(sorted(os.listdir(record.path)),
+                         [dicom_name(2), dicom_name(4)])
+        self.assertEqual(len(login.downloaded), 2)
+        # Files in sub-directories of the resource are matched by name or
+        # path
+        record = _download_resource(
+            self.MockResource(login), self.MockScan(), self.MockXnatSession(),
+            self.tmpdir, False, None, None, False, files=['extra/*.json'])
+        self.assertEqual(os.listdir(record.path), ['sidecar.json'])
+
+    def test_same_names(self):
+        # Files with the same name in different sub-directories are checked
+        # against their own digests
+        files = {'a/info.json': b'{"a": 1}', 'b/info.json': b'{"b": 2}'}
+        login = self.MockSession(files)
+        record = _download_resource(
+            self.MockResource(login), self.MockScan(), self.MockXnatSession(),
+            self.tmpdir, False, None, None, False, check_digests=True,
+            files=['*.json'])
+        self.assertEqual(record.digest_status, 'verified')
+        self.assertEqual(sorted(os.listdir(record.path)), ['a', 'b'])
@@ -0,0 +1,160 @@
+import os.path
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+from xnatutils.index_ import update_index, ProjectIndex
+from xnatutils.ls_ import ls
+from xnatutils.exceptions import (
+    XnatUtilsUsageError, XnatUtilsNoMatchingSessionsException)
+
+
+def result_set(rows):
+    return {'ResultSet': {'Result': rows, 'totalRecords': str(len(rows))}}
+
+
+def tree(session_id, label, subject_id, date, scans):
+    return {'items': [{
+        'children': [{'field': 'scans/scan', 'items': [
+            {'children': [{'field': 'file', 'items': [
+                {'children': [],
+                 'data_fields': {'xnat_abstractresource_id': int(i) * 10,
+                                 'label': 'DICOM', 'format': 'DICOM',
+                                 'file_count': 2, 'file_size': 200}}]}],
+             'data_fields': {'ID': i, 'type': t}}
+            for i, t in scans]}],
+        'data_fields': {'ID': session_id, 'label': label,
+                        'project': 'MRH017', 'subject_ID': subject_id,
+                        'date': date}}]}
+
+
+class XnatIndexTest(TestCase):
+
+    class MockSession(object):
+
+        server = 'https://xnat.org'
+
+        class MockResponse(object):
+
+            encoding = None
+
+            def __init__(self, text):
+                self.text = text
+
+            def iter_content(self, chunk_size, decode_unicode=False):
+                yield self.text
+
+            def close(self):
+                pass
+
+        def __init__(self):
+            self.interface = self
+            self.requests = []
+            self.listings = {
+                '/data/projects/MRH017/subjects': [
+                    {'ID': 'S1', 'label': 'MRH017_001'},
+                    {'ID': 'S2', 'label': 'MRH017_002'}],
+                '/data/projects/MRH017/experiments': [
+                    {'ID': 'E1', 'label': 'MRH017_001_MR01',
+                     'subject_ID': 'S1', 'date': '2021-06-01',
+                     'last_modified': '2021-06-01 10:00:00'},
+                    {'ID': 'E2', 'label': 'MRH017_001_MR02',
+                     'subject_ID': 'S1', 'date': '2022-06-01',
+                     'last_modified': '2022-06-01 10:00:00'},
+                    {'ID': 'E3', 'label': 'MRH017_002_MR01',
+                     'subject_ID': 'S2', 'date': '2022-07-01',
+                     'last_modified': '2022-07-01 10:00:00'}]}
+            self.trees = {
+                'E1': tree('E1', 'MRH017_001_MR01', 'S1', '2021-06-01',
+                           [('1', 't1_mprage'), ('2', 'ep2d_diff')]),
+                'E2': tree('E2', 'MRH017_001_MR02', 'S1', '2022-06-01',
+                           [('1', 't1_mprage'), ('2', 'ep2d_diff')]),
+                'E3': tree('E3', 'MRH017_002_MR01', 'S2', '2022-07-01',
+                           [('1', 't1_mprage'), ('2', 'ep2d_diff'),
+                            ('3', 't2_flair')])}
+
+        def _format_uri(self, path, format=None, query=None):
+            return path
+
+        def _check_response(self, response, uri=None):
+            pass
+
+        def get(self, uri, stream=False):
+            self.requests.append(uri)
+            if uri.endswith('/files'):
+                rows = [{'Name': '1.dcm', 'Size': '100', 'digest': 'abc'},
+                        {'Name': '2.dcm', 'Size': '100', 'digest': 'def'}]
+            else:
+                rows = self.listings[uri]
+            return self.MockResponse(json.dumps(result_set(rows)))
+
+        def get_json(self, uri, query=None):
+            self.requests.append(uri)
+            return self.trees[uri.split('/')[-1]]
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'MRH017.sqlite')
+        self.login = self.MockSession()
+        result = update_index('MRH017', index_path=self.path,
+                              connection=self.login)
+        self.assertEqual(sorted(result.crawled), ['E1', 'E2', 'E3'])
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def ls(self, *args, **kwargs):
+        return ls(*args, project_id='MRH017', index=self.path, **kwargs)
+
+    def test_query(self):
+        self.assertEqual(
+            self.ls(datatype='session', with_scans=['t1.*', 'ep2d_diff'],
+                    without_scans=['.*flair.*'], after='2022-01-01'),
+            ['MRH017_001_MR02'])
+        self.assertEqual(self.ls(datatype='session', before='2022-06-01'),
+                         ['MRH017_001_MR01', 'MRH017_001_MR02'])
+        self.assertEqual(self.ls(datatype='subject'),
+                         ['MRH017_001', 'MRH017_002'])
+        self.assertEqual(self.ls(['MRH017_002_MR01'], datatype='scan'),
+                         ['ep2d_diff', 't1_mprage', 't2_flair'])
+        self.assertEqual(
+            self.ls(datatype='session', subject_id='MRH017_002'),
+            ['MRH017_002_MR01'])
+        self.assertRaises(XnatUtilsNoMatchingSessionsException, self.ls,
+                          datatype='session', with_scans=['dwi'])
+        # Attributes that aren't in the index can't be returned
+        self.assertRaises(XnatUtilsUsageError, self.ls, datatype='session',
+                          return_attr='modality')
+        with ProjectIndex.open(path=self.path) as index:
+            session = next(s for s in index.iter_sessions()
+                           if s.id == 'E3')
+            self.assertEqual(session.scans['3'].resources['DICOM'].uri,
+                             '/data/experiments/E3/scans/3/resources/30')
+            self.assertEqual(index._conn.execute(
+                "SELECT COUNT(*) FROM files").fetchone()[0], 14)
+
+    def test_update(self):
+        login = self.login
+        del login.listings['/data/projects/MRH017/experiments'][0]
+        login.listings['/data/projects/MRH017/experiments'][1][
+            'last_modified'] = '2023-01-01 10:00:00'
+        login.trees['E3'] = tree('E3', 'MRH017_002_MR01', 'S2', '2022-07-01',
+                                 [('1', 't1_mprage'), ('2', 'ep2d_diff')])
+        login.requests = []
+        result = update_index('MRH017', index_path=self.path,
+                              connection=login, files=False)
+        # Only the modified session is crawled again
+        self.assertEqual(result.crawled, ['E3'])
+        self.assertEqual(result.removed, ['E1'])
+        self.assertEqual(result.num_sessions, 2)
+        self.assertNotIn('/data/experiments/E2', login.requests)
+        self.assertEqual(
+            self.ls(datatype='session', with_scans=['t1.*'],
+                    without_scans=['.*flair.*']),
+            ['MRH017_001_MR02', 'MRH017_002_MR01'])
+
+    def test_mismatched_source(self):
+        self.assertRaises(XnatUtilsUsageError, update_index, 'MRH001',
+                          index_path=self.path, connection=self.login)
+        self.assertRaises(XnatUtilsUsageError, ProjectIndex.open,
+                          path=os.path.join(self.work_dir, 'missing.sqlite'))
@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from xnatutils.base import FileLock
+from xnatutils.get_ import _publish
+from xnatutils.exceptions import XnatUtilsError
+
+
+class XnatLockTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lock(self):
+        path = os.path.join(self.tmpdir, 'resource.lock')
+        with FileLock(path) as lock:
+            self.assertFalse(lock.waited)
+            self.assertRaises(XnatUtilsError,
+                              FileLock(path, timeout=0.2,
+                                       poll_interval=0.05).acquire)
+        self.assertFalse(os.path.exists(path))
+        with FileLock(path) as lock:
+            self.assertFalse(lock.waited)
+
+    def test_publish(self):
+        target = os.path.join(self.tmpdir, 'scan')
+        os.mkdir(target)
+        with open(os.path.join(target, 'old.dcm'), 'w') as f:
+            f.write('old')
+        work_dir = os.path.join(self.tmpdir, 'work')
+        staged = os.path.join(work_dir, 'scan')
+        os.makedirs(staged)
+        with open(os.path.join(staged, 'new.dcm'), 'w') as f:
+            f.write('new')
+        _publish(staged, target, work_dir)
+        self.assertEqual(os.listdir(target), ['new.dcm'])
+        self.assertEqual(os.listdir(work_dir), [])
@@ -0,0 +1,79 @@
+import os
+import types
+import shutil
+import tempfile
+from unittest import TestCase
+import xnatutils.base
+from xnatutils.base import load_model
+
+
+MODEL_SOURCE = """
+XNAT_CLASS_LOOKUP = {}
+
+
+class MrSessionData(object):
+
+    @classmethod
+    def __register__(cls, target):
+        target['xnat:mrSessionData'] = cls
+"""
+
+
+class XnatModelCacheTest(TestCase):
+
+    class MockConnection(object):
+
+        server = 'https://xnat.org'
+
+        def __init__(self, xnat_version='1.8.5'):
+            self.xnat_version = xnat_version
+            self.classes = None
+            self.XNAT_CLASS_LOOKUP = {}
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.env = dict(os.environ)
+        os.environ['XNATUTILS_CACHE'] = self.cache_dir
+        self.built = []
+        self.injected = []
+        self.build_model = xnatutils.base.xnat.build_model
+        self.inject_search_fields = xnatutils.base.inject_search_fields
+
+        def build_model(connection, extension_types, connection_id):
+            self.built.append(connection.xnat_version)
+            connection.classes = types.ModuleType('model')
+            connection.source_code = MODEL_SOURCE
+
+        xnatutils.base.xnat.build_model = build_model
+        xnatutils.base.inject_search_fields = self.injected.append
+
+    def tearDown(self):
+        xnatutils.base.xnat.build_model = self.build_model
+        xnatutils.base.inject_search_fields = self.inject_search_fields
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.cache_dir)
+
+    def cached_models(self):
+        return os.listdir(os.path.join(self.cache_dir, 'models'))
+
+    def test_cache(self):
+        # The model is built on a miss
+        load_model(self.MockConnection())
+        self.assertEqual(self.built, ['1.8.5'])
+        old_models = self.cached_models()
+        self.assertEqual(len(old_models), 1)
+        # and loaded from the cache (with its search fields) on a hit
+        connection = self.MockConnection()
+        self.assertIs(load_model(connection), connection)
+        self.assertEqual(self.built, ['1.8.5'])
+        self.assertIs(connection.XNAT_CLASS_LOOKUP['xnat:mrSessionData'],
+                      connection.classes.MrSessionData)
+        self.assertIs(connection.classes.SESSION, connection)
+        self.assertEqual(self.injected, [connection])
+        # Models of previous versions of the server are replaced
+        load_model(self.MockConnection('1.8.6'))
+        self.assertEqual(self.built, ['1.8.5', '1.8.6'])
+        models = self.cached_models()
+        self.assertEqual(len(models), 1)
+        self.assertNotEqual(models, old_models)
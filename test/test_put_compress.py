@@ -0,0 +1,129 @@
+import os
+import json
+import gzip
+import shutil
+import hashlib
+import tempfile
+from unittest import TestCase
+from xnatutils.put_ import (
+    _check_upload_args, _remote_name, _gzip_digest, _iter_gzip, _upload)
+
+
+class XnatPutCompressTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 't1.nii')
+        with open(self.path, 'wb') as f:
+            f.write(os.urandom(100000) + b'\0' * 3000000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_resource_name(self):
+        _, resource_name = _check_upload_args(
+            'TEST004_001_MR01', 't1', [self.path], None, compress=True)
+        self.assertEqual(resource_name, 'NIFTI_GZ')
+        self.assertEqual(_remote_name(self.path, True), 't1.nii.gz')
+        self.assertEqual(_remote_name(self.path + '.gz', True), 't1.nii.gz')
+
+    def test_stream(self):
+        file_hash = hashlib.md5()
+        with open(self.path, 'rb') as f:
+            compressed = b''.join(_iter_gzip(f, file_hash))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(gzip.decompress(compressed), f.read())
+        self.assertEqual(file_hash.hexdigest(),
+                         hashlib.md5(compressed).hexdigest())
+        # The stream is deterministic so resumed uploads can be checked
+        self.assertEqual(_gzip_digest(self.path), file_hash.hexdigest())
+
+
+class XnatPutCompressResourceTest(TestCase):
+
+    class MockResource(object):
+
+        def __init__(self, login, name):
+            self.xnat_session = login
+            self.uri = '/data/experiments/E1/scans/t1/resources/' + name
+
+        def upload(self, fname, remote_name, overwrite=False):
+            with open(fname, 'rb') as f:
+                self.xnat_session.files[remote_name] = f.read()
+
+    class MockResponse(object):
+
+        encoding = None
+
+        def __init__(self, text):
+            self.text = text
+
+        def iter_content(self, chunk_size, decode_unicode=False):
+            yield self.text
+
+        def close(self):
+            pass
+
+    class MockXnatSession(object):
+
+        MrSessionData = None
+
+        def __init__(self):
+            self.files = {}
+            self.interface = self
+            self.classes = self
+            self.experiments = {'TEST004_001_MR01': None}
+
+        def MrScanData(self, id, type, parent):
+            return self
+
+        def create_resource(self, name):
+            self.resource = XnatPutCompressResourceTest.MockResource(
+                self, name)
+            return self.resource
+
+        def put(self, path, data=None, query=None, headers=None):
+            self.files[path.split('/files/')[-1]] = b''.join(data)
+
+        def _format_uri(self, path, format=None, query=None):
+            return path
+
+        def _check_response(self, response, uri=None):
+            pass
+
+        def get(self, uri, stream=False):
+            rows = [{'Name': n, 'URI': uri + '/' + n,
+                     'digest': hashlib.md5(c).hexdigest()}
+                    for n, c in self.files.items()]
+            return XnatPutCompressResourceTest.MockResponse(
+                json.dumps({'ResultSet': {'Result': rows}}))
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.env = dict(os.environ)
+        os.environ['XNATUTILS_CACHE'] = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.tmpdir)
+
+    def upload(self, fname, resource_name=None):
+        path = os.path.join(self.tmpdir, fname)
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 1000)
+        filenames, resource_name = _check_upload_args(
+            'TEST004_001_MR01', 't1', [path], resource_name, compress=True)
+        login = self.MockXnatSession()
+        _upload(login, 'TEST004_001_MR01', 't1', filenames, resource_name,
+                compress=True)
+        return resource_name, login.files
+
+    def test_compressed_resources(self):
+        resource_name, files = self.upload('t1.nii')
+        self.assertEqual(resource_name, 'NIFTI_GZ')
+        self.assertEqual(gzip.decompress(files['t1.nii.gz']), b'\0' * 1000)
+        # DICOM files are uploaded as they are
+        resource_name, files = self.upload('1.dcm', 'DICOM')
+        self.assertEqual(resource_name, 'DICOM')
+        self.assertEqual(files, {'1.dcm': b'\0' * 1000})
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+import xnatutils.put_
+from xnatutils.put_ import read_manifest, put_many
+from xnatutils.exceptions import XnatUtilsUsageError
+
+
+class XnatPutManifestTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'manifest.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read(self):
+        with open(self.path, 'w') as f:
+            f.write('session,scan,resource,paths\n'
+                    'TEST004_001_MR01,t1,NIFTI_GZ,t1.nii.gz\n'
+                    'TEST004_002_MR01,dwi,,dwi.mif; dwi.b\n')
+        rows = read_manifest(self.path)
+        self.assertEqual([r['paths'] for r in rows],
+                         [['t1.nii.gz'], ['dwi.mif', 'dwi.b']])
+        self.assertEqual(rows[1]['resource'], '')
+
+    def test_missing_column(self):
+        with open(self.path, 'w') as f:
+            f.write('session,scan\nTEST004_001_MR01,t1\n')
+        self.assertRaises(XnatUtilsUsageError, read_manifest, self.path)
+
+    def test_row_error(self):
+        paths = []
+        for name in ('t1.nii', 't2.nii'):
+            paths.append(os.path.join(self.tmpdir, name))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'\0')
+
+        def run_upload(scheduler, login, session, scan, filenames,
+                       resource_name, **kwargs):
+            if scan == 't1':
+                raise ValueError("Unexpected response")
+
+        class MockXnatSession(object):
+
+            def __init__(self):
+                self.interface = self
+                self.hooks = {'response': []}
+
+        orig_run_upload = xnatutils.put_._run_upload
+        xnatutils.put_._run_upload = run_upload
+        try:
+            statuses = put_many(
+                [{'session': 'TEST004_001_MR01', 'scan': 't1',
+                  'paths': paths[0]},
+                 {'session': 'TEST004_001_MR01', 'scan': 't2',
+                  'paths': paths[1]}],
+                resource_name='NIFTI', connection=MockXnatSession())
+        finally:
+            xnatutils.put_._run_upload = orig_run_upload
+        # An unexpected error only fails the row it was raised by
+        self.assertEqual([s.status for s in statuses], ['failed', 'uploaded'])
+        self.assertEqual(statuses[0].message,
+                         'ValueError: Unexpected response')
@@ -0,0 +1,38 @@
+import os
+import io
+import hashlib
+from unittest import TestCase
+from xnatutils.put_ import _check_upload_args, _upload_stream, StreamSource
+from xnatutils.exceptions import XnatUtilsUsageError
+
+
+class XnatPutStreamTest(TestCase):
+
+    class MockSession(object):
+
+        def put(self, path, data=None, query=None, headers=None):
+            self.path = path
+            self.query = query
+            self.data = b''.join(data)
+
+    class MockResource(object):
+        uri = '/data/experiments/TEST004_001_MR01/scans/t1/resources/NIFTI'
+
+    def test_stream_args(self):
+        fileobj = io.BytesIO(b'data')
+        filenames, resource_name = _check_upload_args(
+            'TEST004_001_MR01', 't1', [fileobj], None, name='t1.nii')
+        self.assertEqual(filenames, [StreamSource('t1.nii', fileobj)])
+        self.assertEqual(resource_name, 'NIFTI')
+        self.assertRaises(XnatUtilsUsageError, _check_upload_args,
+                          'TEST004_001_MR01', 't1', ['-'], None)
+
+    def test_upload_stream(self):
+        data = os.urandom(3 * 2 ** 20 + 17)
+        login = self.MockSession()
+        digest = _upload_stream(login, self.MockResource(), io.BytesIO(data),
+                                't1.nii', overwrite=True)
+        self.assertEqual(login.data, data)
+        self.assertEqual(digest, hashlib.md5(data).hexdigest())
+        self.assertEqual(login.query, {'inbody': 'true', 'overwrite': 'true'})
+        self.assertTrue(login.path.endswith('/files/t1.nii'))
@@ -0,0 +1,133 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from unittest import TestCase
+from xnatutils.put_ import _upload
+
+
+RESOURCE_URI = '/data/experiments/E1/scans/t1/resources/NIFTI'
+
+
+class XnatPutSyncTest(TestCase):
+
+    class MockResponse(object):
+
+        status_code = 200
+        encoding = None
+
+        def __init__(self, rows):
+            self.rows = rows
+            self.text = json.dumps({'ResultSet': {'Result': rows}})
+
+        def json(self):
+            return {'ResultSet': {'Result': self.rows}}
+
+        def iter_content(self, chunk_size, decode_unicode=False):
+            yield self.text
+
+        def close(self):
+            pass
+
+    class MockResource(object):
+
+        uri = RESOURCE_URI
+
+        def __init__(self, login):
+            self.xnat_session = login
+
+        def upload(self, fname, remote_name, overwrite=False):
+            with open(fname, 'rb') as f:
+                self.xnat_session.files[remote_name] = f.read()
+            self.xnat_session.uploaded.append((remote_name, overwrite))
+
+    class MockScan(object):
+
+        def __init__(self, login):
+            self.login = login
+
+        @property
+        def resources(self):
+            if self.login.files:
+                return {'NIFTI': self.login.resource}
+            return {}
+
+        def create_resource(self, name):
+            return self.login.resource
+
+    class MockXnatSession(object):
+
+        def __init__(self, files):
+            self.files = files
+            self.uploaded = []
+            self.deleted = []
+            self.interface = self
+            self.classes = self
+            self.experiments = {'TEST004_001_MR01': None}
+            self.resource = XnatPutSyncTest.MockResource(self)
+
+        def MrScanData(self, id, type, parent):
+            return XnatPutSyncTest.MockScan(self)
+
+        MrSessionData = None
+
+        def _format_uri(self, path, format=None, query=None):
+            return path
+
+        def _check_response(self, response, uri=None):
+            pass
+
+        def get(self, uri, stream=False):
+            assert uri == RESOURCE_URI + '/files'
+            return XnatPutSyncTest.MockResponse([
+                {'Name': p.split('/')[-1], 'URI': uri + '/' + p,
+                 'digest': hashlib.md5(c).hexdigest()}
+                for p, c in sorted(self.files.items())])
+
+        def delete(self, uri):
+            self.deleted.append(uri)
+            del self.files[uri[len(RESOURCE_URI + '/files/'):]]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.env = dict(os.environ)
+        os.environ['XNATUTILS_CACHE'] = os.path.join(self.tmpdir, 'cache')
+        self.paths = []
+        for name in ('a.nii', 'b.nii'):
+            self.paths.append(os.path.join(self.tmpdir, name))
+            with open(self.paths[-1], 'wb') as f:
+                f.write(name.encode())
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.tmpdir)
+
+    def upload(self, login, **kwargs):
+        return _upload(login, 'TEST004_001_MR01', 't1', self.paths, 'NIFTI',
+                       **kwargs)
+
+    def test_resume(self):
+        login = self.MockXnatSession({'a.nii': b'a.nii', 'b.nii': b'old',
+                                      'c.nii': b'c.nii'})
+        self.upload(login, resume=True)
+        # Files with matching digests are skipped and mismatching ones are
+        # replaced
+        self.assertEqual(login.uploaded, [('b.nii', True)])
+        self.assertEqual(login.files['b.nii'], b'b.nii')
+        # Remote-only files are kept when resuming
+        self.assertEqual(login.deleted, [])
+
+    def test_sync(self):
+        login = self.MockXnatSession({'a.nii': b'a.nii', 'b.nii': b'old',
+                                      'c.nii': b'c.nii',
+                                      'extra/a.nii': b'extra'})
+        self.upload(login, sync=True)
+        self.assertEqual(login.uploaded, [('b.nii', True)])
+        # Remote-only files are deleted by their own URIs, including files
+        # in sub-directories with the same names as local files
+        self.assertEqual(sorted(login.deleted),
+                         [RESOURCE_URI + '/files/c.nii',
+                          RESOURCE_URI + '/files/extra/a.nii'])
+        self.assertEqual(sorted(login.files), ['a.nii', 'b.nii'])
@@ -0,0 +1,90 @@
+import os
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+import xnatutils.put_
+from xnatutils.put_ import (
+    _list_series, _series_signature, _series_resource_name, _remove_uploaded,
+    watch_put)
+from xnatutils.exceptions import XnatUtilsUsageError
+
+
+class XnatPutWatchTest(TestCase):
+
+    class MockXnatSession(object):
+
+        def __init__(self):
+            self.interface = self
+            self.hooks = {'response': []}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.series_dir = os.path.join(self.tmpdir, 'TEST004_001_MR01', 't1')
+        os.makedirs(self.series_dir)
+        for i in range(3):
+            with open(os.path.join(self.series_dir,
+                                   '{}.dcm'.format(i)), 'wb') as f:
+                f.write(b'\0' * 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_list_series(self):
+        os.makedirs(os.path.join(self.tmpdir, '.uploaded', 'X', 'Y'))
+        self.assertEqual(list(_list_series(self.tmpdir)),
+                         [(self.series_dir, 'TEST004_001_MR01', 't1')])
+
+    def test_signature(self):
+        num_files, size, latest = _series_signature(self.series_dir)
+        self.assertEqual((num_files, size), (3, 30))
+        self.assertAlmostEqual(latest, time.time(), delta=60)
+
+    def test_signature_deleted(self):
+        # A file that is deleted between listing the directory and reading
+        # its size (simulated by a dangling link) means the series isn't
+        # quiescent
+        os.symlink(os.path.join(self.tmpdir, 'missing.dcm'),
+                   os.path.join(self.series_dir, '3.dcm'))
+        self.assertIsNone(_series_signature(self.series_dir))
+        shutil.rmtree(self.series_dir)
+        self.assertIsNone(_series_signature(self.series_dir))
+
+    def test_resource_name(self):
+        fnames = os.listdir(self.series_dir)
+        self.assertEqual(_series_resource_name(fnames), 'DICOM')
+        self.assertRaises(XnatUtilsUsageError, _series_resource_name,
+                          fnames + ['t1.nii.gz'])
+
+    def test_remove_uploaded(self):
+        _remove_uploaded(self.tmpdir, self.series_dir, 'TEST004_001_MR01',
+                         't1', False)
+        self.assertEqual(os.listdir(self.tmpdir), ['.uploaded'])
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.tmpdir, '.uploaded',
+                                        'TEST004_001_MR01', 't1'))), 3)
+
+    def test_remove_failed(self):
+        uploaded = []
+
+        def run_upload(scheduler, login, session, scan, filenames,
+                       resource_name, **kwargs):
+            uploaded.append((session, scan, resource_name))
+
+        def remove_uploaded(watch_dir, series_dir, session, scan, delete):
+            raise OSError("Permission denied")
+
+        orig = (xnatutils.put_._run_upload, xnatutils.put_._remove_uploaded)
+        xnatutils.put_._run_upload = run_upload
+        xnatutils.put_._remove_uploaded = remove_uploaded
+        try:
+            statuses = list(watch_put(
+                self.tmpdir, interval=0, quiescence=0, max_polls=3,
+                connection=self.MockXnatSession()))
+        finally:
+            xnatutils.put_._run_upload, xnatutils.put_._remove_uploaded = orig
+        # The watch carries on and the series is reported as failed
+        self.assertEqual(uploaded, [('TEST004_001_MR01', 't1', 'DICOM')])
+        self.assertEqual([(st.row, st.status) for st in statuses],
+                         [(self.series_dir, 'failed')])
+        self.assertIn('Permission denied', statuses[0].message)
@@ -0,0 +1,162 @@
+import json
+from datetime import date
+from unittest import TestCase
+from xnatutils.base import (
+    matching_sessions, matching_subjects, iter_projects, iter_json_array,
+    iter_table, SessionRecord)
+from xnatutils.ls_ import ls
+from xnatutils.exceptions import (
+    XnatUtilsKeyError, XnatUtilsNoMatchingSessionsException)
+
+
+def result_set(rows):
+    return {'ResultSet': {'Result': rows, 'totalRecords': str(len(rows))}}
+
+
+class XnatRecordsTest(TestCase):
+
+    class MockSession(object):
+
+        listings = {
+            '/data/projects': [
+                {'ID': 'MRH017', 'name': 'Project 17'},
+                {'ID': 'MRH001', 'name': 'Project 1'}],
+            '/data/projects/MRH017/subjects': [
+                {'ID': 'S2', 'label': 'MRH017_002', 'project': 'MRH017'},
+                {'ID': 'S1', 'label': 'MRH017_001', 'project': 'MRH017'}],
+            '/data/projects/MRH017/experiments': [
+                {'ID': 'E3', 'label': 'MRH017_002_MR01', 'project': 'MRH017',
+                 'subject_ID': 'S2', 'date': '2018-02-27'},
+                {'ID': 'E1', 'label': 'MRH017_001_MR01', 'project': 'MRH017',
+                 'subject_ID': 'S1', 'date': '2017-09-29'},
+                {'ID': 'E2', 'label': 'MRH017_001_MR02', 'project': 'MRH017',
+                 'subject_ID': 'S1', 'date': ''}]}
+
+        class MockResponse(object):
+
+            encoding = None
+
+            def __init__(self, text):
+                self.text = text
+
+            def iter_content(self, chunk_size, decode_unicode=False):
+                # Stream the response in small chunks to exercise the
+                # incremental parsing
+                for i in range(0, len(self.text), 7):
+                    yield self.text[i:i + 7]
+
+            def close(self):
+                pass
+
+        def __init__(self):
+            self.requests = []
+            self.interface = self
+
+        def _format_uri(self, path, format=None, query=None):
+            self.requests.append((path, query))
+            return path
+
+        def _check_response(self, response, uri=None):
+            pass
+
+        def get(self, uri, stream=False):
+            return self.MockResponse(json.dumps(
+                result_set(self.listings[uri])))
+
+        def create_object(self, uri):
+            return ('promoted', uri)
+
+    def test_sessions(self):
+        login = self.MockSession()
+        sessions = matching_sessions(login, 'MRH017_001_.*',
+                                     project_id='MRH017')
+        self.assertEqual([s.label for s in sessions],
+                         ['MRH017_001_MR01', 'MRH017_001_MR02'])
+        self.assertIsInstance(sessions[0], SessionRecord)
+        self.assertEqual(sessions[0].date, date(2017, 9, 29))
+        self.assertEqual(sessions[0].uri, '/data/experiments/E1')
+        # All sessions are listed in a single request
+        self.assertEqual(
+            login.requests,
+            [('/data/projects/MRH017/experiments',
+              {'columns': 'ID,label,project,subject_ID,date'})])
+        self.assertEqual(sessions[0].promote(),
+                         ('promoted', '/data/experiments/E1'))
+
+    def test_session_ids(self):
+        login = self.MockSession()
+        sessions = matching_sessions(
+            login, ['E3', 'MRH017_001_MR01'], project_id='MRH017')
+        self.assertEqual([s.id for s in sessions], ['E1', 'E3'])
+        self.assertRaises(XnatUtilsKeyError, matching_sessions, login,
+                          ['MRH017_003_MR01'], project_id='MRH017')
+
+    def test_session_records(self):
+        login = self.MockSession()
+        listed = matching_sessions(login, [], project_id='MRH017')
+        login.requests = []
+        # Records of sessions that have already been listed aren't looked up
+        # again
+        sessions = matching_sessions(login, listed[1:], after='2018-01-01')
+        self.assertEqual([s.label for s in sessions], ['MRH017_002_MR01'])
+        self.assertEqual(login.requests, [])
+
+    def test_dates(self):
+        login = self.MockSession()
+        sessions = matching_sessions(login, [], project_id='MRH017',
+                                     after='2018-01-01')
+        self.assertEqual([s.label for s in sessions], ['MRH017_002_MR01'])
+        self.assertRaises(
+            XnatUtilsNoMatchingSessionsException, matching_sessions, login,
+            [], project_id='MRH017', before='2017-01-01')
+
+    def test_subjects(self):
+        subjects = matching_subjects(self.MockSession(), [],
+                                     project_id='MRH017')
+        self.assertEqual([s.label for s in subjects],
+                         ['MRH017_001', 'MRH017_002'])
+
+    def test_ls(self):
+        login = self.MockSession()
+        self.assertEqual([p.id for p in iter_projects(login)],
+                         ['MRH017', 'MRH001'])
+        self.assertEqual(ls(datatype='project', connection=login),
+                         ['MRH001', 'MRH017'])
+        self.assertEqual(
+            ls('MRH017_00.*', datatype='session', project_id='MRH017',
+               return_attr='subject_id', connection=login),
+            ['S1', 'S1', 'S2'])
+
+    def test_iter_table_fallback(self):
+
+        class PublicSession(object):
+            "A session without the private methods of XnatPy sessions"
+
+            def __init__(self):
+                self.requests = []
+
+            def get_json(self, uri, query=None):
+                self.requests.append((uri, query))
+                return result_set(XnatRecordsTest.MockSession.listings[uri])
+
+        login = PublicSession()
+        rows = list(iter_table(login, '/data/projects/MRH017/subjects',
+                               columns=('ID', 'label')))
+        self.assertEqual([r['ID'] for r in rows], ['S2', 'S1'])
+        self.assertEqual(login.requests,
+                         [('/data/projects/MRH017/subjects',
+                           {'columns': 'ID,label'})])
+
+    def test_iter_json_array(self):
+        text = json.dumps(result_set([
+            {'ID': str(i), 'label': 'a "quoted" ]}, label'}
+            for i in range(100)]), indent=1)
+        for size in (1, 3, 50, len(text)):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            rows = list(iter_json_array(chunks, 'Result'))
+            self.assertEqual([r['ID'] for r in rows],
+                             [str(i) for i in range(100)])
+            self.assertEqual(rows[0]['label'], 'a "quoted" ]}, label')
+        self.assertEqual(
+            list(iter_json_array(['{"ResultSet": {"Result" : [ ]}}'],
+                                 'Result')), [])
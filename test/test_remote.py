@@ -0,0 +1,154 @@
+import io
+import re
+import json
+from unittest import TestCase
+from xnatutils.get_ import RemoteFile, read_resource_bytes
+from xnatutils.base import SessionRecord
+from xnatutils.exceptions import XnatUtilsUsageError
+
+
+class XnatRemoteFileTest(TestCase):
+
+    CONTENTS = bytes(bytearray(i % 251 for i in range(10000)))
+
+    class MockResponse(object):
+
+        encoding = None
+
+        def __init__(self, status_code, content=b'', headers=None):
+            self.status_code = status_code
+            self.content = content
+            self.headers = headers if headers is not None else {}
+            self.text = content.decode('utf-8', errors='replace')
+
+        def iter_content(self, chunk_size, decode_unicode=False):
+            yield self.text
+
+        def close(self):
+            pass
+
+    class MockSession(object):
+
+        def __init__(self, contents, support_range=True, max_response=None):
+            self.contents = contents
+            self.support_range = support_range
+            self.max_response = max_response
+            self.interface = self
+            self.ranges = []
+
+        def _format_uri(self, path, format=None, query=None):
+            return path
+
+        def _check_response(self, response, accepted_status=None, uri=None):
+            pass
+
+        def head(self, url, allow_redirects=False):
+            return XnatRemoteFileTest.MockResponse(
+                200, headers={'Content-Length': str(len(self.contents))})
+
+        def get(self, url, headers=None, stream=False):
+            if url.endswith('/files'):
+                rows = [{'Name': n, 'URI': url + '/' + n, 'Size': str(len(c))}
+                        for n, c in sorted(self.contents.items())]
+                return XnatRemoteFileTest.MockResponse(
+                    200, json.dumps({'ResultSet': {'Result': rows}}).encode())
+            start, stop = (int(i) for i in re.match(
+                r'bytes=(\d+)-(\d+)', headers['Range']).groups())
+            self.ranges.append((start, stop))
+            if not self.support_range:
+                return XnatRemoteFileTest.MockResponse(200, self.contents)
+            if self.max_response is not None:
+                stop = min(stop, start + self.max_response - 1)
+            return XnatRemoteFileTest.MockResponse(
+                206, self.contents[start:stop + 1],
+                {'Content-Range': 'bytes {}-{}/{}'.format(
+                    start, stop, len(self.contents))})
+
+        def download_stream(self, uri, target_stream):
+            target_stream.write(self.contents[uri.split('/files/')[-1]])
+
+    def test_read(self):
+        login = self.MockSession(self.CONTENTS)
+        f = RemoteFile(login, '/data/files/1.dcm', block_size=1000,
+                       cache_blocks=3)
+        self.assertEqual(f.read(10), self.CONTENTS[:10])
+        f.seek(1500)
+        # Consecutive missing blocks are read in a single request
+        self.assertEqual(f.read(2000), self.CONTENTS[1500:3500])
+        self.assertEqual(login.ranges, [(0, 999), (1000, 3999)])
+        # Blocks in the cache aren't read again
+        f.seek(-7000, io.SEEK_END)
+        self.assertEqual(f.read(100), self.CONTENTS[3000:3100])
+        self.assertEqual(len(login.ranges), 2)
+        f.seek(9990)
+        self.assertEqual(f.read(), self.CONTENTS[9990:])
+        self.assertEqual(f.read(), b'')
+        self.assertEqual(f.tell(), 10000)
+        # Only the most recently used blocks are kept
+        f.seek(0)
+        f.read(1)
+        self.assertEqual(login.ranges[-1], (0, 999))
+        f.close()
+        self.assertRaises(ValueError, f.read)
+
+    def test_no_range_support(self):
+        login = self.MockSession(self.CONTENTS, support_range=False)
+        with RemoteFile(login, '/data/files/1.dcm', block_size=1000) as f:
+            f.seek(5000)
+            self.assertEqual(f.read(3000), self.CONTENTS[5000:8000])
+            f.seek(0)
+            self.assertEqual(f.read(), self.CONTENTS)
+        self.assertEqual(len(login.ranges), 1)
+
+    def test_short_response(self):
+        # The server returns fewer bytes than requested
+        login = self.MockSession(self.CONTENTS, max_response=1500)
+        with RemoteFile(login, '/data/files/1.dcm', block_size=1000) as f:
+            f.seek(500)
+            self.assertEqual(f.read(3000), self.CONTENTS[500:3500])
+            # Only the missing blocks are requested again
+            self.assertEqual(login.ranges, [(0, 3999), (1000, 3999),
+                                            (2000, 3999), (3000, 3999)])
+            f.seek(9500)
+            self.assertEqual(f.read(), self.CONTENTS[9500:])
+
+    def test_read_resource_bytes(self):
+        login = self.MockSession({'a.json': b'{}', 'b.txt': b'b' * 100})
+        session = SessionRecord('E1', 'MRH017_001_MR01', 'MRH017', None,
+                                None, '/data/experiments/E1', None, None,
+                                login)
+        login.get_json = lambda uri, query=None: {'items': [{
+            'children': [{'field': 'resources/resource', 'items': [
+                {'children': [], 'data_fields': {
+                    'xnat_abstractresource_id': 1, 'label': 'QC'}}]}],
+            'data_fields': {'ID': 'E1', 'label': 'MRH017_001_MR01'}}]}
+        self.assertEqual(
+            read_resource_bytes(session, None, connection=login),
+            {'a.json': b'{}', 'b.txt': b'b' * 100})
+        self.assertEqual(
+            read_resource_bytes(session, None, 'QC', files='*.json',
+                                connection=login),
+            {'a.json': b'{}'})
+        self.assertRaises(XnatUtilsUsageError, read_resource_bytes, session,
+                          None, 'QC', max_size=50, connection=login)
+
+    def test_session_lookup(self):
+        login = self.MockSession({'a.json': b'{}'})
+        requested = []
+
+        def get_json(uri, query=None):
+            requested.append(uri)
+            return {'items': [{
+                'children': [{'field': 'resources/resource', 'items': [
+                    {'children': [], 'data_fields': {
+                        'xnat_abstractresource_id': 1, 'label': 'QC'}}]}],
+                'data_fields': {'ID': 'E1', 'label': 'MRH017_001_MR01'}}]}
+
+        login.get_json = get_json
+        # Sessions are retrieved directly instead of being searched for
+        read_resource_bytes('MRH017_001_MR01', None, connection=login)
+        read_resource_bytes('MRH017_001_MR01', None, project_id='MRH017',
+                            connection=login)
+        self.assertEqual(requested, [
+            '/data/experiments/MRH017_001_MR01',
+            '/data/projects/MRH017/experiments/MRH017_001_MR01'])
@@ -0,0 +1,192 @@
+import time
+import json
+import threading
+from datetime import timedelta
+from unittest import TestCase
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from xnat.exceptions import XNATResponseError
+from xnatutils.base import (
+    TransferScheduler, response_status, is_retryable, _parse_retry_after,
+    configure_retries, iter_table)
+
+
+class XnatRetryTest(TestCase):
+
+    class MockResponse(object):
+
+        def __init__(self, status_code, elapsed=0.1, headers=None):
+            self.status_code = status_code
+            self.elapsed = timedelta(seconds=elapsed)
+            self.headers = headers if headers is not None else {}
+            self.url = 'https://xnat.org/data/archive'
+            self.text = ''
+
+    def error(self, status_code):
+        return XNATResponseError(
+            "Invalid response from XNATSession (status {})".format(
+                status_code), self.MockResponse(status_code))
+
+    def test_response_status(self):
+        self.assertEqual(response_status(self.error(503)), 503)
+        self.assertTrue(is_retryable(self.error(503)))
+        self.assertFalse(is_retryable(self.error(404)))
+        self.assertTrue(is_retryable(requests.exceptions.ConnectionError()))
+        self.assertFalse(is_retryable(IOError()))
+        # Failed connections have already been retried by the adapters
+        self.assertFalse(is_retryable(requests.exceptions.ConnectionError(
+            MaxRetryError(None, '/data/archive',
+                          NewConnectionError(None, 'refused')))))
+
+    def test_retry(self):
+        scheduler = TransferScheduler(4, max_retries=3, base_delay=0)
+        calls = []
+
+        def flaky():
+            calls.append(None)
+            if len(calls) < 3:
+                raise self.error(502)
+            return 'done'
+
+        self.assertEqual(scheduler.run(flaky), 'done')
+        self.assertEqual(len(calls), 3)
+        # The limit is only decreased once for failures in quick succession
+        self.assertEqual(scheduler.concurrency, 2)
+
+    def test_no_retry(self):
+        scheduler = TransferScheduler(4, max_retries=3, base_delay=0)
+        calls = []
+
+        def missing():
+            calls.append(None)
+            raise self.error(404)
+
+        self.assertRaises(XNATResponseError, scheduler.run, missing)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(scheduler.concurrency, 4)
+
+    def test_give_up(self):
+        scheduler = TransferScheduler(1, max_retries=2, base_delay=0)
+        calls = []
+
+        def unavailable():
+            calls.append(None)
+            raise self.error(503)
+
+        self.assertRaises(XNATResponseError, scheduler.run, unavailable)
+        self.assertEqual(len(calls), 3)
+
+    def test_aimd(self):
+        scheduler = TransferScheduler(8)
+        scheduler.observe_response(self.MockResponse(503))
+        self.assertEqual(scheduler.concurrency, 4)
+        # Successful transfers increase the limit additively
+        for _ in range(5):
+            scheduler.run(lambda: None)
+        self.assertEqual(scheduler.concurrency, 5)
+
+    def test_latency(self):
+        scheduler = TransferScheduler(8, latency_factor=3)
+        for _ in range(5):
+            scheduler.observe_response(self.MockResponse(200, elapsed=0.1))
+        self.assertEqual(scheduler.concurrency, 8)
+        for _ in range(10):
+            scheduler.observe_response(self.MockResponse(200, elapsed=2.0))
+        self.assertLess(scheduler.concurrency, 8)
+
+    def test_retry_after(self):
+        scheduler = TransferScheduler(2, base_delay=0)
+        scheduler.observe_response(
+            self.MockResponse(429, headers={'Retry-After': '0.2'}))
+        self.assertGreater(scheduler.backoff(0), 0.1)
+        start = time.time()
+        scheduler.run(lambda: None)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertEqual(_parse_retry_after('120'), 120.0)
+        self.assertAlmostEqual(
+            _parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+        self.assertIsNone(_parse_retry_after('soon'))
+
+
+class XnatAdapterRetryTest(TestCase):
+    "Retries made by the adapters mounted by configure_retries"
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            self.server.requests.append(self.path)
+            if self.server.unavailable:
+                self.server.unavailable -= 1
+                self.send_response(503)
+                self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = json.dumps({'ResultSet': {'Result': [
+                {'ID': 'MRH017'}]}}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class MockSession(object):
+
+        def __init__(self, url):
+            self.url = url
+            self.interface = requests.Session()
+
+        def _format_uri(self, path, format=None, query=None):
+            return self.url + path
+
+        def _check_response(self, response, uri=None):
+            if response.status_code != 200:
+                raise XNATResponseError(
+                    "Invalid response from XNATSession (status {})".format(
+                        response.status_code), response)
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), self.Handler)
+        self.server.requests = []
+        self.server.unavailable = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.login = self.MockSession(
+            'http://127.0.0.1:{}'.format(self.server.server_port))
+        configure_retries(self.login, max_retries=3)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.login.interface.close()
+
+    def test_listing(self):
+        # Listings are retried by the adapters
+        self.server.unavailable = 2
+        rows = list(iter_table(self.login, '/data/projects'))
+        self.assertEqual(rows, [{'ID': 'MRH017'}])
+        self.assertEqual(len(self.server.requests), 3)
+        # until the retries run out
+        self.server.unavailable = 10
+        self.assertRaises(XNATResponseError, list,
+                          iter_table(self.login, '/data/projects'))
+        self.assertEqual(len(self.server.requests), 7)
+
+    def test_transfer(self):
+        # Requests made within transfers are only retried by the scheduler
+        self.server.unavailable = 2
+        scheduler = TransferScheduler(1, max_retries=3, base_delay=0)
+        rows = scheduler.run(
+            lambda: list(iter_table(self.login, '/data/projects')))
+        self.assertEqual(rows, [{'ID': 'MRH017'}])
+        self.assertEqual(len(self.server.requests), 3)
+        self.server.unavailable = 10
+        self.assertRaises(
+            XNATResponseError, scheduler.run,
+            lambda: list(iter_table(self.login, '/data/projects')))
+        self.assertEqual(len(self.server.requests), 7)
@@ -0,0 +1,89 @@
+import os
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+import xnatutils.base
+from xnatutils.base import connect, _session_cache_path
+
+
+class XnatSessionCacheTest(TestCase):
+
+    SERVER = 'https://xnat.org'
+
+    class MockInterface(object):
+
+        def __init__(self, jsession):
+            self.cookies = {'JSESSIONID': jsession}
+
+        def mount(self, prefix, adapter):
+            pass
+
+    class MockConnection(object):
+
+        session_expiration_time = (None, 900)
+
+        def __init__(self, jsession):
+            self.interface = XnatSessionCacheTest.MockInterface(jsession)
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.env = dict(os.environ)
+        os.environ['XNATUTILS_CACHE'] = self.cache_dir
+        self.logins = []
+        self.xnat_connect = xnatutils.base.xnat.connect
+
+        def mock_connect(server, loglevel=None, jsession=None, **kwargs):
+            self.logins.append(dict(kwargs, jsession=jsession))
+            return self.MockConnection(
+                jsession if jsession is not None
+                else 'session{}'.format(len(self.logins)))
+
+        xnatutils.base.xnat.connect = mock_connect
+
+    def tearDown(self):
+        xnatutils.base.xnat.connect = self.xnat_connect
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.cache_dir)
+
+    def connect(self, **kwargs):
+        return connect(server=self.SERVER, user='unittest',
+                       password='Test123!', use_netrc=False,
+                       parse_model=False, **kwargs)
+
+    def test_not_cached_by_default(self):
+        self.connect()
+        self.assertFalse(self.logins[0]['cli'])
+        self.assertFalse(os.path.exists(_session_cache_path(self.SERVER)))
+
+    def test_save_and_reuse(self):
+        self.connect(cache_session=True)
+        # Cached sessions aren't logged out on disconnection
+        self.assertTrue(self.logins[0]['cli'])
+        self.assertEqual(self.logins[0]['password'], 'Test123!')
+        with open(_session_cache_path(self.SERVER)) as f:
+            self.assertEqual(json.load(f)['jsession'], 'session1')
+        self.connect(cache_session=True)
+        self.assertEqual(self.logins[1]['jsession'], 'session1')
+        self.assertNotIn('password', self.logins[1])
+        # The model is loaded from the model cache rather than being built by
+        # XnatPy for both fresh and reused sessions
+        self.assertTrue(all(login['no_parse_model'] for login in self.logins))
+        # Sessions cached for another user aren't reused
+        connect(server=self.SERVER, user='other', password='Test123!',
+                use_netrc=False, parse_model=False, cache_session=True)
+        self.assertIsNone(self.logins[2]['jsession'])
+
+    def test_expiry(self):
+        self.connect(cache_session=True)
+        cache_path = _session_cache_path(self.SERVER)
+        with open(cache_path) as f:
+            cached = json.load(f)
+        cached['expires'] -= 900
+        with open(cache_path, 'w') as f:
+            json.dump(cached, f)
+        self.connect(cache_session=True)
+        self.assertIsNone(self.logins[1]['jsession'])
+        with open(cache_path) as f:
+            self.assertEqual(json.load(f)['jsession'], 'session2')
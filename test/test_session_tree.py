@@ -0,0 +1,74 @@
+from datetime import date
+from unittest import TestCase
+from xnatutils.base import fetch_session_tree, matching_scans
+
+
+def resource(resource_id, label, file_count):
+    return {'children': [],
+            'meta': {'xsi:type': 'xnat:resourceCatalog'},
+            'data_fields': {'xnat_abstractresource_id': resource_id,
+                            'label': label, 'format': label,
+                            'file_count': file_count}}
+
+
+def scan(scan_id, scan_type, resources):
+    return {'children': [{'field': 'file', 'items': resources},
+                         {'field': 'parameters/addParam', 'items': []}],
+            'meta': {'xsi:type': 'xnat:mrScanData'},
+            'data_fields': {'ID': scan_id, 'type': scan_type}}
+
+
+TREE = {'items': [{
+    'children': [
+        {'field': 'scans/scan', 'items': [
+            scan('1', 't1_mprage', [resource(101, 'DICOM', 192),
+                                    resource(102, 'NIFTI_GZ', 1)]),
+            scan('2', 'ep2d_diff', [resource(103, 'DICOM', 4000)]),
+            scan('3', None, [])]},
+        {'field': 'resources/resource', 'items': [
+            resource(104, 'NOTES', 2)]}],
+    'meta': {'xsi:type': 'xnat:mrSessionData'},
+    'data_fields': {'ID': 'MBIXNAT_E001', 'label': 'MRH017_001_MR01',
+                    'project': 'MRH017', 'subject_ID': 'MBIXNAT_S001',
+                    'date': '2017-09-29'}}]}
+
+
+class XnatSessionTreeTest(TestCase):
+
+    class MockSession(object):
+
+        uri = '/data/experiments/MBIXNAT_E001'
+
+        def __init__(self):
+            self.xnat_session = self
+            self.paths = []
+
+        def get_json(self, path, query=None):
+            self.paths.append(path)
+            return TREE
+
+    def test_tree(self):
+        session = self.MockSession()
+        tree = fetch_session_tree(session)
+        # The whole tree is retrieved in a single request
+        self.assertEqual(session.paths, ['/data/experiments/MBIXNAT_E001'])
+        self.assertEqual(tree.label, 'MRH017_001_MR01')
+        self.assertEqual(tree.subject_id, 'MBIXNAT_S001')
+        self.assertEqual(tree.date, date(2017, 9, 29))
+        self.assertEqual(list(tree.scans), ['1', '2', '3'])
+        t1 = tree.scans['1']
+        self.assertEqual(t1.type, 't1_mprage')
+        self.assertEqual(list(t1.resources), ['DICOM', 'NIFTI_GZ'])
+        self.assertEqual(t1.resources['DICOM'].file_count, 192)
+        self.assertEqual(
+            t1.resources['DICOM'].uri,
+            '/data/experiments/MBIXNAT_E001/scans/1/resources/101')
+        self.assertEqual(list(tree.resources), ['NOTES'])
+        self.assertIsNone(tree.scans['3'].type)
+
+    def test_matching_scans(self):
+        tree = fetch_session_tree(self.MockSession())
+        self.assertEqual(
+            [s.id for s in matching_scans(tree, ['t1.*', '3'])], ['3', '1'])
+        self.assertEqual(
+            [s.id for s in matching_scans(tree, ['3'], match_id=False)], [])
@@ -0,0 +1,47 @@
+import os
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+from xnatutils import merge_manifests
+from xnatutils.base import parse_shard, in_shard
+from xnatutils.get_ import write_manifest
+from xnatutils.exceptions import XnatUtilsUsageError
+
+
+class XnatShardTest(TestCase):
+
+    labels = ['TEST004_{:03}_MR01'.format(i) for i in range(1, 101)]
+
+    def test_parse(self):
+        self.assertEqual(parse_shard('3/10'), (3, 10))
+        self.assertEqual(parse_shard((0, 1)), (0, 1))
+        self.assertIsNone(parse_shard(None))
+        self.assertRaises(XnatUtilsUsageError, parse_shard, '10/10')
+        self.assertRaises(XnatUtilsUsageError, parse_shard, '1-10')
+
+    def test_partition(self):
+        shards = [[label for label in self.labels if in_shard(label, (i, 4))]
+                  for i in range(4)]
+        self.assertEqual(sorted(sum(shards, [])), self.labels)
+        self.assertTrue(all(shards))
+
+    def test_merge(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for i in (0, 2):
+                matched = [label for label in self.labels
+                           if in_shard(label, (i, 3))]
+                path = os.path.join(tmpdir, '{}.json'.format(i))
+                write_manifest(path, {m: ['/data/' + m] for m in matched},
+                               matched, shard=(i, 3))
+                paths.append(path)
+            output = os.path.join(tmpdir, 'merged.json')
+            merged = merge_manifests(paths, output=output)
+            self.assertEqual(merged['missing_shards'], [1])
+            self.assertEqual(merged['duplicates'], [])
+            with open(output) as f:
+                self.assertEqual(json.load(f)['matched'], merged['matched'])
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from xnatutils.sync_ import (
+    load_sync_state, save_sync_state, _signature, _delete_resources)
+from xnatutils.exceptions import XnatUtilsUsageError
+
+
+class XnatSyncTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.tmpdir, '.xnat-sync-MRH017.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_state(self):
+        state = load_sync_state(self.state_path, 'MRH017')
+        self.assertEqual(state['sessions'], {})
+        state['sessions']['XNAT_E00001'] = {
+            'label': 'MRH017_001_MR01', 'last_modified': '2018-02-27 10:00',
+            'resources': {}}
+        save_sync_state(self.state_path, state)
+        self.assertEqual(load_sync_state(self.state_path, 'MRH017'), state)
+        self.assertRaises(XnatUtilsUsageError, load_sync_state,
+                          self.state_path, 'MRH018')
+
+    def test_signature(self):
+        digests = {'1.dcm': 'abc', '2.dcm': 'def'}
+        self.assertEqual(_signature(digests), _signature(dict(digests)))
+        self.assertNotEqual(_signature(digests),
+                            _signature({'1.dcm': 'abc', '2.dcm': 'xyz'}))
+
+    def test_delete(self):
+        scan_dir = os.path.join(self.tmpdir, 'MRH017_001_MR01', '1-t1')
+        os.makedirs(scan_dir)
+        deleted = _delete_resources(
+            {'/data/experiments/XNAT_E00001/scans/1/resources/DICOM':
+             {'path': scan_dir, 'signature': 'abc'}}, self.tmpdir)
+        self.assertEqual(deleted, [scan_dir])
+        # The empty session directory is removed but not the mirror itself
+        self.assertEqual(os.listdir(self.tmpdir), [])
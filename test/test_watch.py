@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+from unittest import TestCase
+import requests
+import xnatutils.get_
+from xnatutils.get_ import watch, _lag
+from xnatutils.exceptions import XnatUtilsException
+
+
+class XnatWatchTest(TestCase):
+
+    class MockSession(object):
+
+        def __init__(self, polls):
+            self.polls = polls
+            self.paths = []
+
+        def get_json(self, path, query=None):
+            self.paths.append(path)
+            poll = self.polls.pop(0)
+            if isinstance(poll, Exception):
+                raise poll
+            return {'ResultSet': {'Result': [
+                {'ID': r[0], 'label': r[1], 'insert_date': r[2],
+                 'last_modified': r[3] if len(r) > 3 else None}
+                for r in poll]}}
+
+        def clearcache(self):
+            pass
+
+    def test_no_new_sessions(self):
+        existing = [('E1', 'MRH017_001_MR01', '2018-02-27 10:00:00.0')]
+        login = self.MockSession([
+            existing,
+            existing + [('E2', 'MRH018_001_MR01', '2018-02-27 11:00:00.0')]])
+        # The session inserted after the first poll doesn't match the pattern
+        # so nothing is downloaded
+        records = list(watch('MRH017_.*', '/tmp', interval=0, max_polls=2,
+                             project_id='MRH017', connection=login))
+        self.assertEqual(records, [])
+        self.assertEqual(login.paths,
+                         ['/data/projects/MRH017/experiments'] * 2)
+
+    def test_lag(self):
+        inserted = (datetime.now() - timedelta(seconds=90)).strftime(
+            '%Y-%m-%d %H:%M:%S.%f')
+        self.assertAlmostEqual(_lag(inserted), 90, delta=5)
+        self.assertIsNone(_lag(''))
+
+    def test_retry(self):
+        old = '2018-02-27 09:00:00.0'
+        existing = [('E1', 'MRH017_001_MR01', '2018-02-27 10:00:00.0', old)]
+        new = existing + [
+            ('E2', 'MRH017_002_MR01', '2018-02-27 11:00:00.0', old)]
+        # A session that is still being archived
+        modified = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+        archiving = new + [
+            ('E3', 'MRH017_003_MR01', '2018-02-27 12:00:00.0', modified)]
+        # Failures to list the sessions are retried at the next poll
+        error = requests.exceptions.ConnectionError("Connection reset")
+        login = self.MockSession([existing, error, new, archiving,
+                                  archiving])
+        calls = []
+
+        def iter_get(session, download_dir, **kwargs):
+            # The records of the listed sessions are passed to iter_get
+            calls.append([s.id for s in session])
+            if len(calls) == 1:
+                raise XnatUtilsException("Server error")
+            yield session[0].label
+
+        orig_iter_get = xnatutils.get_.iter_get
+        xnatutils.get_.iter_get = iter_get
+        try:
+            records = list(watch('MRH017_.*', '/tmp', interval=0, settle=60,
+                                 max_polls=5, project_id='MRH017',
+                                 connection=login))
+        finally:
+            xnatutils.get_.iter_get = orig_iter_get
+        # The session that failed is downloaded at the next poll and the one
+        # that is still being modified isn't downloaded
+        self.assertEqual(records, ['MRH017_002_MR01'])
+        self.assertEqual(calls, [['E2']] * 2)
@@ -20,8 +20,14 @@ limitations under the License.
 from .version_ import __version__  # noqa
 from .base import connect, set_logger  # noqa
 from .ls_ import ls  # noqa
-from .get_ import get, get_from_xml  # noqa
-from .put_ import put  # noqa
+from .get_ import (  # noqa
+    get, iter_get, watch, get_from_xml, open_remote, read_resource_bytes,
+    RemoteFile)
+from .put_ import put, put_many, watch_put  # noqa
 from .rename_ import rename  # noqa
 from .varget_ import varget  # noqa
 from .varput_ import varput  # noqa
+from .merge_manifests_ import merge_manifests  # noqa
+from .copy_ import copy  # noqa
+from .sync_ import sync_pull  # noqa
+from .index_ import update_index, ProjectIndex  # noqa
@@ -3,21 +3,52 @@ import argparse
 import os.path
 import re
 import errno
+import json
+import types
+from glob import glob
+import time
+import random
+import hashlib
+import functools
+import email.utils
+import sqlite3
+import threading
+import multiprocessing
 from datetime import datetime
 import stat
+import shutil
 import getpass
+import tempfile
+from zipfile import ZipFile
 from builtins import input
 from operator import attrgetter
 from netrc import netrc
+from urllib.parse import unquote
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import (
+    MaxRetryError, NewConnectionError, ConnectTimeoutError)
 import xnat
 from xnat.exceptions import XNATResponseError
 from .exceptions import (
     XnatUtilsLookupError, XnatUtilsUsageError, XnatUtilsKeyError,
     XnatUtilsNoMatchingSessionsException,
-    XnatUtilsSkippedAllSessionsException, XnatUtilsError)
+    XnatUtilsSkippedAllSessionsException, XnatUtilsError,
+    XnatUtilsDigestCheckFailedError)
 import warnings
 import logging
 from .version_ import __version__
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    from xnat.search import inject_search_fields
+except ImportError:  # XnatPy versions without display field searches
+    inject_search_fields = None
 
 logger = logging.getLogger('xnat-utils')
 
@@ -54,11 +85,60 @@ illegal_scan_chars_re = re.compile(r'\.')
 
 session_modality_re = re.compile(r'\w+_\w+_([A-Z]+)\d+')
 
+HASH_CHUNK_SIZE = 2 ** 22
+
+# Environment variable that disables the on-disk cache of file checksums
+NO_CHECKSUM_CACHE_VAR = 'XNATUTILS_NO_CHECKSUM_CACHE'
+
+# Environment variables that disable the on-disk cache of converted resources
+# and override its maximum size (e.g. '20G') and the number of days unused
+# entries are kept for
+NO_CONVERSION_CACHE_VAR = 'XNATUTILS_NO_CONVERSION_CACHE'
+CONVERSION_CACHE_SIZE_VAR = 'XNATUTILS_CONVERSION_CACHE_SIZE'
+CONVERSION_CACHE_AGE_VAR = 'XNATUTILS_CONVERSION_CACHE_AGE'
+DEFAULT_CONVERSION_CACHE_SIZE = 20 * 2 ** 30
+DEFAULT_CONVERSION_CACHE_AGE = 30
+
+# The default idle timeout of XNAT sessions in seconds, used if the server
+# doesn't report it
+DEFAULT_SESSION_TIMEOUT = 900
+
+# The default number of concurrent requests used to crawl metadata listings
+DEFAULT_CRAWL_WORKERS = 8
+
+# The size of the chunks that JSON listings are parsed in (see
+# `iter_json_array`) and the number of characters to keep between chunks when
+# searching for the start of the array
+JSON_CHUNK_SIZE = 2 ** 16
+JSON_KEY_MARGIN = 64
+
+# The default number of times a request or transfer that fails with a
+# transient error is retried
+DEFAULT_MAX_RETRIES = 5
+
+# HTTP status codes returned by overloaded servers (or proxies in front of
+# them) that are worth retrying
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# The maximum number of connections kept open to the server, large enough for
+# the default number of crawl workers plus transfer workers
+HTTP_POOL_SIZE = 32
+
 server_name_re = re.compile(r'(https?://)?([\w\-\.]+).*')
 
+shard_re = re.compile(r'^(\d+)/(\d+)$')
+
+bandwidth_re = re.compile(r'^(\d+(?:\.\d*)?)\s*([kmg]?)(?:i?b(?:/s)?)?$',
+                          re.IGNORECASE)
+
+bandwidth_units = {'': 1, 'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30}
+
+dicom_tag_re = re.compile(r'^\(?([0-9a-fA-F]{4}),?([0-9a-fA-F]{4})\)?$')
+
 
 def connect(server=None, user=None, loglevel='ERROR', connection=None,
-            use_netrc=True, failures=0, password=None):
+            use_netrc=True, failures=0, password=None, cache_session=False,
+            parse_model=True, max_retries=DEFAULT_MAX_RETRIES):
     """
     Opens a connection to an XNAT instance
 
@@ -88,6 +168,19 @@ def connect(server=None, user=None, loglevel='ERROR', connection=None,
     password : str
         Password provided to login. Will be ignored unless 'user' and 'server'
         are not also provided
+    cache_session : bool
+        Whether to save the authenticated session (i.e. its JSESSIONID) in
+        the xnatutils cache directory so that subsequent connections to the
+        server within the session's lifetime can reuse it instead of logging
+        in again. Cached sessions aren't logged out on disconnection. The
+        command-line tools enable this unless '--no_netrc' is passed
+    parse_model : bool
+        Whether to build XnatPy's class model of the server's data types
+        (i.e. `connection.classes`), which is required to access the
+        project/subject/session objects. The model is loaded from an on-disk
+        cache if it has been built for the server (and its XNAT version)
+        before. If False, the model can be loaded later, only if it is
+        required, with `load_model`
     Returns
     -------
     connection : xnat.Session
@@ -142,19 +235,26 @@ def connect(server=None, user=None, loglevel='ERROR', connection=None,
     if server is None:
         server = input(
             'XNAT server hostname (e.g. mbi-xnat.erc.monash.edu.au): ')
+    # Prepend default HTTP protcol if protocol is not present
+    if server_name_re.match(server).group(1) is None:
+        server = 'http://' + server
+    if cache_session:
+        connection = _connect_cached_session(server, user, loglevel)
+        if connection is not None:
+            configure_retries(connection, max_retries)
+            return load_model(connection) if parse_model else connection
     if not netrc_match:
         if user is None:
             user = input("XNAT username for '{}': ".format(server))
         if password is None:
             password = getpass.getpass()
-    # Prepend default HTTP protcol if protocol is not present
-    if server_name_re.match(server).group(1) is None:
-        server = 'http://' + server
     kwargs = {'user': user, 'password': password}
     with warnings.catch_warnings():
         warnings.simplefilter('ignore')
         try:
+            # Sessions that are cached are not closed on disconnection
             connection = xnat.connect(server, loglevel=loglevel,
+                                      cli=cache_session, no_parse_model=True,
                                       **kwargs)
         except ValueError:  # Login failed
             if password is None:
@@ -183,7 +283,10 @@ def connect(server=None, user=None, loglevel='ERROR', connection=None,
                 return connect(server=server, loglevel=loglevel,
                                connection=connection,
                                use_netrc=use_netrc,
-                               failures=failures + 1)
+                               failures=failures + 1,
+                               cache_session=cache_session,
+                               parse_model=parse_model,
+                               max_retries=max_retries)
             else:
                 raise XnatUtilsUsageError(
                     "Three failed attempts, your account '{}' is now "
@@ -204,9 +307,246 @@ def connect(server=None, user=None, loglevel='ERROR', connection=None,
                     "To prevent this from happening in the future pass "
                     "the '--no_netrc' or '-n' option".format(
                         server, netrc_path))
+            if cache_session:
+                _save_cached_session(connection, server, user)
+    configure_retries(connection, max_retries)
+    if parse_model:
+        load_model(connection)
+    return connection
+
+
+def configure_retries(connection, max_retries=DEFAULT_MAX_RETRIES):
+    """
+    Mounts HTTP adapters on a connection that retry idempotent requests
+    (GET, HEAD, OPTIONS and DELETE) that fail with a transient error (see
+    `is_retryable`), with jittered exponential backoff honouring any
+    Retry-After header sent by the server. Uploads aren't retried at this
+    level as their bodies may be streams that can't be replayed.
+
+    Transfers run by a `TransferScheduler` are retried as a whole by the
+    scheduler, which also adapts the number of concurrent transfers to the
+    errors, so only the connection failures of the requests made within
+    them are retried by the adapters (see `_AdapterRetry`). Each kind of
+    failure is therefore retried at one level only, and a request (or
+    transfer) is attempted at most 'max_retries + 1' times for each.
+
+    Parameters
+    ----------
+    connection : xnat.Session
+        The connection to configure
+    max_retries : int
+        The maximum number of times to retry each request
+    """
+    methods = frozenset(['GET', 'HEAD', 'OPTIONS', 'DELETE'])
+    retry_kwargs = dict(
+        total=max_retries, connect=max_retries, read=max_retries,
+        status=max_retries, backoff_factor=0.5,
+        status_forcelist=RETRY_STATUS_CODES, raise_on_status=False,
+        respect_retry_after_header=True)
+    # The names of the Retry options differ between urllib3 versions
+    for version_kwargs in ({'allowed_methods': methods, 'backoff_jitter': 1.0},
+                           {'allowed_methods': methods},
+                           {'method_whitelist': methods}):
+        try:
+            retry = _AdapterRetry(**dict(retry_kwargs, **version_kwargs))
+        except TypeError:
+            continue
+        break
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=HTTP_POOL_SIZE)
+    for prefix in ('http://', 'https://'):
+        connection.interface.mount(prefix, adapter)
+
+
+class _AdapterRetry(Retry):
+    """
+    The retry policy of the adapters mounted by `configure_retries`, which
+    leaves the failures of requests made within transfers run by a
+    `TransferScheduler` (other than failures to connect) to the scheduler
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if _in_transfer():
+            return False
+        return super(_AdapterRetry, self).is_retry(method, status_code,
+                                                   has_retry_after)
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if _in_transfer() and error is not None and not isinstance(
+                error, (NewConnectionError, ConnectTimeoutError)):
+            raise MaxRetryError(_pool, url, error)
+        return super(_AdapterRetry, self).increment(
+            method, url, response, error, _pool, _stacktrace)
+
+
+# Whether the current thread is making a transfer run by a TransferScheduler
+_transfer_state = threading.local()
+
+
+def _in_transfer():
+    return getattr(_transfer_state, 'active', False)
+
+
+def _run_in_transfer(func, *args):
+    """
+    Calls a function, marking the requests it makes in the current thread as
+    part of a transfer (see `_AdapterRetry`)
+    """
+    previous = _in_transfer()
+    _transfer_state.active = True
+    try:
+        return func(*args)
+    finally:
+        _transfer_state.active = previous
+
+
+def load_model(connection):
+    """
+    Builds the XnatPy class model (i.e. `connection.classes`) for a
+    connection opened with 'parse_model=False'. Building the model requires
+    the XML schemas of the server to be downloaded and parsed, so the
+    generated model is cached on disk, keyed by the server URL, its XNAT
+    version and the XnatPy version, and reused by subsequent connections.
+
+    As with models built by XnatPy, the server's display fields are injected
+    into the classes of models loaded from the cache as search fields.
+
+    Parameters
+    ----------
+    connection : xnat.Session
+        The connection to build the model for
+
+    Returns
+    -------
+    connection : xnat.Session
+        The connection passed to the function
+    """
+    if getattr(connection, 'classes', None) is not None:
+        return connection  # Model has already been built
+    prefix = sanitize_re.sub('_', connection.server) + '-'
+    cache_path = os.path.join(
+        get_cache_dir('models'), prefix + sanitize_re.sub(
+            '_', '{}-{}'.format(connection.xnat_version,
+                                xnat.__version__)) + '.py')
+    try:
+        with open(cache_path) as f:
+            source_code = f.read()
+    except IOError:
+        logger.debug("Building XnatPy model for %s", connection.server)
+        xnat.build_model(connection, extension_types=True,
+                         connection_id=hashlib.md5(
+                             cache_path.encode('utf-8')).hexdigest())
+        # Remove models cached for previous versions of the server/XnatPy
+        for path in glob(os.path.join(os.path.dirname(cache_path),
+                                      prefix + '*.py')):
+            remove_ignore_errors(path)
+        with open(cache_path + '.tmp', 'w') as f:
+            f.write(connection.source_code)
+        os.replace(cache_path + '.tmp', cache_path)
+    else:
+        _exec_model(connection, source_code, cache_path)
+    return connection
+
+
+def _exec_model(connection, source_code, path):
+    """
+    Executes cached XnatPy model source code, registers the classes it
+    defines with the connection and injects the search fields into them
+    (mirroring `xnat.build_model`)
+    """
+    module_name = 'xnat.generated.model_{}'.format(
+        hashlib.md5(path.encode('utf-8')).hexdigest())
+    module = types.ModuleType(module_name)
+    exec(compile(source_code, path, 'exec'), module.__dict__)
+    for obj in list(vars(module).values()):
+        if (isinstance(obj, type) and obj.__module__ == module_name and
+                '__register__' in vars(obj)):
+            obj.__register__(module.XNAT_CLASS_LOOKUP)
+    module.SESSION = connection
+    connection.XNAT_CLASS_LOOKUP.update(module.XNAT_CLASS_LOOKUP)
+    connection.classes = module
+    connection.source_code = source_code
+    if inject_search_fields is not None:
+        inject_search_fields(connection)
+
+
+def get_cache_dir(*subdirs):
+    """
+    Returns the path to a sub-directory of the xnatutils cache directory
+    ($XNATUTILS_CACHE if set, otherwise ~/.xnatutils), creating it (readable
+    by the user only) if it doesn't exist
+
+    Parameters
+    ----------
+    subdirs : list(str)
+        The names of the nested sub-directories within the cache directory
+    """
+    path = os.path.join(
+        os.environ.get('XNATUTILS_CACHE',
+                       os.path.join(os.path.expanduser('~'), '.xnatutils')),
+        *subdirs)
+    try:
+        os.makedirs(path, mode=0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def _session_cache_path(server):
+    return os.path.join(get_cache_dir('sessions'),
+                        sanitize_re.sub('_', server) + '.json')
+
+
+def _connect_cached_session(server, user, loglevel):
+    """
+    Connects to the server by reusing a cached session if there is an
+    unexpired one for the given user, returning None otherwise
+    """
+    cache_path = _session_cache_path(server)
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if cached['expires'] < time.time() or (user is not None and
+                                           user != cached['user']):
+        return None
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            connection = xnat.connect(server, loglevel=loglevel,
+                                      jsession=cached['jsession'], cli=True,
+                                      no_parse_model=True)
+        except ValueError:
+            # The session has been closed on the server (e.g. 401 response)
+            logger.debug("Cached session for %s is no longer valid, logging "
+                         "in again", server)
+            remove_ignore_errors(cache_path)
+            return None
+    _save_cached_session(connection, server, cached['user'])
     return connection
 
 
+def _save_cached_session(connection, server, user):
+    jsession = connection.interface.cookies.get('JSESSIONID')
+    if jsession is None:
+        return
+    expiration = getattr(connection, 'session_expiration_time', None)
+    timeout = (expiration[1] if expiration is not None
+               else DEFAULT_SESSION_TIMEOUT)
+    cache_path = _session_cache_path(server)
+    # Create the file so that it is only readable by the user
+    fd = os.open(cache_path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                 stat.S_IRUSR | stat.S_IWUSR)
+    with os.fdopen(fd, 'w') as f:
+        # Expire the cached session a minute early to allow for the time
+        # taken by the command that is using it
+        json.dump({'jsession': jsession, 'user': user,
+                   'expires': time.time() + timeout - 60}, f)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
 def write_netrc(netrc_path, servers):
     """
     Writes servers back to file
@@ -254,12 +594,7 @@ def list_results(login, path, attr):
     try:
         response = login.get_json('/data/archive/' + '/'.join(path))
     except XNATResponseError as e:
-        match = re.search(r'\(status (\d+)\)', str(e))
-        if match:
-            status_code = int(match.group(1))
-        else:
-            status_code = None
-        if status_code == 404:
+        if response_status(e) == 404:
             raise XnatUtilsLookupError(path)
         else:
             raise XnatUtilsUsageError(str(e))
@@ -271,6 +606,269 @@ def list_results(login, path, attr):
     return results
 
 
+def supports_raw_requests(login):
+    """
+    Whether a connection has the private methods of XnatPy sessions that
+    `raw_request` relies on, which aren't part of XnatPy's public API and so
+    may change between its versions
+    """
+    return (hasattr(login, '_format_uri') and
+            hasattr(login, '_check_response'))
+
+
+def raw_request(login, path, method='get', format=None, query=None,
+                accepted_status=None, **kwargs):
+    """
+    Makes a request to the server that XnatPy's public API doesn't support
+    (e.g. a streamed or Range request) and checks the status of its
+    response. This is the only place the private methods of XnatPy sessions
+    are used to build the URLs and check the responses of such requests, so
+    callers that can fall back to the public API (e.g. `get_json`) should
+    check `supports_raw_requests` first
+
+    Parameters
+    ----------
+    login : xnat.Session
+        The connection to the server
+    path : str
+        The path of the request, e.g. '/data/projects/MRH017/experiments'
+    method : str
+        The (lower-case) HTTP method of the request
+    format : str | None
+        The format to request the response in, e.g. 'json'
+    query : dict(str, str) | None
+        The query parameters of the request
+    accepted_status : list(int) | None
+        The status codes that are accepted, defaults to those accepted by
+        XnatPy
+    **kwargs
+        Passed to the request method of the underlying requests session,
+        e.g. 'stream' or 'headers'
+
+    Returns
+    -------
+    response : requests.Response
+        The checked response
+    """
+    uri_kwargs = dict((k, v) for k, v in (('format', format),
+                                          ('query', query)) if v is not None)
+    url = login._format_uri(path, **uri_kwargs)
+    response = getattr(login.interface, method)(url, **kwargs)
+    check_kwargs = {}
+    if accepted_status is not None:
+        check_kwargs['accepted_status'] = accepted_status
+    try:
+        login._check_response(response, uri=url, **check_kwargs)
+    except BaseException:
+        response.close()
+        raise
+    return response
+
+
+def iter_table(login, path, columns=None):
+    """
+    Iterates over the rows of a tabular listing (i.e. a 'ResultSet') on the
+    server, which are parsed from the response as it is streamed (see
+    `iter_json_array`) so memory use doesn't grow with the size of the
+    listing. If the installed version of XnatPy doesn't support streamed
+    requests (see `raw_request`) the whole listing is loaded with `get_json`
+    instead
+
+    Parameters
+    ----------
+    login : xnat.Session
+        The connection to the server
+    path : str
+        The path of the listing, e.g. '/data/projects/MRH017/experiments'
+    columns : list(str) | None
+        The columns to request, if not the default columns of the listing
+    """
+    query = {'columns': ','.join(columns)} if columns else None
+    try:
+        if supports_raw_requests(login):
+            response = raw_request(login, path, format='json',
+                                   query=query, stream=True)
+        else:
+            logger.debug("Streamed requests aren't supported by the "
+                         "installed version of XnatPy, loading %s in full",
+                         path)
+            response = None
+            rows = login.get_json(path, query=query)['ResultSet']['Result']
+    except XNATResponseError as e:
+        if response_status(e) == 404:
+            raise XnatUtilsLookupError(path)
+        raise
+    if response is None:
+        for row in rows:
+            yield row
+        return
+    try:
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        for row in iter_json_array(
+                response.iter_content(JSON_CHUNK_SIZE, decode_unicode=True),
+                'Result'):
+            yield row
+    finally:
+        response.close()
+
+
+def iter_json_array(chunks, key):
+    """
+    Incrementally parses the items of the array under the given key in a
+    JSON document read in chunks of text (e.g. the rows under 'Result' in a
+    'ResultSet' listing), yielding each item as soon as it has been read so
+    that only one item and a chunk of the document are held in memory at a
+    time
+
+    Parameters
+    ----------
+    chunks : iterable(str)
+        The chunks of the JSON document
+    key : str
+        The key of the array to parse the items of. The first occurrence of
+        the key in the document is used
+    """
+    decoder = json.JSONDecoder()
+    start_re = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+    chunks = iter(chunks)
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        match = start_re.search(buf)
+        if match is not None:
+            buf = buf[match.end():]
+            break
+        # Keep the end of the buffer in case the key spans two chunks
+        buf = buf[-(len(key) + JSON_KEY_MARGIN):]
+    else:
+        raise XnatUtilsError(
+            "Did not find '{}' array in JSON response".format(key))
+    pos = 0
+    while True:
+        # Skip the whitespace and separators between items
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf):
+                break
+            buf = next(chunks, None)
+            pos = 0
+            if buf is None:
+                raise XnatUtilsError(
+                    "JSON response ended before the end of the '{}' array"
+                    .format(key))
+        if buf[pos] == ']':
+            return
+        while True:
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The item continues into the next chunk
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise
+                buf = buf[pos:] + chunk
+                pos = 0
+            else:
+                break
+        yield item
+        if pos > JSON_CHUNK_SIZE:
+            buf = buf[pos:]
+            pos = 0
+
+
+def iter_projects(login):
+    """
+    Iterates over the projects the user has access to, yielding a
+    `ProjectRecord` for each as it is parsed from the listing
+    """
+    for row in iter_table(login, '/data/projects'):
+        yield ProjectRecord(row['ID'], row.get('name'),
+                            '/data/projects/' + row['ID'], login)
+
+
+def iter_subjects(login, project_id=None):
+    """
+    Iterates over the subjects (in a project), yielding a `SubjectRecord`
+    for each as it is parsed from the listing
+    """
+    if project_id is not None:
+        path = '/data/projects/{}/subjects'.format(project_id)
+    else:
+        path = '/data/subjects'
+    for row in iter_table(login, path, columns=('ID', 'label', 'project')):
+        yield SubjectRecord(row['ID'], row['label'], row.get('project'),
+                            '/data/subjects/' + row['ID'], login)
+
+
+def iter_sessions(login, project_id=None, subject_id=None):
+    """
+    Iterates over the sessions (in a project or subject), yielding a
+    `SessionRecord` for each as it is parsed from the listing, without its
+    scans and resources (see `fetch_session_tree`)
+    """
+    if subject_id is not None:
+        path = '/data/projects/{}/subjects/{}/experiments'.format(
+            project_id, subject_id)
+    elif project_id is not None:
+        path = '/data/projects/{}/experiments'.format(project_id)
+    else:
+        path = '/data/experiments'
+    for row in iter_table(login, path, columns=(
+            'ID', 'label', 'project', 'subject_ID', 'date')):
+        yield SessionRecord(
+            row['ID'], row['label'], row.get('project'),
+            row.get('subject_ID'), _parse_date(row.get('date')),
+            '/data/experiments/' + row['ID'], None, None, login)
+
+
+def _parse_date(date):
+    if not date:
+        return None
+    return datetime.strptime(date, '%Y-%m-%d').date()
+
+
+def response_status(exception):
+    """
+    Returns the HTTP status code of a XNATResponseError, which older versions
+    of XnatPy only include in the error message, or None if it isn't known
+    """
+    status_code = getattr(exception, 'status_code', None)
+    if status_code is None:
+        match = re.search(r'\(status (\d+)\)', str(exception))
+        if match:
+            status_code = int(match.group(1))
+    return status_code
+
+
+def is_connect_failure(exception):
+    """
+    Whether a request failed because a connection to the server couldn't be
+    established after the retries made by the adapters mounted by
+    `configure_retries`
+    """
+    if not (isinstance(exception, requests.exceptions.ConnectionError) and
+            exception.args and isinstance(exception.args[0], MaxRetryError)):
+        return False
+    return isinstance(exception.args[0].reason,
+                      (NewConnectionError, ConnectTimeoutError))
+
+
+def is_retryable(exception):
+    """
+    Whether an exception raised by a request is transient, i.e. the request
+    could succeed if retried
+    """
+    if isinstance(exception, XNATResponseError):
+        return response_status(exception) in RETRY_STATUS_CODES
+    if is_connect_failure(exception):
+        return False  # Already retried by the adapters (configure_retries)
+    return isinstance(exception, (requests.exceptions.ConnectionError,
+                                  requests.exceptions.Timeout,
+                                  requests.exceptions.ChunkedEncodingError))
+
+
 def _unpack_response(response_part, types):
     if isinstance(response_part, dict):
         if 'children' in response_part:
@@ -299,29 +897,43 @@ def _unpack_response(response_part, types):
     return unpacked
 
 
-def matching_subjects(base, subject_ids, project_id=None):
+def _tree_children(item, field):
+    """
+    Returns the child items of an item in an object tree returned by a
+    '?format=json' request (see `fetch_session_tree`) that are listed under
+    the given field, e.g. 'scans/scan'
+    """
+    return [c for child in item.get('children', [])
+            if child['field'] == field for c in child['items']]
+
+
+def matching_subjects(login, subject_ids, project_id=None, index=None):
+    """
+    Returns `SubjectRecord` records of the subjects that match the given
+    labels or regular expressions (or of the subjects in the projects named
+    by the given IDs if they aren't regular expressions). If a
+    `ProjectIndex` is provided the subjects are listed from it instead of
+    the server (in which case login can be None)
+    """
     if isinstance(subject_ids, basestring):
         subject_ids = [subject_ids]
-    if project_id is not None:
-        try:
-            base = base.projects[project_id]
-        except KeyError:
-            raise XnatUtilsKeyError(
-                project_id, "No project named '{}'".format(project_id))
     if not subject_ids:
         if project_id is None:
             raise XnatUtilsUsageError(
                 "project_id (\"-p\") must be provided to use empty IDs string")
-        subjects = base.subjects.values()
+        subjects = list(_project_subjects(login, project_id, index))
     elif is_regex(subject_ids):
-        subjects = [s for s in base.subjects.values()
+        subjects = [s for s in _project_subjects(login, project_id, index)
                     if any(re.match(i + '$', s.label)
                            for i in subject_ids)]
     else:
-        subjects = set()
+        subjects = []
         for id_ in subject_ids:
             try:
-                subjects.update(base.projects[id_].subjects.values())
+                if index is not None:
+                    subjects.extend(index.iter_subjects(id_))
+                else:
+                    subjects.extend(iter_subjects(login, id_))
             except XnatUtilsLookupError:
                 raise XnatUtilsKeyError(
                     id_,
@@ -330,19 +942,34 @@ def matching_subjects(base, subject_ids, project_id=None):
     return sorted(subjects, key=attrgetter('label'))
 
 
+def _project_subjects(login, project_id, index=None):
+    if index is not None:
+        subjects = index.iter_subjects(project_id)
+    else:
+        subjects = iter_subjects(login, project_id)
+    try:
+        for subject in subjects:
+            yield subject
+    except XnatUtilsLookupError:
+        raise XnatUtilsKeyError(
+            project_id, "No project named '{}'".format(project_id))
+
+
 def matching_sessions(login, session_ids, with_scans=None,
                       without_scans=None, skip=(), before=None,
-                      after=None, project_id=None, subject_id=None):
+                      after=None, project_id=None, subject_id=None,
+                      crawl_workers=DEFAULT_CRAWL_WORKERS, index=None):
     """
     Parameters
     ----------
     login : xnat.Session
         The XNAT session  object (i.e. wrapper around requests.Session
         object representing a user login session not an imaging session)
-    session_ids : str | list(str)
+    session_ids : str | list(str) | list(SessionRecord)
         A regex or name, or list of, with which to match the sessions
         with. Can also be a project (no underscores) or subject (exactly
-        one underscore) name.
+        one underscore) name. Records of sessions that have already been
+        listed are filtered without listing the sessions again
     with_scans : str | list(str)
         Regex(es) with which to match scans within sessions. Only
         sessions containing these scans will be matched
@@ -362,6 +989,18 @@ def matching_sessions(login, session_ids, with_scans=None,
     subject_id : str
         The subject ID to retrieve the sessions from. Requires project_id to
         also be supplied
+    crawl_workers : int
+        The number of sessions to retrieve the metadata of concurrently when
+        filtering them by scans
+    index : ProjectIndex | None
+        A local index of the project to match the sessions (and their scans)
+        from instead of the server, in which case login can be None
+
+    Returns
+    -------
+    sessions : list(SessionRecord)
+        Records of the matching sessions, sorted by label, which are listed
+        in a single request (see `iter_sessions`)
     """
     if isinstance(session_ids, basestring):
         session_ids = [session_ids]
@@ -379,11 +1018,16 @@ def matching_sessions(login, session_ids, with_scans=None,
         without_scans = ()
 
     def valid(session):
-        if before is not None and session.date > before:
+        if before is not None and (session.date is None or
+                                   session.date > before):
             return False
-        if after is not None and session.date < after:
+        if after is not None and (session.date is None or
+                                  session.date < after):
             return False
         if with_scans or without_scans:
+            # Records from an index already include their scans
+            if session.scans is None:
+                session = fetch_session_tree(session)
             scans = [(s.type if s.type is not None else s.id)
                      for s in session.scans.values()]
             for scan_type in with_scans:
@@ -394,47 +1038,67 @@ def matching_sessions(login, session_ids, with_scans=None,
                     return False
         return True
 
-    if project_id is not None:
-        try:
-            base = login.projects[project_id]
-        except KeyError:
-            raise XnatUtilsKeyError(
-                project_id,
-                "No project named '{}'".format(project_id))
+    if subject_id is not None and project_id is None:
+        raise XnatUtilsUsageError(
+            "Must provide project_id if subject_id is provided ('{}')"
+            .format(subject_id))
+    if not session_ids and project_id is None:
+        raise XnatUtilsUsageError(
+            "project_id (\"-p\") must be provided to use empty IDs string")
+    if session_ids and all(isinstance(i, SessionRecord)
+                           for i in session_ids):
+        # Sessions that have already been listed (e.g. by `watch`) are only
+        # filtered rather than being looked up again
+        sessions = list(session_ids)
+        session_ids = [s.label for s in sessions]
+    else:
+        # The listing is filtered as it is parsed so only the records of the
+        # matching sessions are kept in memory
+        if index is not None:
+            listed = index.iter_sessions(project_id=project_id,
+                                         subject_id=subject_id)
         else:
+            listed = iter_sessions(login, project_id=project_id,
+                                   subject_id=subject_id)
+        try:
+            if not session_ids:
+                sessions = list(listed)
+            elif is_regex(session_ids):
+                sessions = [s for s in listed if any(re.match(i + '$', s.label)
+                                                     for i in session_ids)]
+            else:
+                # Sessions can be referred to by either their ID or label
+                by_key = {}
+                for session in listed:
+                    if session.label in session_ids:
+                        by_key.setdefault(session.label, session)
+                    if session.id in session_ids:
+                        by_key[session.id] = session
+        except XnatUtilsLookupError:
             if subject_id is not None:
+                raise XnatUtilsKeyError(
+                    subject_id, "No subject named '{}' in project '{}'"
+                    .format(subject_id, project_id))
+            raise XnatUtilsKeyError(
+                project_id, "No project named '{}'".format(project_id))
+        if session_ids and not is_regex(session_ids):
+            sessions = {}
+            for id_ in session_ids:
                 try:
-                    base = base.subjects[subject_id]
+                    session = by_key[id_]
                 except KeyError:
                     raise XnatUtilsKeyError(
-                        subject_id,
-                        "No subject named '{}' in project '{}'"
-                        .format(subject_id, project_id))
-    else:
-        if subject_id is not None:
-            raise XnatUtilsUsageError(
-                "Must provide project_id if subject_id is provided ('{}')"
-                .format(subject_id))
-        base = login
-    if not session_ids:
-        if project_id is None:
-            raise XnatUtilsUsageError(
-                "project_id (\"-p\") must be provided to use empty IDs string")
-        sessions = set(base.experiments.values())
-    elif is_regex(session_ids):
-        sessions = set(s for s in base.experiments.values()
-                       if any(re.match(i + '$', s.label)
-                              for i in session_ids))
+                        id_, "No session named '{}'".format(id_))
+                sessions[session.id] = session
+            sessions = list(sessions.values())
+    if (with_scans or without_scans) and index is None:
+        # Filtering by scans requires the scans of each session to be
+        # retrieved so check them concurrently
+        filtered = [s for s, is_valid in iter_concurrent(
+            lambda s: (s, valid(s)), ((s,) for s in sessions),
+            num_workers=crawl_workers) if is_valid]
     else:
-        sessions = set()
-        for id_ in session_ids:
-            try:
-                session = base.experiments[id_]
-            except KeyError:
-                raise XnatUtilsKeyError(
-                    id_, "No session named '{}'".format(id_))
-            sessions.add(session)
-    filtered = [s for s in sessions if valid(s)]
+        filtered = [s for s in sessions if valid(s)]
     if not filtered:
         raise XnatUtilsNoMatchingSessionsException(
             "No accessible sessions matched pattern(s) '{}'"
@@ -451,7 +1115,27 @@ def matching_sessions(login, session_ids, with_scans=None,
     return sorted(filtered, key=attrgetter('label'))
 
 
-def matching_scans(session, scan_types, match_id=True):
+def matching_scans(session, scan_types, match_id=True, dicom_filters=None,
+                   num_workers=DEFAULT_CRAWL_WORKERS):
+    """
+    Parameters
+    ----------
+    session : xnat.classes.MrSessionData
+        The session to match the scans of
+    scan_types : list(str) | None
+        Regexes with which to match the scans types (or IDs if the type is
+        None and 'match_id' is True). If None all scans are matched
+    match_id : bool
+        Whether to match scans that don't have a type on their ID
+    dicom_filters : dict(str, str) | list(str) | None
+        Regexes with which to match fields of the DICOM headers of the scans
+        (see `parse_dicom_filters`). The headers are retrieved from the
+        server's DICOM dump service concurrently (see `fetch_dicom_header`),
+        so only the scans that match are downloaded. Scans without a DICOM
+        resource, or whose headers can't be retrieved, aren't matched
+    num_workers : int
+        The number of DICOM headers to retrieve concurrently
+    """
     def label(scan):
         if scan.type is not None:
             label = scan.type
@@ -464,52 +1148,1352 @@ def matching_scans(session, scan_types, match_id=True):
     if scan_types is not None:
         matches = (s for s in matches if any(
             re.match(i + '$', label(s)) for i in scan_types))
-    return sorted(matches, key=label)
+    matches = sorted(matches, key=label)
+    if dicom_filters:
+        filters = parse_dicom_filters(dicom_filters)
 
+        def header_matches(scan):
+            header = fetch_dicom_header(session, scan)
+            return scan.id, header is not None and all(
+                header.get(field) is not None and
+                re.match(regex + '$', header[field])
+                for field, regex in filters)
 
-def find_executable(name):
+        matched_ids = set(scan_id for scan_id, is_match in iter_concurrent(
+            header_matches, ((s,) for s in matches),
+            num_workers=num_workers) if is_match)
+        matches = [s for s in matches if s.id in matched_ids]
+    return matches
+
+
+def parse_dicom_filters(filters):
     """
-    Finds the location of an executable on the system path
+    Parses filters on the fields of DICOM headers into a list of (field,
+    regex) tuples, where the fields are normalised so they can be looked up
+    in the headers returned by `fetch_dicom_header`
 
     Parameters
     ----------
-    name : str
-        Name of the executable to search for on the system path
+    filters : dict(str, str) | list(str)
+        Regexes keyed by the DICOM keyword (e.g. 'SeriesDescription') or tag
+        (e.g. '0008,103E') of the field to match, or 'field=regex' strings
+        (e.g. 'ImageType=ORIGINAL.*')
     """
-    path = None
-    for path_prefix in os.environ['PATH'].split(os.path.pathsep):
-        prov_path = os.path.join(path_prefix, name)
-        if os.path.exists(prov_path):
-            path = prov_path
-    return path
+    if isinstance(filters, dict):
+        items = filters.items()
+    else:
+        if isinstance(filters, basestring):
+            filters = [filters]
+        items = []
+        for dicom_filter in filters:
+            field, sep, regex = dicom_filter.partition('=')
+            if not sep or not field.strip():
+                raise XnatUtilsUsageError(
+                    "Invalid DICOM filter '{}', should be of the form "
+                    "'field=regex' (e.g. 'SeriesDescription=.*MPRAGE.*')"
+                    .format(dicom_filter))
+            items.append((field, regex))
+    return [(_dicom_field_key(field), regex) for field, regex in items]
 
 
-class WrappedXnatSession(object):
+def _dicom_field_key(field):
     """
-    Wraps a XnatPy session in a way that it can be used in a 'with'
-    context and not disconnect upon exit of the context
+    Normalises the keyword, description (e.g. 'Series Description') or tag
+    of a DICOM field
+    """
+    match = dicom_tag_re.match(field.strip())
+    if match is not None:
+        return ''.join(match.groups()).upper()
+    return re.sub(r'[^a-z0-9]', '', re.sub(r"'s\b", '', field.lower()))
+
+
+def fetch_dicom_header(session, scan, use_cache=True):
+    """
+    Retrieves the DICOM header of a scan (i.e. of one of the files in the
+    series) from the server's DICOM dump service, instead of downloading
+    the series. Headers are cached on disk (see `DicomHeaderCache`).
 
     Parameters
     ----------
-    xnat_session : xnat.Session
-        The XnatPy session to wrap
+    session : SessionRecord
+        The session the scan belongs to
+    scan : ScanRecord
+        The scan to retrieve the header of
+    use_cache : bool
+        Whether to look up (and save) the header in the header cache
+
+    Returns
+    -------
+    header : dict(str, str) | None
+        The values of the (top-level) fields in the header, keyed by both
+        their normalised keyword (e.g. 'seriesdescription') and tag (e.g.
+        '0008103E'), or None if the scan doesn't have a DICOM resource or
+        its header couldn't be retrieved
     """
+    resource = scan.resources.get('DICOM')
+    if resource is None:
+        logger.debug("Scan %s of %s doesn't have a DICOM resource, cannot "
+                     "match its header", scan.id, session.label)
+        return None
+    login = scan.xnat_session
+    cache = DicomHeaderCache.default() if use_cache else None
+    if cache is not None:
+        key = cache.key(login.server, scan, resource)
+        header = cache.lookup(key)
+        if header is not None:
+            return header
+    try:
+        response = login.get_json(
+            '/data/services/dicomdump',
+            query={'src': '/archive/projects/{}/experiments/{}/scans/{}'
+                   .format(session.project, session.id, scan.id),
+                   'format': 'json'})
+        header = {}
+        for row in response['ResultSet']['Result']:
+            match = dicom_tag_re.match(row.get('tag1', ''))
+            # Skip the fields nested in sequences
+            if match is None or row.get('tag2'):
+                continue
+            header[''.join(match.groups()).upper()] = row.get('value')
+            if row.get('desc'):
+                header[_dicom_field_key(row['desc'])] = row.get('value')
+    except (XNATResponseError, requests.exceptions.RequestException,
+            KeyError, ValueError) as e:
+        # Not cached so the header is requested again next time
+        logger.warning("Could not retrieve the DICOM header of scan %s of "
+                       "%s, treating it as not matching: %s", scan.id,
+                       session.label, e)
+        return None
+    if cache is not None:
+        cache.store(key, header)
+    return header
 
-    def __init__(self, xnat_session):
-        self._session = xnat_session
 
-    def __enter__(self):
-        return self._session
+def fetch_session_tree(session):
+    """
+    Retrieves the scans and resources of a session (i.e. its object tree) in
+    a single request, instead of the separate requests XnatPy makes for the
+    scan listing of the session and the resource listing of each scan. The
+    tree is returned as lightweight `SessionRecord`, `ScanRecord` and
+    `ResourceRecord` records, which have the attributes of the corresponding
+    XnatPy objects that xnatutils reads (e.g. `session.scans.values()`,
+    `scan.resources[label]` and `resource.download_dir`).
 
-    def __exit__(self, *args, **kwargs):
-        pass
+    Parameters
+    ----------
+    session : xnat.classes.MrSessionData
+        The session to retrieve the tree of
+    """
+    login = session.xnat_session
+    response = login.get_json(session.uri)
+    item = response['items'][0]
+    fields = item['data_fields']
 
+    def resources(item, uri):
+        records = OrderedDict()
+        for child in item:
+            data = child['data_fields']
+            resource_id = data.get('xnat_abstractresource_id', data['label'])
+            records[data['label']] = ResourceRecord(
+                str(resource_id), data['label'], data.get('format'),
+                data.get('file_count'), data.get('file_size'),
+                '{}/resources/{}'.format(uri, resource_id), login)
+        return records
 
-def remove_ignore_errors(path):
-    try:
-        os.remove(path)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
+    scans = OrderedDict()
+    for child in _tree_children(item, 'scans/scan'):
+        data = child['data_fields']
+        uri = '{}/scans/{}'.format(session.uri, data['ID'])
+        scans[data['ID']] = ScanRecord(
+            data['ID'], data.get('type'), uri,
+            resources(_tree_children(child, 'file'), uri), login)
+    return SessionRecord(
+        fields['ID'], fields['label'], fields.get('project'),
+        fields.get('subject_ID'), _parse_date(fields.get('date')),
+        session.uri, scans,
+        resources(_tree_children(item, 'resources/resource'), session.uri),
+        login)
+
+
+def prefetch_session_trees(sessions, num_workers=DEFAULT_CRAWL_WORKERS):
+    """
+    Retrieves the object trees of many sessions concurrently (see
+    `fetch_session_tree`), yielding a `SessionRecord` for each session in the
+    order they are retrieved
+
+    Parameters
+    ----------
+    sessions : list(xnat.classes.MrSessionData)
+        The sessions to retrieve the trees of
+    num_workers : int
+        The number of concurrent requests to make
+    """
+    return iter_concurrent(fetch_session_tree, ((s,) for s in sessions),
+                           num_workers=num_workers)
+
+
+class _Record(object):
+    """
+    Base class of the lightweight (tuple-backed) records of objects on the
+    server that are used in place of XnatPy objects when listing and
+    filtering many of them
+    """
+    __slots__ = ()
+
+    def promote(self):
+        """
+        Returns the full XnatPy object corresponding to the record, for
+        when attributes that aren't in the record are required
+        """
+        return self.xnat_session.create_object(self.uri)
+
+
+class ProjectRecord(_Record, namedtuple('ProjectRecord', (
+        'id', 'name', 'uri', 'xnat_session'))):
+    """
+    Record of a project listed by `iter_projects`
+
+    Parameters
+    ----------
+    id : str
+        The ID of the project
+    name : str
+        The name of the project
+    uri : str
+        The URI of the project
+    xnat_session : xnat.Session
+        The connection the project was listed over
+    """
+    __slots__ = ()
+
+
+class SubjectRecord(_Record, namedtuple('SubjectRecord', (
+        'id', 'label', 'project', 'uri', 'xnat_session'))):
+    """
+    Record of a subject listed by `iter_subjects`
+
+    Parameters
+    ----------
+    id : str
+        The ID of the subject
+    label : str
+        The label of the subject
+    project : str
+        The ID of the project the subject belongs to
+    uri : str
+        The URI of the subject
+    xnat_session : xnat.Session
+        The connection the subject was listed over
+    """
+    __slots__ = ()
+
+
+class SessionRecord(_Record, namedtuple('SessionRecord', (
+        'id', 'label', 'project', 'subject_id', 'date', 'uri', 'scans',
+        'resources', 'xnat_session'))):
+    """
+    Record of a session listed by `iter_sessions` or retrieved by
+    `fetch_session_tree`. The scans and resources of the session are only
+    included in records retrieved by `fetch_session_tree` (otherwise they
+    are None)
+
+    Parameters
+    ----------
+    id : str
+        The ID of the session
+    label : str
+        The label of the session
+    project : str
+        The ID of the project the session belongs to
+    subject_id : str
+        The ID of the subject the session belongs to
+    date : datetime.date | None
+        The date of the session
+    uri : str
+        The URI of the session
+    scans : OrderedDict(str, ScanRecord) | None
+        The scans of the session keyed by ID
+    resources : OrderedDict(str, ResourceRecord) | None
+        The session-level resources keyed by label
+    xnat_session : xnat.Session
+        The connection the session was retrieved over
+    """
+    __slots__ = ()
+
+    @property
+    def subject(self):
+        return self.xnat_session.create_object(
+            '/data/subjects/' + self.subject_id)
+
+
+class ScanRecord(_Record, namedtuple('ScanRecord', (
+        'id', 'type', 'uri', 'resources', 'xnat_session'))):
+    """
+    Record of a scan retrieved by `fetch_session_tree`
+
+    Parameters
+    ----------
+    id : str
+        The ID of the scan
+    type : str | None
+        The type of the scan
+    uri : str
+        The URI of the scan
+    resources : OrderedDict(str, ResourceRecord)
+        The resources of the scan keyed by label
+    xnat_session : xnat.Session
+        The connection the scan was retrieved over
+    """
+    __slots__ = ()
+
+
+class ResourceRecord(_Record, namedtuple('ResourceRecord', (
+        'id', 'label', 'format', 'file_count', 'file_size', 'uri',
+        'xnat_session'))):
+    """
+    Record of a resource retrieved by `fetch_session_tree`
+
+    Parameters
+    ----------
+    id : str
+        The ID of the resource
+    label : str
+        The label of the resource (i.e. its format, e.g. 'DICOM')
+    format : str | None
+        The format stored in the resource metadata
+    file_count : int | None
+        The number of files in the resource
+    file_size : int | None
+        The total size of the files in the resource
+    uri : str
+        The URI of the resource
+    xnat_session : xnat.Session
+        The connection the resource was retrieved over
+    """
+    __slots__ = ()
+
+    def download_dir(self, target_dir):
+        """
+        Downloads the files of the resource as a zip and extracts it into
+        the target directory (as per the XnatPy method of the same name)
+        """
+        with tempfile.TemporaryFile() as f:
+            self.xnat_session.download_stream(self.uri + '/files', f,
+                                              format='zip')
+            with ZipFile(f) as zip_file:
+                zip_file.extractall(target_dir)
+
+
+def parse_shard(shard):
+    """
+    Parses a shard specification of the form 'i/N' (where 0 <= i < N) into a
+    tuple of integers
+
+    Parameters
+    ----------
+    shard : str | tuple(int, int) | None
+        The shard specification, e.g. '3/10' for the fourth of ten shards
+    """
+    if shard is None:
+        return None
+    if isinstance(shard, basestring):
+        match = shard_re.match(shard.strip())
+        if match is None:
+            raise XnatUtilsUsageError(
+                "Invalid shard specification '{}', should be of the form "
+                "'i/N' (e.g. '0/10')".format(shard))
+        shard = tuple(int(g) for g in match.groups())
+    index, count = shard
+    if count < 1 or not 0 <= index < count:
+        raise XnatUtilsUsageError(
+            "Invalid shard '{}/{}', index must be >= 0 and less than the "
+            "number of shards".format(index, count))
+    return index, count
+
+
+def in_shard(label, shard):
+    """
+    Whether the given label is assigned to the given shard. Assignment uses
+    a hash of the label so that it is stable regardless of what other
+    sessions are matched (i.e. sessions added between the runs of
+    different shards won't shift the assignment of existing sessions)
+
+    Parameters
+    ----------
+    label : str
+        The label of the session
+    shard : tuple(int, int)
+        The (index, count) of the shard as returned by `parse_shard`
+    """
+    index, count = shard
+    digest = hashlib.md5(label.encode('utf-8')).hexdigest()
+    return int(digest, 16) % count == index
+
+
+def parse_bandwidth(bandwidth):
+    """
+    Parses a bandwidth specification into a number of bytes per second
+
+    Parameters
+    ----------
+    bandwidth : str | float | None
+        The bandwidth in bytes per second, optionally with a 'K', 'M' or 'G'
+        suffix (powers of 1024), e.g. '50M' or '1.5G'
+    """
+    if bandwidth is None:
+        return None
+    if isinstance(bandwidth, basestring):
+        match = bandwidth_re.match(bandwidth.strip())
+        if match is None:
+            raise XnatUtilsUsageError(
+                "Invalid bandwidth '{}', should be a number of bytes per "
+                "second with an optional K, M or G suffix (e.g. '50M')"
+                .format(bandwidth))
+        bandwidth = (float(match.group(1)) *
+                     bandwidth_units[match.group(2).lower()])
+    if bandwidth <= 0:
+        raise XnatUtilsUsageError(
+            "Bandwidth must be greater than zero ({})".format(bandwidth))
+    return float(bandwidth)
+
+
+def parse_size(size):
+    """
+    Parses a size specification into a number of bytes
+
+    Parameters
+    ----------
+    size : str | int
+        The size in bytes, optionally with a 'K', 'M' or 'G' suffix (powers
+        of 1024), e.g. '20G'
+    """
+    if isinstance(size, basestring):
+        match = bandwidth_re.match(size.strip())
+        if match is None:
+            raise XnatUtilsUsageError(
+                "Invalid size '{}', should be a number of bytes with an "
+                "optional K, M or G suffix (e.g. '20G')".format(size))
+        size = (float(match.group(1)) *
+                bandwidth_units[match.group(2).lower()])
+    return int(size)
+
+
+def interleave(groups):
+    """
+    Interleaves the items of an iterable of groups (e.g. the resources of
+    each session) round-robin, so that one large group doesn't hold up the
+    items of the groups after it. The groups are consumed lazily, with a new
+    group joining the rotation each time an item is yielded, so the first
+    items are yielded without waiting for all the groups to be available.
+
+    Parameters
+    ----------
+    groups : iterable(iterable)
+        The groups to interleave the items of
+    """
+    groups = iter(groups)
+    rotation = deque()
+    exhausted = False
+    while not exhausted or rotation:
+        if not exhausted:
+            try:
+                rotation.append(iter(next(groups)))
+            except StopIteration:
+                exhausted = True
+        if not rotation:
+            continue
+        group = rotation.popleft()
+        try:
+            item = next(group)
+        except StopIteration:
+            continue
+        rotation.append(group)
+        yield item
+
+
+def calculate_checksum(fname, use_cache=True):
+    """
+    Calculates the MD5 digest of a file. Digests are cached on disk keyed by
+    the path, inode, size and modification time of the file, so unchanged
+    files aren't re-read on subsequent calls (e.g. when rerunning an upload).
+
+    Parameters
+    ----------
+    fname : str
+        Path to the file
+    use_cache : bool
+        Whether to look up (and save) the digest in the checksum cache. The
+        cache can also be disabled by setting $XNATUTILS_NO_CHECKSUM_CACHE
+    """
+    if use_cache and not os.environ.get(NO_CHECKSUM_CACHE_VAR):
+        cache = ChecksumCache.default()
+    else:
+        cache = None
+    try:
+        if cache is not None:
+            key = cache.key(fname)
+            digest = cache.lookup(key)
+            if digest is not None:
+                return digest
+        file_hash = hashlib.md5()
+        buff = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buff)
+        with open(fname, 'rb', buffering=0) as f:
+            for num_bytes in iter(lambda: f.readinto(buff), 0):
+                file_hash.update(view[:num_bytes])
+        digest = file_hash.hexdigest()
+    except (OSError, IOError):
+        raise XnatUtilsDigestCheckFailedError(
+            "Could not check digest of '{}' ".format(fname))
+    if cache is not None:
+        cache.store(key, digest)
+    return digest
+
+
+def calculate_checksums(fnames, num_workers=None, use_cache=True):
+    """
+    Calculates the MD5 digests of a list of files, hashing the files that
+    aren't in the checksum cache concurrently (hashlib releases the GIL
+    while hashing large buffers)
+
+    Parameters
+    ----------
+    fnames : list(str)
+        Paths to the files
+    num_workers : int | None
+        The number of threads to hash the files in, defaults to the number
+        of CPUs
+    use_cache : bool
+        Whether to use the checksum cache (see `calculate_checksum`)
+
+    Returns
+    -------
+    digests : dict(str, str)
+        The digests of the files keyed by their path
+    """
+    fnames = list(fnames)
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = min(num_workers, len(fnames))
+    return dict(iter_concurrent(
+        lambda f: (f, calculate_checksum(f, use_cache=use_cache)),
+        ((f,) for f in fnames), num_workers=num_workers))
+
+
+class _SQLiteCache(object):
+    """
+    Base class of the SQLite stores in the xnatutils cache directory. A
+    separate connection is opened for each operation so the cache can be
+    shared between threads and processes, and errors accessing it are logged
+    and otherwise ignored (after which the cache is disabled)
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database
+    """
+
+    # The statement that creates the table of the cache and its name in
+    # messages
+    SCHEMA = None
+    NAME = None
+
+    def __init__(self, path):
+        self.path = path
+        self._disabled = False
+        self._execute(self.SCHEMA)
+
+    def _execute(self, sql, params=()):
+        if self._disabled:
+            return []
+        try:
+            conn = sqlite3.connect(self.path, timeout=30)
+            try:
+                with conn:
+                    return conn.execute(sql, params).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning("Could not access %s at %s (%s), disabling it",
+                           self.NAME, self.path, e)
+            self._disabled = True
+            return []
+
+
+class ChecksumCache(_SQLiteCache):
+    """
+    A SQLite store of the MD5 digests of local files, keyed by their
+    absolute path, inode, size and modification time (in ns). Errors
+    accessing it are logged and otherwise ignored (i.e. the digest is just
+    recalculated).
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database
+    """
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS checksums ("
+              "path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, "
+              "mtime_ns INTEGER, md5 TEXT)")
+    NAME = 'checksum cache'
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    @classmethod
+    def default(cls):
+        "Returns the cache stored in the xnatutils cache directory"
+        with cls._default_lock:
+            path = os.path.join(get_cache_dir(), 'checksums.sqlite')
+            if cls._default is None or cls._default.path != path:
+                cls._default = cls(path)
+            return cls._default
+
+    @classmethod
+    def key(cls, fname):
+        fstat = os.stat(fname)
+        mtime_ns = getattr(fstat, 'st_mtime_ns',
+                           int(fstat.st_mtime * 1e9))
+        return (os.path.abspath(fname), fstat.st_ino, fstat.st_size,
+                mtime_ns)
+
+    def lookup(self, key):
+        rows = self._execute(
+            "SELECT md5 FROM checksums WHERE path=? AND inode=? AND size=? "
+            "AND mtime_ns=?", key)
+        return rows[0][0] if rows else None
+
+    def store(self, key, digest):
+        self._execute(
+            "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)",
+            tuple(key) + (digest,))
+
+
+class DicomHeaderCache(_SQLiteCache):
+    """
+    A SQLite store of the DICOM headers of scans retrieved by
+    `fetch_dicom_header`, keyed by the server, the URI of the scan and the
+    number and total size of the files in its DICOM resource (so the header
+    is retrieved again if the series is replaced). Errors accessing it are
+    logged and otherwise ignored (i.e. the header is just retrieved again).
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database
+    """
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS headers ("
+              "key TEXT PRIMARY KEY, header TEXT)")
+    NAME = 'DICOM header cache'
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    @classmethod
+    def default(cls):
+        "Returns the cache stored in the xnatutils cache directory"
+        with cls._default_lock:
+            path = os.path.join(get_cache_dir(), 'dicom_headers.sqlite')
+            if cls._default is None or cls._default.path != path:
+                cls._default = cls(path)
+            return cls._default
+
+    @classmethod
+    def key(cls, server, scan, resource):
+        return hashlib.md5(json.dumps(
+            [server, scan.uri, resource.file_count,
+             resource.file_size]).encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        rows = self._execute("SELECT header FROM headers WHERE key=?",
+                             (key,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def store(self, key, header):
+        self._execute("INSERT OR REPLACE INTO headers VALUES (?, ?)",
+                      (key, json.dumps(header)))
+
+
+class ConversionCache(object):
+    """
+    An on-disk cache of the outputs of converting resources (e.g. DICOM to
+    NIfTI), keyed by the digests of the files in the resource and the
+    conversion settings (see `key`), so repeated downloads of an unchanged
+    resource can reuse the converted outputs instead of downloading and
+    converting it again. Each entry is a directory containing the outputs,
+    which is moved into place in a single rename so other processes never
+    see partially written entries. Entries that haven't been used for
+    'max_age' days are evicted, followed by the least recently used entries
+    until the cache is within 'max_size'. Errors accessing the cache are
+    logged and otherwise ignored (i.e. the resource is just converted again).
+
+    Parameters
+    ----------
+    path : str
+        Path to the cache directory
+    max_size : int
+        The maximum total size of the cached outputs in bytes
+    max_age : float
+        The number of days after which unused entries are evicted
+    """
+
+    ENTRY_FILE = 'entry.json'
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, path, max_size=DEFAULT_CONVERSION_CACHE_SIZE,
+                 max_age=DEFAULT_CONVERSION_CACHE_AGE):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+
+    @classmethod
+    def default(cls):
+        """
+        Returns the cache stored in the xnatutils cache directory, with the
+        limits set by $XNATUTILS_CONVERSION_CACHE_SIZE and
+        $XNATUTILS_CONVERSION_CACHE_AGE if they are set
+        """
+        with cls._default_lock:
+            path = get_cache_dir('conversions')
+            max_size = parse_size(os.environ.get(
+                CONVERSION_CACHE_SIZE_VAR, DEFAULT_CONVERSION_CACHE_SIZE))
+            max_age = float(os.environ.get(CONVERSION_CACHE_AGE_VAR,
+                                           DEFAULT_CONVERSION_CACHE_AGE))
+            if cls._default is None or cls._default.path != path:
+                cls._default = cls(path)
+            cls._default.max_size = max_size
+            cls._default.max_age = max_age
+            return cls._default
+
+    @classmethod
+    def key(cls, digests, **settings):
+        """
+        Returns the key of a conversion from the digests of the files in the
+        converted resource (keyed by file name) and the conversion settings
+        (e.g. the converter and its version)
+        """
+        return hashlib.md5(json.dumps(
+            [sorted(digests.items()), sorted(settings.items())]).encode(
+                'utf-8')).hexdigest()
+
+    def lookup(self, key, target_dir):
+        """
+        Copies the cached outputs of a conversion into the target directory,
+        returning False if they aren't in the cache
+        """
+        entry_dir = os.path.join(self.path, key)
+        try:
+            outputs_dir = os.path.join(entry_dir, 'outputs')
+            for fname in os.listdir(outputs_dir):
+                src_path = os.path.join(outputs_dir, fname)
+                if os.path.isdir(src_path):
+                    shutil.copytree(src_path, os.path.join(target_dir, fname))
+                else:
+                    shutil.copy2(src_path, target_dir)
+            # Record that the entry has been used
+            os.utime(os.path.join(entry_dir, self.ENTRY_FILE), None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("Could not read conversion cache entry %s "
+                               "(%s)", entry_dir, e)
+            for fname in os.listdir(target_dir):
+                _remove_path(os.path.join(target_dir, fname))
+            return False
+        return True
+
+    def store(self, key, src_dir, **settings):
+        """
+        Copies the outputs of a conversion in the source directory into the
+        cache and evicts entries if the cache has grown beyond its limits
+        """
+        entry_dir = os.path.join(self.path, key)
+        if os.path.exists(entry_dir):
+            return
+        tmp_dir = tempfile.mkdtemp(prefix='.' + key + '.', dir=self.path)
+        try:
+            shutil.copytree(src_dir, os.path.join(tmp_dir, 'outputs'))
+            size = sum(os.path.getsize(os.path.join(dpath, f))
+                       for dpath, _, fnames in os.walk(tmp_dir)
+                       for f in fnames)
+            with open(os.path.join(tmp_dir, self.ENTRY_FILE), 'w') as f:
+                json.dump({'size': size, 'settings': settings}, f)
+            os.rename(tmp_dir, entry_dir)
+        except OSError as e:
+            # Another process may have stored the same conversion first
+            if not os.path.exists(entry_dir):
+                logger.warning("Could not store conversion in cache at %s "
+                               "(%s)", self.path, e)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the entries that haven't been used for 'max_age' days, then
+        the least recently used entries until the cache is within 'max_size'
+        """
+        entries = []
+        for key in os.listdir(self.path):
+            entry_path = os.path.join(self.path, key, self.ENTRY_FILE)
+            try:
+                last_used = os.path.getmtime(entry_path)
+                with open(entry_path) as f:
+                    size = json.load(f)['size']
+            except (OSError, IOError, ValueError, KeyError):
+                continue
+            entries.append((last_used, size, key))
+        entries.sort()
+        total_size = sum(e[1] for e in entries)
+        expiry = time.time() - self.max_age * 24 * 60 * 60
+        for last_used, size, key in entries:
+            if last_used >= expiry and total_size <= self.max_size:
+                break
+            # Move the entry aside before deleting it, so concurrent lookups
+            # never read a partially deleted entry
+            evicted_path = os.path.join(self.path, '.evicted.' + key)
+            try:
+                os.rename(os.path.join(self.path, key), evicted_path)
+            except OSError:
+                continue
+            shutil.rmtree(evicted_path, ignore_errors=True)
+            total_size -= size
+            logger.debug("Evicted %s from conversion cache", key)
+
+
+def get_digests(resource):
+    """
+    Downloads the MD5 digests associated with the files in a resource.
+    These are saved with the downloaded files in the cache and used to
+    check if the files have been updated on the server
+    """
+    result = resource.xnat_session.get(resource.uri + '/files')
+    if result.status_code != 200:
+        raise XnatUtilsError(
+            "Could not download metadata for resource {}. Files "
+            "may have been uploaded but cannot check checksums"
+            .format(resource.id))
+    return dict((r['Name'], r['digest'])
+                for r in result.json()['ResultSet']['Result'])
+
+
+def _list_files(resource):
+    """
+    Lists the files in a resource as `ResourceFile` records (in a single
+    streamed request)
+    """
+    listing = []
+    for row in iter_table(resource.xnat_session, resource.uri + '/files'):
+        uri = row.get('URI') or '{}/files/{}'.format(resource.uri,
+                                                     row['Name'])
+        # The path of the file within the resource (i.e. including any
+        # sub-directories)
+        path = unquote(uri.split('/files/', 1)[-1])
+        size = row.get('Size')
+        listing.append(ResourceFile(row['Name'], path, uri,
+                                    row.get('digest') or None,
+                                    int(size) if size else None))
+    return listing
+
+
+class ResourceFile(namedtuple('ResourceFile', ('name', 'path', 'uri',
+                                               'digest', 'size'))):
+    """
+    Record of a file in a resource listed by `_list_files`
+
+    Parameters
+    ----------
+    name : str
+        The name of the file
+    path : str
+        The path of the file within the resource
+    uri : str
+        The URI of the file
+    digest : str | None
+        The MD5 digest of the file stored on the server
+    size : int | None
+        The size of the file in bytes
+    """
+    __slots__ = ()
+
+
+def find_executable(name):
+    """
+    Finds the location of an executable on the system path
+
+    Parameters
+    ----------
+    name : str
+        Name of the executable to search for on the system path
+    """
+    path = None
+    for path_prefix in os.environ['PATH'].split(os.path.pathsep):
+        prov_path = os.path.join(path_prefix, name)
+        if os.path.exists(prov_path):
+            path = prov_path
+    return path
+
+
+def iter_concurrent(func, args_iter, num_workers=1, max_pending=None,
+                    scheduler=None):
+    """
+    Calls a function over an iterable of argument tuples, yielding the
+    results in the order they complete. If the generator is closed before
+    it is exhausted the calls that haven't started yet are cancelled.
+
+    Parameters
+    ----------
+    func : callable
+        The function to call
+    args_iter : iterable(tuple)
+        The positional arguments for each call. Consumed lazily so that
+        results can be yielded before the iterable is exhausted
+    num_workers : int
+        The number of threads to make the calls in. If 1 the calls are made
+        serially in the calling thread
+    max_pending : int | None
+        The maximum number of calls that are submitted but not yet complete,
+        defaults to twice the number of workers
+    scheduler : TransferScheduler | None
+        A scheduler to make the calls through, which retries calls that fail
+        with transient errors and limits the number of calls that run
+        concurrently to fewer than the number of workers if the server is
+        struggling
+    """
+    if scheduler is not None:
+        func = functools.partial(scheduler.run, func)
+    elif _in_transfer() and num_workers > 1:
+        # The calls are made in other threads as part of the same transfer
+        func = functools.partial(_run_in_transfer, func)
+    if num_workers <= 1:
+        for args in args_iter:
+            yield func(*args)
+        return
+    if max_pending is None:
+        max_pending = 2 * num_workers
+    executor = ThreadPoolExecutor(num_workers)
+    pending = set()
+    try:
+        for args in args_iter:
+            pending.add(executor.submit(func, *args))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+class TransferScheduler(object):
+    """
+    Runs transfers (e.g. resource downloads/uploads) made concurrently by a
+    pool of workers, retrying transfers that fail with transient errors
+    (see `is_retryable`) with jittered exponential backoff and adapting the
+    number of transfers that run at once to the load on the server. The limit
+    starts at the size of the pool, is halved when transfers fail or the
+    latency of the server's responses rises well above the lowest latency
+    observed, and is increased by one each time a full limit's worth of
+    transfers succeed (i.e. AIMD). Retry-After headers in responses observed
+    by `attach`-ing the scheduler to a connection pause new transfers until
+    the requested time.
+
+    Parameters
+    ----------
+    max_concurrency : int
+        The maximum number of transfers to run at once (i.e. the number of
+        workers)
+    max_retries : int
+        The number of times to retry a transfer that fails with a transient
+        error
+    base_delay : float
+        The upper bound of the first backoff delay in seconds, which doubles
+        with each retry
+    max_delay : float
+        The maximum backoff delay in seconds
+    latency_factor : float
+        The multiple of the lowest observed (smoothed) response latency that
+        the latency has to rise above to reduce the limit
+    """
+
+    def __init__(self, max_concurrency, max_retries=DEFAULT_MAX_RETRIES,
+                 base_delay=1.0, max_delay=60.0, latency_factor=3.0):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latency_factor = latency_factor
+        self.limit = float(self.max_concurrency)
+        self._active = 0
+        self._latency = None
+        self._baseline = None
+        self._resume_at = 0.0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def concurrency(self):
+        "The number of transfers currently allowed to run at once"
+        return max(1, int(self.limit))
+
+    def run(self, func, *args):
+        """
+        Calls a function that makes a transfer once a slot is available,
+        retrying it if it fails with a transient error. The function should
+        be safe to call again after a failure
+        """
+        attempt = 0
+        while True:
+            self._acquire()
+            try:
+                result = _run_in_transfer(func, *args)
+            except Exception as e:
+                self._release()
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                self._decrease()
+                delay = self.backoff(attempt)
+                attempt += 1
+                logger.warning("Transfer failed (%s), retrying in %.1f s "
+                               "(%s of %s)", e, delay, attempt,
+                               self.max_retries)
+                time.sleep(delay)
+            else:
+                self._release()
+                self._increase()
+                return result
+
+    def backoff(self, attempt):
+        """
+        Returns the delay before a retry, drawn uniformly from zero up to an
+        exponentially increasing bound ("full jitter") so that workers that
+        failed together don't retry together, but at least as long as any
+        Retry-After requested by the server
+        """
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        with self._cond:
+            return max(delay, self._resume_at - time.time())
+
+    def attach(self, connection):
+        "Observes the responses to the requests made over a connection"
+        connection.interface.hooks['response'].append(self.observe_response)
+
+    def detach(self, connection):
+        try:
+            connection.interface.hooks['response'].remove(
+                self.observe_response)
+        except ValueError:
+            pass
+
+    def observe_response(self, response, *args, **kwargs):
+        if response.status_code in RETRY_STATUS_CODES:
+            retry_after = _parse_retry_after(
+                response.headers.get('Retry-After'))
+            if retry_after is not None:
+                with self._cond:
+                    self._resume_at = max(self._resume_at,
+                                          time.time() + retry_after)
+            self._decrease()
+        elif response.elapsed is not None:
+            self._observe_latency(response.elapsed.total_seconds())
+
+    def _observe_latency(self, latency):
+        with self._cond:
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency = 0.8 * self._latency + 0.2 * latency
+            if self._baseline is None or self._latency < self._baseline:
+                self._baseline = self._latency
+            overloaded = (self._latency >
+                          self.latency_factor * max(self._baseline, 0.01))
+        if overloaded:
+            self._decrease()
+
+    def _decrease(self):
+        with self._cond:
+            now = time.time()
+            # Only decrease once per "round trip" so that a burst of failures
+            # from transfers that were started together counts once
+            if now - self._last_decrease < max(self._latency or 0, 1.0):
+                return
+            self._last_decrease = now
+            previous = self.concurrency
+            self.limit = max(1.0, self.limit / 2)
+        if self.concurrency != previous:
+            logger.info("Reduced concurrent transfers to %s",
+                        self.concurrency)
+
+    def _increase(self):
+        with self._cond:
+            self.limit = min(float(self.max_concurrency),
+                             self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                wait = self._resume_at - time.time()
+                if wait <= 0 and self._active < self.concurrency:
+                    break
+                self._cond.wait(wait if wait > 0 else None)
+            self._active += 1
+
+    def _release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+
+class BandwidthLimiter(object):
+    """
+    Limits the combined bandwidth of the transfers made by a command with a
+    token bucket, which is shared by all transfers so each stream gets an
+    even share of the limit. Downloads are limited by `attach`-ing the
+    limiter to a connection, which throttles the reads of the response
+    bodies, and uploads by passing their chunks through `throttle`.
+
+    Parameters
+    ----------
+    rate : float | str
+        The maximum bandwidth in bytes per second (see `parse_bandwidth`)
+    burst : int | None
+        The number of bytes that can be transferred at once after an idle
+        period, defaults to a quarter of a second's worth
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = parse_bandwidth(rate)
+        self.burst = burst if burst is not None else self.rate / 4
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """
+        Takes 'nbytes' tokens from the bucket, sleeping until the bucket has
+        refilled if there weren't enough. The tokens are taken up front (the
+        bucket can go into debt) so concurrent callers queue up behind each
+        other rather than all waking up at once
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= nbytes
+            wait_time = -self._tokens / self.rate
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def throttle(self, chunks):
+        "Passes an iterable of chunks of bytes through the limiter"
+        for chunk in chunks:
+            self.consume(len(chunk))
+            yield chunk
+
+    def attach(self, connection):
+        "Limits the bandwidth of the responses received over a connection"
+        connection.interface.hooks['response'].append(self.limit_response)
+
+    def detach(self, connection):
+        try:
+            connection.interface.hooks['response'].remove(
+                self.limit_response)
+        except ValueError:
+            pass
+
+    def limit_response(self, response, *args, **kwargs):
+        if response.raw is not None:
+            response.raw = _ThrottledStream(response.raw, self)
+        return response
+
+
+class _ThrottledStream(object):
+    """
+    Wraps the raw stream of a response so that reads from it (via `read` or
+    `stream`, which `iter_content` uses) are throttled by a limiter. All
+    other attributes are passed through to the wrapped stream
+    """
+
+    def __init__(self, raw, limiter):
+        object.__setattr__(self, '_raw', raw)
+        object.__setattr__(self, '_limiter', limiter)
+
+    def read(self, *args, **kwargs):
+        chunk = self._raw.read(*args, **kwargs)
+        self._limiter.consume(len(chunk))
+        return chunk
+
+    def stream(self, *args, **kwargs):
+        return self._limiter.throttle(self._raw.stream(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+
+def _parse_retry_after(value):
+    """
+    Parses a Retry-After header (either a number of seconds or an HTTP date)
+    into a number of seconds
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_tz(value)
+        return max(0.0, email.utils.mktime_tz(retry_at) - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+class WrappedXnatSession(object):
+    """
+    Wraps a XnatPy session in a way that it can be used in a 'with'
+    context and not disconnect upon exit of the context
+
+    Parameters
+    ----------
+    xnat_session : xnat.Session
+        The XnatPy session to wrap
+    """
+
+    def __init__(self, xnat_session):
+        self._session = xnat_session
+
+    def __enter__(self):
+        return self._session
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
+
+class FileLock(object):
+    """
+    An exclusive lock held on a file between processes (e.g. separate
+    xnat-get commands downloading to the same directory). The lock file is
+    removed when the lock is released.
+
+    Parameters
+    ----------
+    path : str
+        Path of the lock file
+    timeout : float | None
+        The time to wait for the lock in seconds before raising an error. If
+        None waits indefinitely
+    poll_interval : float
+        The time between attempts to acquire the lock
+
+    Attributes
+    ----------
+    waited : bool
+        Whether the lock was held by another process when it was acquired,
+        in which case the locked resource may have been updated by that
+        process
+    """
+
+    def __init__(self, path, timeout=None, poll_interval=0.5):
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.waited = False
+        self._fd = None
+
+    def acquire(self):
+        start = time.time()
+        self.waited = False
+        while not self._try_acquire():
+            if not self.waited:
+                logger.info("Waiting for lock on %s held by another process",
+                            self.path)
+                self.waited = True
+            if (self.timeout is not None and
+                    time.time() - start > self.timeout):
+                raise XnatUtilsError(
+                    "Timed out after {}s waiting for lock on {}".format(
+                        self.timeout, self.path))
+            time.sleep(self.poll_interval)
+        return self
+
+    def release(self):
+        if self._fd is None:
+            return
+        # The lock file is removed while still locked so that waiting
+        # processes that have opened it can tell it is stale
+        remove_ignore_errors(self.path)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def _try_acquire(self):
+        if fcntl is None:
+            # Fall back to exclusive creation of the lock file
+            try:
+                self._fd = os.open(self.path,
+                                   os.O_CREAT | os.O_EXCL | os.O_RDWR)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                return False
+            return True
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        # Check that the lock file wasn't removed by the previous holder
+        # between it being opened and locked
+        try:
+            current = os.stat(self.path).st_ino
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            current = None
+        if current != os.fstat(fd).st_ino:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def remove_ignore_errors(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
             raise
 
 
@@ -567,7 +2551,8 @@ def add_default_args(parser):
     parser.add_argument('--no_netrc', '-n', action='store_true',
                         default=False,
                         help=("Don't use or store user access tokens in "
-                              "~/.netrc. Useful if using a public account"))
+                              "~/.netrc or cache authenticated sessions. "
+                              "Useful if using a public account"))
 
 
 def set_logger(level=logging.INFO):
@@ -0,0 +1,367 @@
+import sys
+import hashlib
+import logging
+import threading
+from collections import defaultdict
+from xnat.exceptions import XNATResponseError
+from .base import (
+    connect, matching_sessions, base_parser, add_default_args,
+    print_response_error, print_usage_error, print_info_message, set_logger,
+    iter_concurrent, iter_subjects, TransferScheduler, DEFAULT_CRAWL_WORKERS,
+    DEFAULT_MAX_RETRIES, _list_files, raw_request)
+from .get_ import _iter_resources
+from .put_ import _upload, StreamSource
+from .exceptions import (
+    XnatUtilsUsageError, XnatUtilsException, XnatUtilsDigestCheckError)
+
+logger = logging.getLogger('xnat-utils')
+
+
+def copy(session, dest_server, scans=None, resource_name=None,
+         with_scans=None, without_scans=None, before=None, after=None,
+         project_id=None, subject_id=None, match_scan_id=True,
+         dest_project_id=None, dest_user=None, dest_connection=None,
+         overwrite=False, num_workers=1,
+         crawl_workers=DEFAULT_CRAWL_WORKERS, max_retries=DEFAULT_MAX_RETRIES,
+         **kwargs):
+    """
+    Copies datasets (e.g. scans) from one XNAT instance to another, streaming
+    each file from the source server straight into the destination server
+    without writing it to local disk. Subjects and sessions are created on
+    the destination server if they don't already exist (as per `put` with
+    'create_session'). Only the resources of the scans are copied, i.e.
+    session-level resources are skipped, e.g.
+
+        >>> xnatutils.copy('MRH017_.*', 'https://xnat.other.org',
+                           scans='t1_mprage.*', num_workers=4)
+
+    The digest of each file is calculated as it is streamed and checked
+    against the digests stored on both the source and the destination
+    server.
+
+    Parameters
+    ----------
+    session : str | list(str)
+        Name or regular expression of the session(s) to copy (see `get`)
+    dest_server : str | int
+        URI of the XNAT server to copy the datasets to (or the index of a
+        server saved in the ~/.netrc file)
+    scans : str | list(str)
+        Name or regular expression of the scans to copy. If not provided all
+        scans in the matched sessions are copied
+    resource_name : str
+        The name of the resource to copy. If not provided all resources of
+        the matched scans are copied
+    with_scans : list(str)
+        Only copy from sessions containing the specified scans
+    without_scans : list(str)
+        Only copy from sessions that don't contain the specified scans
+    before : str
+        Only select sessions before this date in %Y-%m-%d format
+        (e.g. 2017-09-29)
+    after : str
+        Only select sessions after this date in %Y-%m-%d format
+        (e.g. 2017-09-29)
+    project_id : str | None
+        The ID of the project to list the sessions from
+    subject_id : str | None
+        The ID of the subject to list the sessions from
+    match_scan_id : bool
+        Whether to match scan IDs as well as types
+    dest_project_id : str | None
+        The ID of the project to create sessions in on the destination
+        server. Defaults to the project of each session on the source server
+    dest_user : str
+        The user to connect to the destination server with
+    dest_connection : xnat.Session
+        An existing XnatPy session with the destination server to reuse
+    overwrite : bool
+        Whether to overwrite resources that already exist on the destination
+        server
+    num_workers : int
+        The number of resources to copy concurrently
+    crawl_workers : int
+        The number of sessions to retrieve the metadata of concurrently
+    max_retries : int
+        The number of times to retry requests and resource copies that fail
+        with a transient error on either server. The number of concurrent
+        copies is also reduced below 'num_workers' while either server is
+        struggling (see `TransferScheduler`)
+    user : str
+        The user to connect to the source server with
+    loglevel : str
+        The logging level to display. In order of increasing verbosity
+        ERROR, WARNING, INFO, DEBUG.
+    connection : xnat.Session
+        An existing XnatPy session with the source server to reuse
+    server : str | int | None
+        URI of the XNAT server to copy the datasets from
+    use_netrc : bool
+        Whether to load and save user credentials from netrc file
+        located at $HOME/.netrc
+
+    Returns
+    -------
+    copied : dict(str, list(str))
+        The URIs of the resources created on the destination server, keyed
+        by session label
+    """
+    if isinstance(scans, str):
+        scans = [scans]
+    dest_kwargs = dict(server=dest_server, user=dest_user,
+                       connection=dest_connection,
+                       loglevel=kwargs.get('loglevel', 'ERROR'),
+                       use_netrc=kwargs.get('use_netrc', True),
+                       cache_session=kwargs.get('cache_session', False),
+                       max_retries=max_retries)
+    creation_lock = threading.Lock()
+    dest_sessions = {}
+    subject_labels = {}
+    copied = defaultdict(list)
+    # The source URIs of the resources that copies have been attempted of
+    attempted = set()
+    scheduler = TransferScheduler(num_workers, max_retries=max_retries)
+    with connect(max_retries=max_retries, **kwargs) as login, \
+            connect(**dest_kwargs) as dest_login:
+        matched_sessions = matching_sessions(
+            login, session, with_scans=with_scans,
+            without_scans=without_scans, project_id=project_id,
+            subject_id=subject_id, before=before, after=after,
+            crawl_workers=crawl_workers)
+
+        def get_subject_label(xsession):
+            # The labels of all subjects in the project of the session are
+            # listed in a single request the first time one is required
+            with creation_lock:
+                if xsession.subject_id not in subject_labels:
+                    subject_labels.update(
+                        (s.id, s.label)
+                        for s in iter_subjects(login, xsession.project))
+                try:
+                    return subject_labels[xsession.subject_id]
+                except KeyError:
+                    # The subject is shared into the project from another
+                    subject_labels[xsession.subject_id] = label = (
+                        xsession.subject.label)
+                    return label
+
+        def copy_resource(resource, scan, xsession, suffix):
+            files = _list_files(resource)
+            if not files:
+                logger.warning("No files found in %s, skipping",
+                               resource.uri)
+                return xsession.label, None
+            subject_label = get_subject_label(xsession)
+            dest_project = dest_project_id or xsession.project
+            # The streams can't be rewound so they are recreated for each
+            # attempt, which resumes the copy into the resource created by
+            # the failed attempt (unless overwriting)
+            resume = resource.uri in attempted and not overwrite
+            attempted.add(resource.uri)
+            # The digest of each streamed file is checked against the digest
+            # stored on the source server before its upload is completed
+            sources = [
+                StreamSource(f.name, _StreamingRemoteFile(login, f.uri,
+                                                          digest=f.digest))
+                for f in files]
+            try:
+                # The digests on the destination server are checked against
+                # the streamed files by _upload
+                dest_resource = _upload(
+                    dest_login, xsession.label,
+                    (scan.type if scan.type is not None else scan.id),
+                    sources, resource.label, overwrite=overwrite,
+                    create_session=True, project_id=dest_project,
+                    subject_id=subject_label, scan_id=scan.id,
+                    resume=resume, creation_lock=creation_lock,
+                    sessions=dest_sessions)
+            except XnatUtilsDigestCheckError:
+                # Don't leave a corrupt copy for later copies to resume from
+                dest_uri = ('/data/projects/{}/experiments/{}/scans/{}/'
+                            'resources/{}'.format(dest_project, xsession.label,
+                                                  scan.id, resource.label))
+                try:
+                    dest_login.delete(dest_uri)
+                except XNATResponseError as e:
+                    logger.warning("Could not delete corrupt copy at %s "
+                                   "(%s)", dest_uri, e)
+                raise
+            return xsession.label, dest_resource.uri
+
+        tasks = _iter_resources(matched_sessions, scans, resource_name,
+                                match_scan_id, crawl_workers)
+        scheduler.attach(login)
+        scheduler.attach(dest_login)
+        try:
+            for label, uri in iter_concurrent(copy_resource, tasks,
+                                              num_workers=num_workers,
+                                              scheduler=scheduler):
+                if uri is not None:
+                    copied[label].append(uri)
+        finally:
+            scheduler.detach(login)
+            scheduler.detach(dest_login)
+    if not copied:
+        logger.warning(
+            "No resources matched in specified sessions (%s)",
+            "', '".join(s.label for s in matched_sessions))
+    else:
+        logger.info("Successfully copied %s resources from %s session(s)",
+                    sum(len(u) for u in copied.values()), len(copied))
+    return copied
+
+
+class _StreamingRemoteFile(object):
+    """
+    A read-only file-like object that streams a file from an XNAT server.
+    The request is only made when the file is first read, and the MD5 digest
+    of the file is calculated as it is read
+
+    Parameters
+    ----------
+    login : xnat.Session
+        The session with the server to stream the file from
+    uri : str
+        The URI of the file on the server
+    digest : str | None
+        The MD5 digest stored for the file on the server. If provided, an
+        `XnatUtilsDigestCheckError` is raised instead of signalling the end
+        of the file if the digest of the streamed file doesn't match, so a
+        corrupt stream isn't uploaded in full
+    """
+
+    def __init__(self, login, uri, digest=None):
+        self.login = login
+        self.uri = uri
+        self.digest = digest
+        self._response = None
+        self._hash = hashlib.md5()
+
+    def read(self, size=-1):
+        if self._response is None:
+            self._response = raw_request(self.login, self.uri, stream=True)
+            self._response.raw.decode_content = True
+        chunk = self._response.raw.read(size if size >= 0 else None)
+        self._hash.update(chunk)
+        if not chunk:
+            self.close()
+            if self.digest and self.digest != self.hexdigest():
+                raise XnatUtilsDigestCheckError(
+                    "Digest of file streamed from source server does not "
+                    "match the digest stored on it ({} vs {}) for {}".format(
+                        self.hexdigest(), self.digest, self.uri))
+        return chunk
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+description = """
+Copies datasets (e.g. scans) from one XNAT instance to another, streaming the
+files straight from the source server into the destination server without
+writing them to local disk, e.g.
+
+    $ xnat-copy MRH017_.* --dest_server https://xnat.other.org --scans t1.*
+
+Sessions are selected as per 'xnat-get' and are created (along with their
+subjects) on the destination server if they don't already exist. Only the
+resources of the scans are copied (session-level resources are skipped). Each
+file is checked against the digests stored on both servers.
+
+User credentials for both servers can be stored in the ~/.netrc file.
+"""
+
+
+def parser():
+    parser = base_parser(description)
+    parser.add_argument('session', type=str, nargs='+',
+                        help=("Name or regular expression of the session(s) "
+                              "to copy"))
+    parser.add_argument('--dest_server', '-S', type=str, required=True,
+                        help=("URI of the XNAT server to copy the datasets "
+                              "to"))
+    parser.add_argument('--dest_user', type=str, default=None,
+                        help=("The user to connect to the destination server "
+                              "with"))
+    parser.add_argument('--dest_project', type=str, default=None,
+                        help=("The ID of the project to create sessions in "
+                              "on the destination server (defaults to the "
+                              "source project)"))
+    parser.add_argument('--scans', '-x', type=str, default=None, nargs='+',
+                        help=("Name of the scans to copy. If not provided "
+                              "all scans from the session are copied"))
+    parser.add_argument('--resource', '-r', type=str, default=None,
+                        help=("The name of the resource to copy. If not "
+                              "provided all resources are copied"))
+    parser.add_argument('--with_scans', '-w', type=str, default=None,
+                        nargs='+',
+                        help=("Only copy from sessions containing the "
+                              "specified scans"))
+    parser.add_argument('--without_scans', '-o', type=str, default=None,
+                        nargs='+',
+                        help=("Only copy from sessions that don't contain "
+                              "the specified scans"))
+    parser.add_argument('--before', '-b', default=None, type=str,
+                        help=("Only select sessions before this date "
+                              "(in Y-m-d format, e.g. 2018-02-27)"))
+    parser.add_argument('--after', '-a', default=None, type=str,
+                        help=("Only select sessions after this date "
+                              "(in Y-m-d format, e.g. 2018-02-27)"))
+    parser.add_argument('--project', '-p', type=str, default=None,
+                        help=("The ID of the project to list the sessions "
+                              "from."))
+    parser.add_argument('--subject', '-j', type=str, default=None,
+                        help=("The ID of the subject to list the sessions "
+                              "from. Requires '--project' to be also "
+                              "provided"))
+    parser.add_argument('--dont_match_scan_id', action='store_true',
+                        default=False, help=(
+                            "To disable matching on scan ID if the scan "
+                            "type is None"))
+    parser.add_argument('--overwrite', action='store_true', default=False,
+                        help=("Overwrite resources that already exist on "
+                              "the destination server"))
+    parser.add_argument('--num_workers', '-W', type=int, default=1,
+                        help="The number of resources to copy concurrently")
+    parser.add_argument('--crawl_workers', type=int,
+                        default=DEFAULT_CRAWL_WORKERS,
+                        help=("The number of sessions to retrieve the "
+                              "metadata of concurrently"))
+    parser.add_argument('--max_retries', type=int,
+                        default=DEFAULT_MAX_RETRIES,
+                        help=("The number of times to retry requests and "
+                              "copies that fail with a transient error "
+                              "(e.g. 503 while a server is under load)"))
+    add_default_args(parser)
+    return parser
+
+
+def cmd(argv=sys.argv[1:]):
+
+    args = parser().parse_args(argv)
+
+    set_logger(args.loglevel)
+
+    try:
+        copy(args.session, args.dest_server, scans=args.scans,
+             resource_name=args.resource, with_scans=args.with_scans,
+             without_scans=args.without_scans, before=args.before,
+             after=args.after, project_id=args.project,
+             subject_id=args.subject,
+             match_scan_id=(not args.dont_match_scan_id),
+             dest_project_id=args.dest_project, dest_user=args.dest_user,
+             overwrite=args.overwrite, num_workers=args.num_workers,
+             crawl_workers=args.crawl_workers,
+             max_retries=args.max_retries, user=args.user,
+             server=args.server, use_netrc=(not args.no_netrc),
+             cache_session=(not args.no_netrc))
+    except XnatUtilsUsageError as e:
+        print_usage_error(e)
+    except XNATResponseError as e:
+        print_response_error(e)
+    except XnatUtilsException as e:
+        print_info_message(e)
@@ -1,24 +1,40 @@
+from past.builtins import basestring
 import sys
+import io
 import os.path
-from collections import defaultdict
+import json
+from collections import defaultdict, namedtuple, OrderedDict
 import subprocess as sp
 from glob import glob
+import functools
 from functools import reduce
+from fnmatch import fnmatch
+from urllib.parse import quote
 from operator import add
 import errno
 import re
 import logging
 import shutil
+import time
+import tempfile
+from datetime import datetime
 from xml.etree import ElementTree
 from xnat.exceptions import XNATResponseError
 from .base import (
     sanitize_re, skip_resources, resource_exts, find_executable, is_regex,
     base_parser, add_default_args, print_response_error, print_usage_error,
     print_info_message, set_logger, matching_sessions, matching_scans,
-    connect)
+    parse_dicom_filters, connect, parse_shard, in_shard, FileLock,
+    iter_concurrent, interleave, fetch_session_tree, _remove_path,
+    calculate_checksums, get_digests, TransferScheduler, BandwidthLimiter,
+    ConversionCache, NO_CONVERSION_CACHE_VAR, DEFAULT_CRAWL_WORKERS,
+    DEFAULT_MAX_RETRIES, _list_files, response_status, SessionRecord,
+    raw_request, _parse_date)
 from .exceptions import (
-    XnatUtilsUsageError, XnatUtilsMissingResourceException,
-    XnatUtilsSkippedAllSessionsException, XnatUtilsException)
+    XnatUtilsUsageError, XnatUtilsKeyError, XnatUtilsMissingResourceException,
+    XnatUtilsSkippedAllSessionsException, XnatUtilsException,
+    XnatUtilsDigestCheckError, XnatUtilsNoMatchingSessionsException,
+    XnatUtilsError, XnatUtilsLookupError)
 
 
 
@@ -26,14 +42,36 @@ logger = logging.getLogger('xnat-utils')
 
 
 conv_choices = ['nifti', 'nifti_gz', 'mrtrix', 'mrtrix_gz']
+
+# The kwargs of `watch` that are passed to `connect` rather than `iter_get`
+connect_kwargs = ('user', 'password', 'loglevel', 'connection', 'server',
+                  'use_netrc', 'cache_session')
 converter_choices = ('dcm2niix', 'mrconvert')
 
+version_re = re.compile(r'v?\d+\.\d+[\w.\-]*')
+
+# The number of files downloaded concurrently from each resource when only
+# some of its files are selected (see the 'files' and 'sample' kwargs of
+# `get`)
+FILE_DOWNLOAD_WORKERS = 4
+
+# The size of the blocks read from the server by `RemoteFile` with each Range
+# request, the number of blocks it keeps in memory, and the maximum total size
+# of the files read into memory by `read_resource_bytes`
+REMOTE_BLOCK_SIZE = 2 ** 18
+REMOTE_CACHE_BLOCKS = 32
+MAX_RESOURCE_BYTES = 2 ** 26
+
 
 def get(session, download_dir, scans=None, resource_name=None,
         convert_to=None, converter=None, subject_dirs=False,
         with_scans=None, without_scans=None, strip_name=False,
         skip_downloaded=False, before=None, after=None,
-        project_id=None, subject_id=None, match_scan_id=True, **kwargs):
+        project_id=None, subject_id=None, match_scan_id=True, shard=None,
+        manifest=None, num_workers=1, check_digests=True, callback=None,
+        crawl_workers=DEFAULT_CRAWL_WORKERS, max_retries=DEFAULT_MAX_RETRIES,
+        max_bandwidth=None, cache_conversions=True, files=None, sample=None,
+        dicom_filters=None, **kwargs):
     """
     Downloads datasets (e.g. scans) from XNAT.
 
@@ -66,6 +104,16 @@ def get(session, download_dir, scans=None, resource_name=None,
         >>> xnatutils.get('TEST001_001_MR01', '/home/tclose/Downloads',
                           scans='ep2d_diff.*', convert_to='nifti_gz')
 
+    The matched sessions can be split between multiple processes (e.g. the
+    tasks of a SLURM array job) by providing the 'shard' kwarg, where each
+    session is assigned to one of N shards by a hash of its label, e.g.
+
+        >>> xnatutils.get('MRH017_.*', '/scratch/MRH017', shard='3/10',
+                          manifest='/scratch/MRH017-3.json')
+
+    The manifests saved by each shard can be combined with
+    `xnatutils.merge_manifests` (or the 'xnat-merge-manifests' command).
+
     User credentials can be stored in a ~/.netrc file so that they don't need
     to be entered each time a command is run. If a new user provided or netrc
     doesn't exist the tool will ask whether to create a ~/.netrc file with the
@@ -73,8 +121,9 @@ def get(session, download_dir, scans=None, resource_name=None,
 
     Parameters
     ----------
-    session : str | list(str)
-        Name of the sessions to download the dataset from
+    session : str | list(str) | list(SessionRecord)
+        Name of the sessions to download the dataset from (or the records
+        of sessions that have already been listed)
     download_dir : str
         Path to download the scans to. If not provided the current working
         directory will be used
@@ -127,6 +176,61 @@ def get(session, download_dir, scans=None, resource_name=None,
     match_scan_id : bool
         Whether to use the scan ID to match scans with if the scan type
         is None
+    shard : str | tuple(int, int) | None
+        Only download the subset of matched sessions assigned to this shard,
+        specified as 'i/N' where 0 <= i < N. Sessions are assigned to shards
+        by a stable hash of their label so N processes given the same
+        arguments will download disjoint subsets of the matched sessions
+    manifest : str | None
+        Path to save a JSON manifest of the matched sessions and downloaded
+        resources to
+    num_workers : int
+        The number of resources to download concurrently
+    check_digests : bool
+        Whether to check the downloaded files against the MD5 digests stored
+        on the server
+    callback : callable | None
+        A function called with a `DownloadedResource` record as each
+        resource is downloaded (see also `iter_get`)
+    crawl_workers : int
+        The number of sessions to retrieve the scan and resource listings of
+        concurrently
+    max_retries : int
+        The number of times to retry requests and downloads that fail with a
+        transient error (e.g. a 502/503 status while the server is under
+        load). The number of concurrent downloads is also reduced below
+        'num_workers' while the server is struggling (see
+        `TransferScheduler`)
+    max_bandwidth : str | float | None
+        The maximum combined bandwidth of the downloads in bytes per second,
+        optionally with a 'K', 'M' or 'G' suffix (e.g. '50M'), which is
+        shared evenly between the concurrent downloads
+    cache_conversions : bool
+        Whether to cache the outputs of conversions (see 'convert_to') keyed
+        by the digests of the converted files and the conversion settings
+        (including the converter version), so converting an unchanged
+        resource again reuses the cached outputs without downloading it.
+        The cache is stored in ~/.xnatutils/conversions and limited to 20GB
+        of entries used within the last 30 days (see `ConversionCache`). It
+        can also be disabled by setting $XNATUTILS_NO_CONVERSION_CACHE
+    files : str | list(str) | None
+        Glob pattern(s) (e.g. '*.json') matched against the paths of the
+        files within each resource. If provided, the files in the resource
+        are listed and only the matching files are downloaded (concurrently)
+        instead of the whole resource
+    sample : int | None
+        Only download this number of evenly spaced files from each resource
+        (after any 'files' filter), e.g. 1 to download just the middle slice
+        of a DICOM series for QC. DICOM files are ordered by their instance
+        number
+    dicom_filters : dict(str, str) | list(str) | None
+        Regexes with which to match fields of the DICOM headers of the scans
+        in addition to their types, keyed by the DICOM keyword or tag of the
+        field or given as 'field=regex' strings, e.g.
+        ['SeriesDescription=.*MPRAGE.*', 'ImageType=ORIGINAL.*']. The
+        headers are retrieved from the server's DICOM dump service (and
+        cached in ~/.xnatutils/dicom_headers.sqlite), so only the scans that
+        match are downloaded
     user : str
         The user to connect to the server with
     loglevel : str
@@ -148,9 +252,69 @@ def get(session, download_dir, scans=None, resource_name=None,
         Whether to load and save user credentials from netrc file
         located at $HOME/.netrc
     """
+    downloaded_resources = defaultdict(list)
+    for record in iter_get(
+            session, download_dir, scans=scans, resource_name=resource_name,
+            convert_to=convert_to, converter=converter,
+            subject_dirs=subject_dirs, with_scans=with_scans,
+            without_scans=without_scans, strip_name=strip_name,
+            skip_downloaded=skip_downloaded, before=before, after=after,
+            project_id=project_id, subject_id=subject_id,
+            match_scan_id=match_scan_id, shard=shard, manifest=manifest,
+            num_workers=num_workers, check_digests=check_digests,
+            crawl_workers=crawl_workers, max_retries=max_retries,
+            max_bandwidth=max_bandwidth, cache_conversions=cache_conversions,
+            files=files, sample=sample, dicom_filters=dicom_filters,
+            **kwargs):
+        downloaded_resources[record.session].append(record.uri)
+        if callback is not None:
+            callback(record)
+    return downloaded_resources
+
+
+def iter_get(session, download_dir, scans=None, resource_name=None,
+             convert_to=None, converter=None, subject_dirs=False,
+             with_scans=None, without_scans=None, strip_name=False,
+             skip_downloaded=False, before=None, after=None,
+             project_id=None, subject_id=None, match_scan_id=True,
+             shard=None, manifest=None, num_workers=1, check_digests=True,
+             crawl_workers=DEFAULT_CRAWL_WORKERS,
+             max_retries=DEFAULT_MAX_RETRIES, max_bandwidth=None,
+             cache_conversions=True, files=None, sample=None,
+             dicom_filters=None, **kwargs):
+    """
+    Downloads datasets (e.g. scans) from XNAT in the same way as `get`, but
+    yields a `DownloadedResource` record for each resource as soon as it has
+    been downloaded, so processing can start before the remaining resources
+    have been downloaded, e.g.
+
+        >>> for record in xnatutils.iter_get('MRH017_.*', '/scratch',
+                                             num_workers=4):
+        ...     process(record.path)
+
+    When downloading with multiple workers the records are yielded in the
+    order the downloads complete. Closing the generator (e.g. breaking out
+    of the loop) cancels the downloads that haven't started yet and waits
+    for those in progress to finish. If a manifest is requested it is only
+    saved once all downloads have completed.
+
+    Takes the same parameters as `get`.
+    """
     # Convert scan string to list of scan strings if only one provided
     if isinstance(scans, str):
         scans = [scans]
+    if isinstance(files, str):
+        files = [files]
+    if sample is not None and sample < 1:
+        raise XnatUtilsUsageError(
+            "Number of files to sample must be at least 1 ({})"
+            .format(sample))
+    if dicom_filters:
+        # Check the filters are valid before connecting
+        parse_dicom_filters(dicom_filters)
+    shard = parse_shard(shard)
+    limiter = (BandwidthLimiter(max_bandwidth)
+               if max_bandwidth is not None else None)
     if skip_downloaded:
         skip = [d for d in os.listdir(download_dir)
                 if os.path.isdir(os.path.join(download_dir, d))]
@@ -158,54 +322,49 @@ def get(session, download_dir, scans=None, resource_name=None,
         skip = []
     # Quickly skip session if not using regex (and therefore don't need to
     # connect to XNAT
-    if session and all((not is_regex(s) and s in skip) for s in session):
+    labels = [getattr(s, 'label', s) for s in session] if session else []
+    if labels and all((not is_regex(s) and s in skip) for s in labels):
         raise XnatUtilsSkippedAllSessionsException(
             "{} sessions are already present in the download location and "
             "--skip_downloaded was provided".format(session))
-    with connect(**kwargs) as login:
+    with connect(max_retries=max_retries, **kwargs) as login:
         matched_sessions = matching_sessions(
             login, session, with_scans=with_scans,
             without_scans=without_scans, project_id=project_id,
-            subject_id=subject_id, skip=skip, before=before, after=after)
+            subject_id=subject_id, skip=skip, before=before, after=after,
+            crawl_workers=crawl_workers)
+        if shard is not None:
+            matched_sessions = [s for s in matched_sessions
+                                if in_shard(s.label, shard)]
+            logger.info("%s sessions assigned to shard %s/%s",
+                        len(matched_sessions), *shard)
         downloaded_resources = defaultdict(list)
-        for session in matched_sessions:
-            for scan in matching_scans(session, scans,
-                                       match_id=match_scan_id):
-                resources = []
-                suffix = False
-                if resource_name is not None:
-                    try:
-                        resource = scan.resources[resource_name]
-                    except KeyError:
-                        try:
-                            resource = scan.resources[resource_name.upper()]
-                        except KeyError:
-                            logger.warning(
-                                ("Did not find '%s' resource for %s:%s, "
-                                 "skipping"),
-                                resource_name, session.label, scan_label)
-                            continue
-                    resources.append(resource)
-                else:
-                    resource_names = [
-                        r.label for r in scan.resources.values()
-                        if r.label not in skip_resources]
-                    if not resource_names:
-                        logger.warning(
-                            ("No valid scan formats for '%s-%s' in '%s' "
-                             "(found '%s')"),
-                            scan.id, scan.type, session,
-                            "', '".join(scan.resources))
-                        continue
-                    if len(resource_names) > 1:
-                        suffix = True
-                    for resource_name in resource_names:
-                        resources.append(scan.resources[resource_name])
-                for resource in resources:
-                    _download_resource(
-                        resource, scan, session, download_dir, subject_dirs,
-                        convert_to, converter, strip_name, suffix=suffix)
-                    downloaded_resources[session.label].append(resource.uri)
+
+        def download(resource, scan, session, suffix):
+            return _download_resource(
+                resource, scan, session, download_dir, subject_dirs,
+                convert_to, converter, strip_name, suffix=suffix,
+                check_digests=check_digests,
+                cache_conversions=cache_conversions, files=files,
+                sample=sample)
+
+        tasks = _iter_resources(matched_sessions, scans, resource_name,
+                                match_scan_id, crawl_workers,
+                                dicom_filters=dicom_filters)
+        scheduler = TransferScheduler(num_workers, max_retries=max_retries)
+        scheduler.attach(login)
+        if limiter is not None:
+            limiter.attach(login)
+        try:
+            for record in iter_concurrent(download, tasks,
+                                          num_workers=num_workers,
+                                          scheduler=scheduler):
+                downloaded_resources[record.session].append(record.uri)
+                yield record
+        finally:
+            scheduler.detach(login)
+            if limiter is not None:
+                limiter.detach(login)
     if not downloaded_resources:
         logger.warning(
             ("No scans matched pattern(s) '%s' in specified "
@@ -217,7 +376,293 @@ def get(session, download_dir, scans=None, resource_name=None,
                                map(len, downloaded_resources.values()))
         logger.info("Successfully downloaded %s scans from %s session(s)",
                     num_resources, len(matched_sessions))
-    return downloaded_resources
+    if manifest is not None:
+        write_manifest(manifest, downloaded_resources,
+                       [s.label for s in matched_sessions], shard=shard)
+
+
+def watch(session, download_dir, interval=60, since=None, max_polls=None,
+          project_id=None, callback=None, settle=None, **kwargs):
+    """
+    Watches for sessions that are newly archived on XNAT and downloads them
+    as they appear, yielding a `DownloadedResource` record for each
+    downloaded resource (as per `iter_get`), e.g.
+
+        >>> for record in xnatutils.watch('.*', '/scratch', interval=60,
+                                          project_id='MRH017'):
+        ...     process(record.path)
+
+    Every 'interval' seconds the insert dates of the sessions (in the project
+    if 'project_id' is provided) are listed in a single request, and the
+    sessions inserted since the last poll that match the 'session'
+    pattern(s) are passed to `iter_get` over the same connection. Sessions
+    that have been modified within the last 'settle' seconds (e.g. because
+    their scans are still being archived) are left until a later poll, as
+    are sessions that fail to download, so the watermark only advances past
+    sessions that have been downloaded (or skipped on purpose). The number
+    of new sessions waiting to be downloaded (the queue depth) and the lag
+    between each session's insert date and the start of its download are
+    logged.
+
+    Parameters
+    ----------
+    session : str | list(str)
+        Name or regular expression of the sessions to download. If empty
+        all new sessions (in the project) are downloaded
+    download_dir : str
+        Path to download the sessions to
+    interval : float
+        The number of seconds between polls
+    since : str | None
+        Download sessions inserted after this time (in '%Y-%m-%d %H:%M:%S'
+        format). If None, only sessions inserted after the first poll are
+        downloaded
+    max_polls : int | None
+        The number of times to poll before returning. If None, polls until
+        interrupted
+    project_id : str | None
+        The ID of the project to watch
+    callback : callable | None
+        A function called with each `DownloadedResource` record
+    settle : float | None
+        The number of seconds a session must have gone unmodified before it
+        is downloaded. Defaults to 'interval'
+
+    Other kwargs are passed to `iter_get` (with the exception of 'manifest')
+    and `connect`
+    """
+    if kwargs.get('manifest') is not None:
+        raise XnatUtilsUsageError(
+            "'manifest' cannot be used when watching for new sessions")
+    if isinstance(session, str):
+        session = [session]
+    if settle is None:
+        settle = interval
+    conn_kwargs = dict((k, kwargs.pop(k)) for k in connect_kwargs
+                       if k in kwargs)
+    watermark = since
+    # The IDs of the sessions inserted at or after the watermark that have
+    # already been downloaded (or skipped)
+    handled = set()
+    started = False
+    num_polls = 0
+    with connect(max_retries=kwargs.get('max_retries', DEFAULT_MAX_RETRIES),
+                 **conn_kwargs) as login:
+        while True:
+            poll_start = time.time()
+            try:
+                inserted = _list_inserted(login, project_id)
+                # Clear the cached listings so the new sessions are visible
+                login.clearcache()
+            except Exception as e:
+                logger.error("Could not list the sessions on the server (%s), "
+                             "will retry at the next poll", e)
+                inserted = None
+            if inserted is not None:
+                if watermark is None:
+                    watermark = max([r[1] for r in inserted] or [''])
+                if not started:
+                    handled = set(r[0].id for r in inserted
+                                  if r[1] == watermark)
+                    logger.info("Watching for sessions inserted after %s",
+                                watermark)
+                    started = True
+                new = sorted((r for r in inserted
+                              if r[1] >= watermark and r[0].id not in handled),
+                             key=lambda r: r[1])
+                queue = []
+                for record, inserted_date, modified in new:
+                    if session and not any(re.match(p + '$', record.label)
+                                           for p in session):
+                        handled.add(record.id)
+                        continue
+                    modified_lag = _lag(modified)
+                    if modified_lag is not None and modified_lag < settle:
+                        logger.info("Waiting for %s to settle before "
+                                    "downloading it (modified %.0fs ago)",
+                                    record.label, modified_lag)
+                        continue
+                    queue.append((record, inserted_date))
+                logger.info("Found %s new session(s) to download",
+                            len(queue))
+                for pos, (record, inserted_date) in enumerate(queue):
+                    lag = _lag(inserted_date)
+                    logger.info("Downloading %s (queue depth %s, lag %s)",
+                                record.label, len(queue) - pos - 1,
+                                ('{:.0f}s'.format(lag) if lag is not None
+                                 else 'unknown'))
+                    try:
+                        # The session is passed as the record that has
+                        # already been listed so it isn't looked up again
+                        for downloaded in iter_get(
+                                [record], download_dir, project_id=project_id,
+                                connection=login, **kwargs):
+                            if callback is not None:
+                                callback(downloaded)
+                            yield downloaded
+                    except (XnatUtilsNoMatchingSessionsException,
+                            XnatUtilsSkippedAllSessionsException) as e:
+                        logger.info("Skipping %s (%s)", record.label, e)
+                    except (XnatUtilsException, XNATResponseError) as e:
+                        logger.error("Could not download %s (%s), will retry "
+                                     "at the next poll", record.label, e)
+                        continue
+                    handled.add(record.id)
+                # Advance the watermark up to the first session that still
+                # needs to be downloaded, forgetting the sessions inserted
+                # before it
+                pending = [r[1] for r in new if r[0].id not in handled]
+                if pending:
+                    watermark = min(pending)
+                elif new:
+                    watermark = new[-1][1]
+                handled = set(r[0].id for r in inserted
+                              if r[1] >= watermark and r[0].id in handled)
+            num_polls += 1
+            if max_polls is not None and num_polls >= max_polls:
+                return
+            time.sleep(max(0, interval - (time.time() - poll_start)))
+
+
+def _list_inserted(login, project_id=None):
+    """
+    Lists the sessions on the server (or in a project) in a single request,
+    returning the `SessionRecord`, insert date and last modified date of
+    each
+    """
+    if project_id is not None:
+        path = '/data/projects/{}/experiments'.format(project_id)
+    else:
+        path = '/data/experiments'
+    result = login.get_json(path, query={
+        'columns': ('ID,label,project,subject_ID,date,insert_date,'
+                    'last_modified'),
+        'format': 'json'})
+    return [(SessionRecord(r['ID'], r['label'], r.get('project'),
+                           r.get('subject_ID'), _parse_date(r.get('date')),
+                           '/data/experiments/' + r['ID'], None, None, login),
+             r.get('insert_date') or '', r.get('last_modified') or '')
+            for r in result['ResultSet']['Result']]
+
+
+def _lag(inserted_date):
+    """
+    Returns the number of seconds since a session was inserted (or modified),
+    assuming the server is in the same timezone, or None if the date can't
+    be parsed
+    """
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            inserted = datetime.strptime(inserted_date, fmt)
+        except ValueError:
+            continue
+        return (datetime.now() - inserted).total_seconds()
+    return None
+
+
+def _iter_resources(sessions, scans, resource_name, match_scan_id,
+                    crawl_workers, dicom_filters=None):
+    """
+    Iterates over the resources to download from the matched sessions,
+    yielding (resource, scan, session, suffix) tuples. The scan and resource
+    listings of each session are retrieved in a single request (see
+    `fetch_session_tree`) for many sessions concurrently, and the resources
+    of each session are yielded as soon as its listings are available. The
+    resources, scans and sessions are yielded as lightweight records rather
+    than XnatPy objects. The resources of the sessions are interleaved (see
+    `interleave`) so that small sessions aren't held up behind large ones.
+    If DICOM filters are provided the headers of the scans are retrieved as
+    part of the crawl, with the crawl workers shared between the sessions
+    being crawled so the number of concurrent requests isn't multiplied
+    """
+    sessions = list(sessions)
+    header_workers = max(1, crawl_workers // max(1, len(sessions)))
+
+    def crawl(session):
+        tree = fetch_session_tree(session)
+        return tree, matching_scans(tree, scans, match_id=match_scan_id,
+                                    dicom_filters=dicom_filters,
+                                    num_workers=header_workers)
+
+    return interleave(
+        _session_resources(session, matched, resource_name)
+        for session, matched in iter_concurrent(
+            crawl, ((s,) for s in sessions), num_workers=crawl_workers))
+
+
+def _session_resources(session, matched, resource_name):
+    """
+    Lists the (resource, scan, session, suffix) tuples of the resources to
+    download from the matched scans of a session
+    """
+    session_resources = []
+    for scan in matched:
+        resources = []
+        suffix = False
+        if resource_name is not None:
+            try:
+                resource = scan.resources[resource_name]
+            except KeyError:
+                try:
+                    resource = scan.resources[resource_name.upper()]
+                except KeyError:
+                    logger.warning(
+                        ("Did not find '%s' resource for %s:%s, "
+                         "skipping"),
+                        resource_name, session.label, scan.id)
+                    continue
+            resources.append(resource)
+        else:
+            resource_names = [
+                r.label for r in scan.resources.values()
+                if r.label not in skip_resources]
+            if not resource_names:
+                logger.warning(
+                    ("No valid scan formats for '%s-%s' in '%s' "
+                     "(found '%s')"),
+                    scan.id, scan.type, session,
+                    "', '".join(scan.resources))
+                continue
+            if len(resource_names) > 1:
+                suffix = True
+            for name in resource_names:
+                resources.append(scan.resources[name])
+        for resource in resources:
+            session_resources.append((resource, scan, session, suffix))
+    return session_resources
+
+
+class DownloadedResource(namedtuple('DownloadedResource', (
+        'session', 'scan', 'resource', 'uri', 'path', 'size',
+        'digest_status'))):
+    """
+    Record of a resource downloaded by `iter_get` (or passed to the
+    'callback' of `get`)
+
+    Parameters
+    ----------
+    session : str
+        Label of the session the resource belongs to
+    scan : str | None
+        Label of the scan the resource belongs to ('<id>-<type>'), None for
+        session resources
+    resource : str
+        Label of the resource (i.e. its format)
+    uri : str
+        URI of the resource on the XNAT server
+    path : str | None
+        Local path the resource was saved to. None if the resource didn't
+        contain any files
+    size : int
+        Total size of the downloaded (and converted) files in bytes
+    digest_status : str
+        The result of checking the downloaded files against the digests
+        stored on the server, one of 'verified', 'unavailable' (the server
+        didn't provide digests for some files), 'unchecked', 'reused' (the
+        resource was downloaded by another process) or 'cached' (the outputs
+        of converting the resource were reused from the conversion cache)
+    """
+    __slots__ = ()
 
 
 def get_from_xml(xml_file_path, download_dir, convert_to=None, converter=None,
@@ -298,6 +743,384 @@ def get_from_xml(xml_file_path, download_dir, convert_to=None, converter=None,
     return downloaded
 
 
+def open_remote(session, scan, resource_name, filename, project_id=None,
+                block_size=REMOTE_BLOCK_SIZE, cache_blocks=REMOTE_CACHE_BLOCKS,
+                **kwargs):
+    """
+    Opens a file in a resource on XNAT as a seekable, read-only binary
+    file-like object (see `RemoteFile`), which reads the parts of the file
+    that are accessed with HTTP Range requests instead of downloading the
+    whole file to disk, e.g. to read the header of an image
+
+        >>> with xnatutils.open_remote('MRH017_001_MR01', 't1_mprage',
+                                       'NIFTI_GZ', 't1_mprage.nii.gz',
+                                       connection=login) as f:
+        ...     header = f.read(348)
+
+    Parameters
+    ----------
+    session : str | SessionRecord
+        The label or ID of the session (or its record)
+    scan : str | None
+        The ID or type of the scan, or None for a session resource
+    resource_name : str | None
+        The label of the resource (i.e. its format). Not required if the
+        scan only has one resource
+    filename : str
+        The path of the file within the resource
+    project_id : str | None
+        The ID of the project the session is in
+    block_size : int
+        The size of the blocks that are read from the server in bytes
+    cache_blocks : int
+        The number of the most recently read blocks that are kept in memory
+    connection : xnat.Session
+        An existing XnatPy session to read the file over (e.g. one that is
+        shared between requests to a web service). If not provided a new
+        connection is opened (as per `get`), which is closed when the file
+        is closed
+    **kwargs
+        Passed to `connect` if a connection isn't provided
+
+    Returns
+    -------
+    remote_file : RemoteFile
+        The opened file
+    """
+    context = connect(**kwargs)
+    login = context.__enter__()
+    try:
+        resource, _ = _resolve_resource(login, session, scan, resource_name,
+                                        project_id)
+        return RemoteFile(
+            login, '{}/files/{}'.format(resource.uri, quote(filename)),
+            block_size=block_size, cache_blocks=cache_blocks,
+            context=context)
+    except BaseException:
+        context.__exit__(*sys.exc_info())
+        raise
+
+
+def read_resource_bytes(session, scan, resource_name=None, files=None,
+                        project_id=None, max_size=MAX_RESOURCE_BYTES,
+                        **kwargs):
+    """
+    Reads the files in a (small) resource on XNAT into memory, downloading
+    them concurrently without writing them to disk, e.g.
+
+        >>> contents = xnatutils.read_resource_bytes(
+                'MRH017_001_MR01', None, 'QC', connection=login)
+        >>> report = json.loads(contents['report.json'])
+
+    Parameters
+    ----------
+    session : str | SessionRecord
+        The label or ID of the session (or its record)
+    scan : str | None
+        The ID or type of the scan, or None for a session resource
+    resource_name : str | None
+        The label of the resource (i.e. its format). Not required if the
+        scan only has one resource
+    files : str | list(str) | None
+        Glob pattern(s) of the files in the resource to read (see `get`). If
+        not provided all files are read
+    project_id : str | None
+        The ID of the project the session is in
+    max_size : int
+        The maximum total size of the files to read in bytes, larger
+        resources should be downloaded with `get` or read with `open_remote`
+    connection : xnat.Session
+        An existing XnatPy session to read the resource over
+    **kwargs
+        Passed to `connect` if a connection isn't provided
+
+    Returns
+    -------
+    contents : OrderedDict(str, bytes)
+        The contents of the files keyed by their paths within the resource
+    """
+    if isinstance(files, basestring):
+        files = [files]
+    with connect(**kwargs) as login:
+        resource, scan_label = _resolve_resource(login, session, scan,
+                                                 resource_name, project_id)
+        selected = _select_files(_list_files(resource), files, None)
+        total_size = sum(f.size or 0 for f in selected)
+        if files is None and resource.file_size:
+            total_size = max(total_size, int(resource.file_size))
+        if total_size > max_size:
+            raise XnatUtilsUsageError(
+                "Resource '{}' of {} is too large to read into memory ({} "
+                "bytes > {}), download it with 'get' or read it with "
+                "'open_remote' instead".format(
+                    resource.label, scan_label, total_size, max_size))
+
+        def read(resource_file):
+            buff = io.BytesIO()
+            login.download_stream(resource_file.uri, buff)
+            return resource_file.path, buff.getvalue()
+
+        contents = dict(iter_concurrent(read, ((f,) for f in selected),
+                                        num_workers=FILE_DOWNLOAD_WORKERS))
+    return OrderedDict(sorted(contents.items()))
+
+
+def _resolve_resource(login, session, scan, resource_name, project_id=None):
+    """
+    Looks up the record of a resource of a session (or one of its scans),
+    returning it along with a label of the session and scan for messages.
+    Sessions given by name are retrieved directly by their URI, i.e. by
+    label within the project if it is provided and by ID (or label) across
+    the server otherwise, rather than searching for matching sessions
+    """
+    if isinstance(session, basestring):
+        if project_id is not None:
+            uri = '/data/projects/{}/experiments/{}'.format(
+                project_id, session)
+        else:
+            uri = '/data/experiments/' + session
+        session = SessionRecord(None, session, project_id, None, None, uri,
+                                None, None, login)
+    try:
+        tree = fetch_session_tree(session)
+    except XNATResponseError as e:
+        if response_status(e) == 404:
+            raise XnatUtilsLookupError(session.uri)
+        raise
+    if scan is None:
+        resources = tree.resources
+        scan_label = 'RESOURCES'
+    else:
+        # Scans are matched on their ID before their type
+        scans = ([s for s in tree.scans.values() if s.id == scan] or
+                 [s for s in tree.scans.values() if s.type == scan])
+        if not scans:
+            raise XnatUtilsKeyError(
+                scan, "No scan with ID or type '{}' in '{}'".format(
+                    scan, tree.label))
+        if len(scans) > 1:
+            raise XnatUtilsUsageError(
+                "Multiple scans of type '{}' in '{}' (IDs '{}'), please "
+                "provide the ID of the scan".format(
+                    scan, tree.label, "', '".join(s.id for s in scans)))
+        resources = scans[0].resources
+        scan_label = scans[0].id
+    if resource_name is None:
+        names = [n for n in resources if n not in skip_resources]
+        if len(names) != 1:
+            raise XnatUtilsUsageError(
+                "'resource_name' must be provided as there are {} resources "
+                "in {}:{} ('{}')".format(len(names), tree.label, scan_label,
+                                         "', '".join(names)))
+        resource_name = names[0]
+    try:
+        resource = resources[resource_name]
+    except KeyError:
+        try:
+            resource = resources[resource_name.upper()]
+        except KeyError:
+            raise XnatUtilsMissingResourceException(
+                resource_name, tree.label, scan_label,
+                available=list(resources))
+    return resource, '{}:{}'.format(tree.label, scan_label)
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    A seekable, read-only binary file-like object for a file on XNAT, which
+    reads the file in blocks with HTTP Range requests as they are accessed.
+    The most recently read blocks are kept in memory, so repeated reads of
+    the same region (e.g. a header) don't go back to the server, and
+    consecutive missing blocks are read in a single request. If the server
+    doesn't support Range requests the whole file is read on first access.
+
+    Parameters
+    ----------
+    login : xnat.Session
+        The connection to read the file over
+    uri : str
+        The URI of the file, e.g.
+        '/data/experiments/<id>/scans/1/resources/<id>/files/1.dcm'
+    block_size : int
+        The size of the blocks that are read from the server in bytes
+    cache_blocks : int
+        The number of the most recently read blocks that are kept in memory
+    context : object | None
+        The context the connection was opened in (see `connect`), which is
+        exited when the file is closed
+    """
+
+    def __init__(self, login, uri, block_size=REMOTE_BLOCK_SIZE,
+                 cache_blocks=REMOTE_CACHE_BLOCKS, context=None):
+        super(RemoteFile, self).__init__()
+        self._login = login
+        self.uri = uri
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self._context = context
+        self._blocks = OrderedDict()
+        self._content = None
+        self._size = None
+        self._pos = 0
+
+    @property
+    def name(self):
+        return self.uri
+
+    @property
+    def size(self):
+        "The size of the file in bytes"
+        if self._size is None:
+            response = raw_request(self._login, self.uri, method='head',
+                                   allow_redirects=True)
+            length = response.headers.get('Content-Length')
+            if length is not None:
+                self._size = int(length)
+            else:
+                # The size is reported in the Content-Range of the response
+                self._read_blocks(0, 0)
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        view = memoryview(b).cast('B')
+        end = min(self._pos + len(view), self.size)
+        if end <= self._pos:
+            return 0
+        first = self._pos // self.block_size
+        last = (end - 1) // self.block_size
+        missing = [i for i in range(first, last + 1) if i not in self._blocks]
+        if missing and self._content is None:
+            self._read_blocks(missing[0], missing[-1])
+        num_read = 0
+        for index in range(first, last + 1):
+            block = self._get_block(index)
+            start = max(self._pos - index * self.block_size, 0)
+            stop = min(end - index * self.block_size, len(block))
+            view[num_read:num_read + stop - start] = block[start:stop]
+            num_read += stop - start
+        self._pos += num_read
+        # Evict the least recently used blocks once they have been copied
+        while len(self._blocks) > self.cache_blocks:
+            self._blocks.popitem(last=False)
+        return num_read
+
+    def close(self):
+        if not self.closed:
+            self._blocks.clear()
+            self._content = None
+            if self._context is not None:
+                self._context.__exit__(None, None, None)
+        super(RemoteFile, self).close()
+
+    def _get_block(self, index):
+        if self._content is not None:
+            return self._content[index * self.block_size:
+                                 (index + 1) * self.block_size]
+        block = self._blocks[index]
+        # Mark the block as the most recently used
+        self._blocks.move_to_end(index)
+        return block
+
+    def _read_blocks(self, first, last):
+        """
+        Reads the blocks between first and last (inclusive) in a single
+        Range request, re-requesting the remaining blocks if the server
+        returns fewer bytes than were requested
+        """
+        while first <= last:
+            start = first * self.block_size
+            stop = (last + 1) * self.block_size - 1
+            response = raw_request(
+                self._login, self.uri, accepted_status=[200, 206],
+                headers={'Range': 'bytes={}-{}'.format(start, stop)})
+            if response.status_code == 200:
+                # The server ignored the Range header and sent the whole file
+                logger.debug("Server doesn't support Range requests for %s, "
+                             "reading the whole file", self.uri)
+                self._content = response.content
+                self._size = len(self._content)
+                self._blocks.clear()
+                return
+            content_range = response.headers.get('Content-Range', '')
+            if self._size is None and '/' in content_range:
+                self._size = int(content_range.rsplit('/', 1)[1])
+            data = response.content
+            at_end = self._size is None or start + len(data) >= self._size
+            requested = first
+            for index in range(requested, last + 1):
+                offset = (index - requested) * self.block_size
+                block = data[offset:offset + self.block_size]
+                # Blocks cut short before the end of the file are requested
+                # again
+                if not block or (len(block) < self.block_size and
+                                 not at_end):
+                    break
+                self._blocks[index] = block
+                self._blocks.move_to_end(index)
+                first = index + 1
+            if at_end:
+                return
+            if first == requested:
+                raise XnatUtilsError(
+                    "Server returned no data for bytes {}-{} of {}".format(
+                        start, stop, self.uri))
+            logger.debug("Server returned bytes %s-%s of %s instead of "
+                         "%s-%s, requesting the remainder", start,
+                         start + len(data) - 1, self.uri, start, stop)
+
+
+def write_manifest(path, downloaded_resources, matched, shard=None):
+    """
+    Saves a JSON manifest of the sessions matched by a call to `get` and the
+    resources downloaded from them, so that the results of separate shards
+    can be merged afterwards
+
+    Parameters
+    ----------
+    path : str
+        Path to write the manifest to
+    downloaded_resources : dict(str, list(str))
+        The URIs of the resources downloaded from each session
+    matched : list(str)
+        Labels of the sessions that were matched
+    shard : tuple(int, int) | None
+        The (index, count) of the shard the manifest was generated by
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'shard': list(shard) if shard is not None else None,
+                   'matched': sorted(matched),
+                   'sessions': dict(downloaded_resources)}, f, indent=2)
+    os.replace(tmp_path, path)
+
+
 def get_extension(resource_name):
     ext = ''
     try:
@@ -339,7 +1162,9 @@ def get_extension(resource_name):
 
 
 def _download_resource(resource, scan, session, download_dir, subject_dirs,
-                       convert_to, converter, strip_name, suffix=False):
+                       convert_to, converter, strip_name, suffix=False,
+                       check_digests=False, cache_conversions=True, files=None,
+                       sample=None):
     if scan is not None:
         scan_label = scan.id
         if scan.type is not None:
@@ -373,17 +1198,119 @@ def _download_resource(resource, scan, session, download_dir, subject_dirs,
     if suffix:
         target_path += '-' + resource.label
     target_path += target_ext
-    tmp_dir = target_path + '.download'
+    # Lock the target path so that concurrent processes downloading to the
+    # same directory don't clobber each other's downloads
+    lock = FileLock(target_path + '.lock')
+    with lock:
+        if lock.waited and os.path.exists(target_path):
+            logger.info("%s was downloaded by another process while waiting "
+                        "for it, reusing", target_path)
+            published, digest_status = [target_path], 'reused'
+        else:
+            # Download to a unique temporary directory alongside the target
+            # so the outputs can be moved into place atomically
+            tmp_dir = tempfile.mkdtemp(
+                prefix='.' + os.path.basename(target_path) + '.',
+                suffix='.download', dir=target_dir)
+            try:
+                published, digest_status = _download_and_publish(
+                    resource, scan, session, scan_label, target_dir,
+                    target_path, tmp_dir, convert_to, converter, strip_name,
+                    check_digests, cache_conversions=cache_conversions,
+                    files=files, sample=sample)
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+    return DownloadedResource(
+        session.label, (scan_label if scan is not None else None),
+        resource.label, resource.uri,
+        (target_path if published else None),
+        sum(_path_size(p) for p in published), digest_status)
+
+
+def _download_and_publish(resource, scan, session, scan_label, target_dir,
+                          target_path, tmp_dir, convert_to, converter,
+                          strip_name, check_digests, cache_conversions=True,
+                          files=None, sample=None):
+    mrconvert = dcm2niix = None
+    if converter == 'dcm2niix':
+        dcm2niix = find_executable('dcm2niix')
+        if dcm2niix is None:
+            raise XnatUtilsUsageError(
+                "Selected converter 'dcm2niix' is not available, "
+                "please make sure it is installed and on your "
+                "path")
+    elif converter == 'mrconvert':
+        mrconvert = find_executable('mrconvert')
+        if mrconvert is None:
+            raise XnatUtilsUsageError(
+                "Selected converter 'mrconvert' is not available, "
+                "please make sure it is installed and on your "
+                "path")
+    else:
+        assert converter is None
+    use_dcm2niix = (convert_to in ('nifti', 'nifti_gz') and
+                    resource.label == 'DICOM' and dcm2niix is not None)
+    # Convert or move downloaded dir/files to a staging directory, from
+    # which they are published to the target directory
+    staging_dir = os.path.join(tmp_dir, 'staging')
+    os.mkdir(staging_dir)
+    staged_path = os.path.join(staging_dir, os.path.basename(target_path))
+    output_name = scan_label if scan is not None else resource.label
+    remote_digests = selected = None
+    if files is not None or sample is not None:
+        # List the files in the resource to select the ones to download
+        listing = _list_files(resource)
+        remote_digests = dict((f.path, f.digest) for f in listing)
+        selected = _select_files(listing, files, sample)
+        if not selected:
+            logger.warning(
+                "No files were selected from resource '%s' of %s:%s",
+                resource.label, session.label, scan_label)
+            return [], 'unchecked'
+    # Look up the outputs of converting the resource in the conversion cache
+    # before downloading it
+    cache = cache_key = None
+    if (cache_conversions and convert_to is not None and
+            convert_to.upper() != resource.label and
+            (use_dcm2niix or mrconvert is not None) and
+            not os.environ.get(NO_CONVERSION_CACHE_VAR)):
+        if remote_digests is None:
+            try:
+                remote_digests = get_digests(resource)
+            except XnatUtilsError as e:
+                logger.warning("%s, not using conversion cache", e)
+        # The digests of all files are required to identify the resource
+        if remote_digests and all(remote_digests.values()):
+            executable = dcm2niix if use_dcm2niix else mrconvert
+            cache = ConversionCache.default()
+            cache_key = cache.key(
+                remote_digests, resource=resource.label,
+                convert_to=convert_to, name=os.path.basename(target_path),
+                output_name=output_name,
+                converter=os.path.basename(executable),
+                version=_converter_version(executable),
+                files=([f.path for f in selected]
+                       if selected is not None else None))
+            if cache.lookup(cache_key, staging_dir):
+                print('Reusing cached conversion of {}: {}-{}'.format(
+                    session.label, scan_label, resource.label))
+                return _publish_staged(staging_dir, target_dir,
+                                       tmp_dir), 'cached'
     # Download the scan from XNAT
     print('Downloading {}: {}-{}'.format(
         session.label, scan_label,
         resource.label))
+    download_dir = os.path.join(tmp_dir, 'download')
     try:
-        resource.download_dir(tmp_dir)
+        if selected is not None:
+            _download_files(resource, selected,
+                            os.path.join(download_dir, 'files'))
+        else:
+            resource.download_dir(download_dir)
     except KeyError:
         raise XnatUtilsMissingResourceException(
             resource.label, session.label, scan_label,
-            available=[r.label for r in scan.resources])
+            available=[r.label for r in scan.resources.values()])
     except XNATResponseError as e:
         # Check for 404 status
         try:
@@ -393,71 +1320,52 @@ def _download_resource(resource, scan, session, download_dir, subject_dirs,
                 logger.warning(
                     ("Did not find any files for resource '{}' in '{}' "
                      "session").format(resource.label, session.label))
-                return True
+                return [], 'unchecked'
         except Exception:  # pylint: disable=broad-except
             pass
         raise e
     # Extract the relevant data from the download dir and move to
     # target location
-    src_path = glob(tmp_dir + '/**/files', recursive=True)[0]
+    src_path = glob(download_dir + '/**/files', recursive=True)[0]
+    if check_digests:
+        digest_status = _check_digests(resource, src_path,
+                                       remote_digests=remote_digests)
+    else:
+        digest_status = 'unchecked'
     fnames = os.listdir(src_path)
     # Link directly to the file if there is only one in the folder
     if len(fnames) == 1:
         src_path = os.path.join(src_path, fnames[0])
-    # Convert or move downloaded dir/files to target path
-    mrconvert = dcm2niix = None
-    if converter == 'dcm2niix':
-        dcm2niix = find_executable('dcm2niix')
-        if dcm2niix is None:
-            raise XnatUtilsUsageError(
-                "Selected converter 'dcm2niix' is not available, "
-                "please make sure it is installed and on your "
-                "path")
-    elif converter == 'mrconvert':
-        mrconvert = find_executable('mrconvert')
-        if mrconvert is None:
-            raise XnatUtilsUsageError(
-                "Selected converter 'mrconvert' is not available, "
-                "please make sure it is installed and on your "
-                "path")
-    else:
-        assert converter is None
-    # Clear target path if it exists
-    if os.path.exists(target_path):
-        if os.path.isdir(target_path):
-            shutil.rmtree(target_path)
-        else:
-            os.remove(target_path)
+    converted = False
     try:
         if (convert_to is None or convert_to.upper() == resource.label):
             # No conversion required
             if strip_name and resource.label in ('DICOM', 'secondary'):
                 dcmfiles = sorted(os.listdir(src_path))
-                os.mkdir(target_path)
+                os.mkdir(staged_path)
                 for f in dcmfiles:
                     dcm_num = int(f.split('-')[-2])
                     file_src_path = os.path.join(src_path, f)
                     file_target_path = os.path.join(
-                        target_path, str(dcm_num).zfill(4) + '.dcm')
+                        staged_path, str(dcm_num).zfill(4) + '.dcm')
                     shutil.move(file_src_path, file_target_path)
             else:
-                shutil.move(src_path, target_path)
-        elif (convert_to in ('nifti', 'nifti_gz') and
-              resource.label == 'DICOM' and dcm2niix is not None):
+                shutil.move(src_path, staged_path)
+        elif use_dcm2niix:
             # convert between dicom and nifti using dcm2niix.
             # mrconvert can do this as well but there have been
             # some problems losing TR from the dicom header.
             zip_opt = 'y' if convert_to == 'nifti_gz' else 'n'
             convert_cmd = '{} -z {} -o "{}" -f "{}" "{}"'.format(
-                dcm2niix, zip_opt, target_dir,
-                (scan_label if scan is not None else resource.label),
-                src_path)
+                dcm2niix, zip_opt, staging_dir, output_name, src_path)
             sp.check_call(convert_cmd, shell=True)
+            converted = True
         elif mrconvert is not None:
             # If dcm2niix format is not installed or another is
             # required use mrconvert instead.
             sp.check_call('{} "{}" "{}"'.format(
-                mrconvert, src_path, target_path), shell=True)
+                mrconvert, src_path, staged_path), shell=True)
+            converted = True
         else:
             if (resource.label == 'DICOM' and convert_to in ('nifti',
                                                              'nifti_gz')):
@@ -469,17 +1377,168 @@ def _download_resource(resource, scan, session, download_dir, subject_dirs,
                 "and {} formats".format(
                     msg, resource.label.lower(), convert_to))
     except sp.CalledProcessError as e:
+        for fname in os.listdir(staging_dir):
+            _remove_path(os.path.join(staging_dir, fname))
         shutil.move(src_path, os.path.join(
-            target_dir,
-            (scan_label if scan is not None else resource.label)
-            + get_extension(resource.label)))
+            staging_dir, output_name + get_extension(resource.label)))
         logger.warning(
             "Could not convert %s:%s to %s format (%s)",
             session.label, scan.type, convert_to,
             e.output.strip() if e.output is not None else '')
-    # Clean up download dir
-    shutil.rmtree(tmp_dir)
-    return True
+    # Only cache conversions of files that were checked against the digests
+    # they are cached under
+    if converted and cache is not None and digest_status == 'verified':
+        cache.store(cache_key, staging_dir, resource=resource.uri,
+                    convert_to=convert_to)
+    return (_publish_staged(staging_dir, target_dir, tmp_dir),
+            digest_status)
+
+
+def _select_files(listing, files, sample):
+    """
+    Selects the files that match the glob patterns (if provided) and then
+    samples the given number of evenly spaced files from them (if provided)
+    """
+    if files is not None:
+        listing = [f for f in listing
+                   if any(fnmatch(f.path, p) or fnmatch(f.name, p)
+                          for p in files)]
+    if sample is not None and sample < len(listing):
+        listing = sorted(listing, key=_instance_number)
+        listing = [listing[int((i + 0.5) * len(listing) / sample)]
+                   for i in range(sample)]
+    return listing
+
+
+def _instance_number(resource_file):
+    """
+    Sort key that orders DICOM files by their instance number (the second
+    last '-' separated part of their names on XNAT), falling back to their
+    names
+    """
+    try:
+        return (int(resource_file.name.split('-')[-2]), resource_file.name)
+    except (ValueError, IndexError):
+        return (float('inf'), resource_file.name)
+
+
+def _download_files(resource, selected, files_dir):
+    """
+    Downloads the selected files of a resource into the files directory
+    concurrently, preserving their paths within the resource
+    """
+    def download(resource_file):
+        path = os.path.join(files_dir, *resource_file.path.split('/'))
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with open(path, 'wb') as f:
+            resource.xnat_session.download_stream(resource_file.uri, f)
+
+    os.makedirs(files_dir)
+    for _ in iter_concurrent(download, ((f,) for f in selected),
+                             num_workers=FILE_DOWNLOAD_WORKERS):
+        pass
+
+
+def _publish_staged(staging_dir, target_dir, tmp_dir):
+    published = []
+    for fname in os.listdir(staging_dir):
+        published.append(os.path.join(target_dir, fname))
+        _publish(os.path.join(staging_dir, fname), published[-1], tmp_dir)
+    return published
+
+
+@functools.lru_cache()
+def _converter_version(executable):
+    """
+    Returns the version reported by a converter (e.g. 'v1.0.20211006' for
+    dcm2niix), falling back to the size and modification time of the
+    executable if it doesn't report one
+    """
+    flag = '-version' if 'mrconvert' in executable else '--version'
+    try:
+        output = sp.run([executable, flag], stdout=sp.PIPE,
+                        stderr=sp.STDOUT, timeout=30).stdout.decode(
+                            'utf-8', errors='replace')
+    except (OSError, sp.SubprocessError):
+        output = ''
+    match = version_re.search(output)
+    if match is not None:
+        return match.group(0)
+    fstat = os.stat(executable)
+    return '{}-{}'.format(fstat.st_size, fstat.st_mtime)
+
+
+def _check_digests(resource, files_dir, remote_digests=None):
+    """
+    Checks the downloaded files of a resource against the MD5 digests stored
+    on the server (downloading them if they aren't provided, keyed by the
+    paths of the files within the resource or their names), returning
+    'verified' if all files were checked or 'unavailable' if the server
+    didn't provide digests for some of them
+    """
+    if remote_digests is None:
+        remote_digests = get_digests(resource)
+    status = 'verified'
+    to_check = {}
+    for dpath, _, fnames in os.walk(files_dir):
+        for fname in fnames:
+            # Digests listed by `_list_files` are keyed by the paths of the
+            # files within the resource, so that files with the same name
+            # in different sub-directories don't clash
+            path = os.path.relpath(os.path.join(dpath, fname),
+                                   files_dir).replace(os.sep, '/')
+            remote_digest = remote_digests.get(path)
+            if remote_digest is None:
+                remote_digest = remote_digests.get(
+                    fname.replace(' ', '%20'), remote_digests.get(fname))
+            if not remote_digest:
+                status = 'unavailable'
+                continue
+            to_check[os.path.join(dpath, fname)] = remote_digest
+    # The downloaded files are in a temporary directory so there is no
+    # point caching their digests
+    local_digests = calculate_checksums(to_check, use_cache=False)
+    for fpath, remote_digest in sorted(to_check.items()):
+        local_digest = local_digests[fpath]
+        if local_digest != remote_digest:
+            raise XnatUtilsDigestCheckError(
+                "Remote digest does not match local ({} vs {}) for {} "
+                "in {}. Please download it again".format(
+                    remote_digest, local_digest, os.path.basename(fpath),
+                    resource.uri))
+    return status
+
+
+def _path_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(dpath, f))
+                   for dpath, _, fnames in os.walk(path) for f in fnames)
+    return os.path.getsize(path)
+
+
+def _publish(src_path, target_path, tmp_dir):
+    """
+    Moves a staged file or directory into its target location, replacing
+    any existing file or directory at the target path. Both paths need to
+    be on the same file-system so that the move is a rename, meaning that
+    other processes never see a partially written target
+    """
+    if os.path.isdir(target_path) and not os.path.islink(target_path):
+        # Directories can't be replaced in a single rename, so move the
+        # existing directory aside first
+        replaced_path = os.path.join(tmp_dir, 'replaced')
+        os.rename(target_path, replaced_path)
+        os.rename(src_path, target_path)
+        shutil.rmtree(replaced_path)
+    else:
+        if os.path.isdir(src_path) and os.path.lexists(target_path):
+            os.remove(target_path)
+        os.replace(src_path, target_path)
+
 
 def _get_subject_from_session(session):
     # if 'subjects' in resource_uri:
@@ -548,6 +1607,31 @@ by providing the '--convert_to' option and specifying the desired format.
 
     $ xnat-get TEST001_001_MR01 --scan 'ep2d_diff.*' --convert_to nifti_gz
 
+To only download some of the files in each resource, e.g. the JSON sidecars
+or the middle slice of each DICOM series for QC, pass glob patterns to the
+'--files' option and/or the number of evenly spaced files to download to the
+'--sample' option, e.g.
+
+    $ xnat-get 'MRH017_.*' --scan 't1.*' --sample 1
+
+Scans can also be selected by the fields of their DICOM headers, which are read
+from the server's DICOM dump service without downloading the series, by passing
+'FIELD=REGEX' pairs (where FIELD is a DICOM keyword or tag) to the '--dicom'
+option, e.g.
+
+    $ xnat-get 'MRH017_.*' --dicom 'SeriesDescription=.*MPRAGE.*' \
+        'ImageType=ORIGINAL.*'
+
+To download sessions as they are archived, pass the '--watch' option, which
+polls the server every '--interval' seconds for newly inserted sessions that
+match, e.g.
+
+    $ xnat-get --project MRH017 --watch --interval 60
+
+Sessions are only downloaded once they haven't been modified for '--settle'
+seconds (so their scans have finished archiving), and sessions that fail to
+download are tried again at the next poll.
+
 User credentials can be stored in a ~/.netrc file so that they don't need to be
 entered each time a command is run. If a new user provided or netrc doesn't
 exist the tool will ask whether to create a ~/.netrc file with the given
@@ -626,6 +1710,67 @@ def parser():
                         help=("Whether to strip the default name of each dicom"
                               " file to have just a number. Ex. 0001.dcm. It "
                               "will work just on DICOM files, not NIFTI."))
+    parser.add_argument('--shard', type=str, default=None,
+                        help=("Only download the matched sessions assigned to "
+                              "this shard, given as 'i/N' with 0 <= i < N "
+                              "(e.g. '$SLURM_ARRAY_TASK_ID/10'). Sessions are "
+                              "assigned by a stable hash of their label"))
+    parser.add_argument('--manifest', type=str, default=None,
+                        help=("Path to save a JSON manifest of the matched "
+                              "sessions and downloaded resources to, which "
+                              "can be combined across shards with "
+                              "'xnat-merge-manifests'"))
+    parser.add_argument('--num_workers', '-W', type=int, default=1,
+                        help=("The number of resources to download "
+                              "concurrently"))
+    parser.add_argument('--crawl_workers', type=int,
+                        default=DEFAULT_CRAWL_WORKERS,
+                        help=("The number of sessions to retrieve the "
+                              "metadata of concurrently"))
+    parser.add_argument('--dont_check_digests', action='store_true',
+                        default=False,
+                        help=("Don't check the downloaded files against the "
+                              "digests stored on the server"))
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help=("Keep polling for newly archived sessions that "
+                              "match and download them as they appear"))
+    parser.add_argument('--interval', type=float, default=60,
+                        help=("The number of seconds between polls when "
+                              "watching for new sessions"))
+    parser.add_argument('--since', type=str, default=None,
+                        help=("When watching, also download sessions "
+                              "inserted after this time ('Y-m-d H:M:S')"))
+    parser.add_argument('--settle', type=float, default=None,
+                        help=("When watching, the number of seconds a new "
+                              "session must have gone unmodified before it "
+                              "is downloaded (defaults to '--interval')"))
+    parser.add_argument('--max_retries', type=int,
+                        default=DEFAULT_MAX_RETRIES,
+                        help=("The number of times to retry requests and "
+                              "downloads that fail with a transient error "
+                              "(e.g. 503 while the server is under load)"))
+    parser.add_argument('--max_bandwidth', type=str, default=None,
+                        help=("The maximum combined bandwidth of the "
+                              "downloads in bytes per second, optionally "
+                              "with a K, M or G suffix (e.g. 50M)"))
+    parser.add_argument('--files', type=str, default=None, nargs='+',
+                        metavar='GLOB',
+                        help=("Only download the files in each resource that "
+                              "match these glob patterns (e.g. '*.json')"))
+    parser.add_argument('--sample', type=int, default=None, metavar='N',
+                        help=("Only download N evenly spaced files from each "
+                              "resource (e.g. 1 for the middle slice of a "
+                              "DICOM series)"))
+    parser.add_argument('--dicom', type=str, nargs='+', default=None,
+                        metavar='FIELD=REGEX',
+                        help=("Only download scans whose DICOM header fields "
+                              "(given by keyword or tag, e.g. "
+                              "SeriesDescription or 0008,103E) match the "
+                              "regular expressions"))
+    parser.add_argument('--no_conversion_cache', action='store_true',
+                        default=False,
+                        help=("Don't reuse (or cache) the outputs of "
+                              "previous conversions of unchanged resources"))
     add_default_args(parser)
     return parser
 
@@ -647,7 +1792,32 @@ def cmd(argv=sys.argv[1:]):
                          download_dir, convert_to=args.convert_to,
                          converter=args.converter, subject_dirs=args.subject_dirs,
                          user=args.user, strip_name=args.strip_name,
-                         server=args.server, use_netrc=(not args.no_netrc))
+                         server=args.server, use_netrc=(not args.no_netrc),
+                         cache_session=(not args.no_netrc))
+        elif args.watch:
+            for _ in watch(
+                    args.session_or_regex_or_xml_file, download_dir,
+                    interval=args.interval, since=args.since,
+                    settle=args.settle,
+                    project_id=args.project, scans=args.scans,
+                    resource_name=args.resource, with_scans=args.with_scans,
+                    without_scans=args.without_scans,
+                    convert_to=args.convert_to, converter=args.converter,
+                    subject_dirs=args.subject_dirs, user=args.user,
+                    strip_name=args.strip_name, server=args.server,
+                    use_netrc=(not args.no_netrc),
+                    cache_session=(not args.no_netrc),
+                    match_scan_id=(not args.dont_match_scan_id),
+                    skip_downloaded=args.skip_downloaded,
+                    subject_id=args.subject, num_workers=args.num_workers,
+                    check_digests=(not args.dont_check_digests),
+                    crawl_workers=args.crawl_workers,
+                    max_retries=args.max_retries,
+                    max_bandwidth=args.max_bandwidth,
+                    cache_conversions=(not args.no_conversion_cache),
+                    files=args.files, sample=args.sample,
+                    dicom_filters=args.dicom):
+                pass
         else:
             get(args.session_or_regex_or_xml_file, download_dir, scans=args.scans,
                 resource_name=args.resource, with_scans=args.with_scans,
@@ -655,13 +1825,26 @@ def cmd(argv=sys.argv[1:]):
                 converter=args.converter, subject_dirs=args.subject_dirs,
                 user=args.user, strip_name=args.strip_name, server=args.server,
                 use_netrc=(not args.no_netrc),
+                cache_session=(not args.no_netrc),
                 match_scan_id=(not args.dont_match_scan_id),
                 skip_downloaded=args.skip_downloaded,
                 project_id=args.project, subject_id=args.subject,
-                before=args.before, after=args.after)
+                before=args.before, after=args.after, shard=args.shard,
+                manifest=args.manifest, num_workers=args.num_workers,
+                check_digests=(not args.dont_check_digests),
+                crawl_workers=args.crawl_workers,
+                max_retries=args.max_retries,
+                max_bandwidth=args.max_bandwidth,
+                cache_conversions=(not args.no_conversion_cache),
+                files=args.files, sample=args.sample,
+                dicom_filters=args.dicom)
     except XnatUtilsUsageError as e:
         print_usage_error(e)
     except XNATResponseError as e:
         print_response_error(e)
     except XnatUtilsException as e:
         print_info_message(e)
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+        print("Stopped watching for new sessions")
@@ -0,0 +1,465 @@
+import sys
+import os.path
+import time
+import sqlite3
+import logging
+from collections import namedtuple, OrderedDict
+from xnat.exceptions import XNATResponseError
+from .base import (
+    connect, base_parser, add_default_args, print_response_error,
+    print_usage_error, print_info_message, set_logger, iter_table,
+    iter_concurrent, fetch_session_tree, get_cache_dir, _parse_date,
+    sanitize_re, SubjectRecord, SessionRecord, ScanRecord, ResourceRecord,
+    DEFAULT_CRAWL_WORKERS)
+from .exceptions import (
+    XnatUtilsUsageError, XnatUtilsLookupError, XnatUtilsException)
+
+logger = logging.getLogger('xnat-utils')
+
+INDEX_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS subjects (id TEXT PRIMARY KEY, label TEXT)",
+    "CREATE TABLE IF NOT EXISTS sessions ("
+    "id TEXT PRIMARY KEY, label TEXT, subject_id TEXT, date TEXT, "
+    "last_modified TEXT)",
+    "CREATE TABLE IF NOT EXISTS scans ("
+    "session_id TEXT, id TEXT, type TEXT, PRIMARY KEY (session_id, id))",
+    "CREATE TABLE IF NOT EXISTS resources ("
+    "uri TEXT PRIMARY KEY, session_id TEXT, scan_id TEXT, id TEXT, "
+    "label TEXT, format TEXT, file_count INTEGER, file_size INTEGER)",
+    "CREATE TABLE IF NOT EXISTS files ("
+    "resource_uri TEXT, session_id TEXT, name TEXT, size INTEGER, "
+    "digest TEXT, PRIMARY KEY (resource_uri, name))",
+    "CREATE INDEX IF NOT EXISTS scans_session ON scans (session_id)",
+    "CREATE INDEX IF NOT EXISTS resources_session ON resources "
+    "(session_id)",
+    "CREATE INDEX IF NOT EXISTS files_session ON files (session_id)")
+
+
+def update_index(project_id, index_path=None, rebuild=False, files=True,
+                 crawl_workers=DEFAULT_CRAWL_WORKERS, **kwargs):
+    """
+    Crawls a project into a local SQLite index of its subjects, sessions,
+    scans and resources (and the names, sizes and digests of their files),
+    which `ls` can query offline instead of crawling the server (i.e. by
+    passing it the 'index' kwarg), e.g.
+
+        >>> xnatutils.update_index('MRH017')
+        >>> xnatutils.ls(project_id='MRH017', datatype='session',
+                         with_scans='t1.*', without_scans='.*flair.*',
+                         after='2022-01-01', index=True)
+
+    The time each session was last modified is recorded in the index, so
+    subsequent updates only re-crawl the sessions that have been added or
+    modified since (and drop the ones that have been removed).
+
+    Parameters
+    ----------
+    project_id : str
+        The ID of the project to index
+    index_path : str | None
+        Path to the index, defaults to '<project>.sqlite' in the 'index'
+        sub-directory of the xnatutils cache directory (~/.xnatutils)
+    rebuild : bool
+        Whether to discard the existing contents of the index and crawl all
+        sessions again
+    files : bool
+        Whether to index the names, sizes and digests of the files in each
+        resource, which requires an additional request per resource
+    crawl_workers : int
+        The number of sessions to crawl concurrently
+    user : str
+        The user to connect to the server with
+    loglevel : str
+        The logging level to display. In order of increasing verbosity
+        ERROR, WARNING, INFO, DEBUG.
+    connection : xnat.Session
+        An existing XnatPy session that is to be reused instead of
+        creating a new session. The session is wrapped in a dummy class
+        that disables the disconnection on exit, to allow the method to
+        be nested in a wider connection context (i.e. reuse the same
+        connection between commands).
+    server : str | int | None
+        URI of the XNAT server to connect to. If not provided connect
+        will look inside the ~/.netrc file to get a list of saved
+        servers. If there is more than one, then they can be selected
+        by passing an index corresponding to the order they are listed
+        in the .netrc
+    use_netrc : bool
+        Whether to load and save user credentials from netrc file
+        located at $HOME/.netrc
+
+    Returns
+    -------
+    result : IndexUpdate
+        The number of sessions in the index and the IDs of the sessions
+        that were crawled and removed
+    """
+    if index_path is None:
+        index_path = ProjectIndex.default_path(project_id)
+    with connect(parse_model=False, **kwargs) as login, \
+            ProjectIndex(index_path, create=True) as index:
+        if rebuild:
+            index.clear()
+        index.check_source(login.server, project_id)
+        return index.update(login, files=files, crawl_workers=crawl_workers)
+
+
+class IndexUpdate(namedtuple('IndexUpdate', ('num_sessions', 'crawled',
+                                             'removed'))):
+    """
+    The result of a call to `update_index`
+
+    Parameters
+    ----------
+    num_sessions : int
+        The number of sessions in the index after the update
+    crawled : list(str)
+        The IDs of the new and modified sessions that were crawled
+    removed : list(str)
+        The IDs of the sessions that were removed from the index as they had
+        been removed from the server
+    """
+    __slots__ = ()
+
+
+class ProjectIndex(object):
+    """
+    A local SQLite index of the subjects, sessions, scans and resources of a
+    project built by `update_index`. The subjects and sessions are listed
+    from it as the same records that are listed from the server (e.g.
+    `SessionRecord`), so it can be passed to `matching_sessions` and
+    `matching_subjects` in place of a connection. The records aren't
+    connected to a server (i.e. their 'xnat_session' is None) so can't be
+    promoted to XnatPy objects.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database
+    create : bool
+        Whether to create the index if it doesn't exist
+    """
+
+    def __init__(self, path, create=False):
+        if not create and not os.path.exists(path):
+            raise XnatUtilsUsageError(
+                "No index found at '{}', build it with 'xnat-index build'"
+                .format(path))
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            for statement in INDEX_SCHEMA:
+                self._conn.execute(statement)
+
+    @classmethod
+    def default_path(cls, project_id):
+        return os.path.join(get_cache_dir('index'),
+                            sanitize_re.sub('_', project_id) + '.sqlite')
+
+    @classmethod
+    def open(cls, project_id=None, path=None):
+        """
+        Opens an existing index, either the one at the given path or the
+        default index of the given project
+        """
+        if path is None:
+            if project_id is None:
+                raise XnatUtilsUsageError(
+                    "Either the project ID (\"-p\") or the path to the index "
+                    "must be provided to list from an index")
+            path = cls.default_path(project_id)
+        index = cls(path)
+        if index.project is None:
+            raise XnatUtilsUsageError(
+                "Index at '{}' hasn't been built yet".format(path))
+        return index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    @property
+    def project(self):
+        return self._get_meta('project')
+
+    @property
+    def server(self):
+        return self._get_meta('server')
+
+    @property
+    def updated(self):
+        return self._get_meta('updated')
+
+    def check_source(self, server, project_id):
+        """
+        Checks that the index was built from the given server and project
+        before updating it
+        """
+        for key, value in (('server', server), ('project', project_id)):
+            indexed = self._get_meta(key)
+            if indexed is not None and indexed != value:
+                raise XnatUtilsUsageError(
+                    "Index at '{}' was built from {} '{}' not '{}', rebuild "
+                    "it or provide a different path".format(
+                        self.path, key, indexed, value))
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                (('server', server), ('project', project_id)))
+
+    def clear(self):
+        with self._conn:
+            for table in ('meta', 'subjects', 'sessions', 'scans',
+                          'resources', 'files'):
+                self._conn.execute("DELETE FROM " + table)
+
+    def update(self, login, files=True,
+               crawl_workers=DEFAULT_CRAWL_WORKERS):
+        """
+        Crawls the sessions of the indexed project that have been added or
+        modified since the index was last updated (see `update_index`)
+        """
+        project_id = self.project
+        listing = OrderedDict(
+            (r['ID'], r) for r in iter_table(
+                login, '/data/projects/{}/experiments'.format(project_id),
+                columns=('ID', 'label', 'subject_ID', 'date', 'insert_date',
+                         'last_modified')))
+        indexed = dict(self._conn.execute(
+            "SELECT id, last_modified FROM sessions"))
+        modified = [i for i, r in listing.items()
+                    if i not in indexed or
+                    indexed[i] != _last_modified(r)]
+        removed = sorted(set(indexed) - set(listing))
+        logger.info("%s of %s sessions in %s added or modified since the "
+                    "index was last updated, %s removed", len(modified),
+                    len(listing), project_id, len(removed))
+        with self._conn:
+            # The subjects are all listed in a single request so they are
+            # just replaced
+            self._conn.execute("DELETE FROM subjects")
+            self._conn.executemany(
+                "INSERT INTO subjects VALUES (?, ?)",
+                ((r['ID'], r['label']) for r in iter_table(
+                    login, '/data/projects/{}/subjects'.format(project_id),
+                    columns=('ID', 'label'))))
+            for session_id in removed:
+                self._delete_session(session_id)
+        records = (
+            (SessionRecord(i, listing[i]['label'], project_id,
+                           listing[i].get('subject_ID'), None,
+                           '/data/experiments/' + i, None, None, login),)
+            for i in modified)
+        for num_crawled, (tree, file_rows) in enumerate(iter_concurrent(
+                lambda s: _crawl_session(s, files), records,
+                num_workers=crawl_workers), start=1):
+            # Each session is written in a single transaction along with
+            # its last-modified time, so an interrupted update is resumed
+            # from the sessions that weren't written
+            with self._conn:
+                self._write_session(tree, _last_modified(listing[tree.id]),
+                                    file_rows)
+            logger.debug("Indexed %s (%s/%s)", tree.label, num_crawled,
+                         len(modified))
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('updated', ?)",
+                (time.strftime('%Y-%m-%dT%H:%M:%S'),))
+        return IndexUpdate(len(listing), modified, removed)
+
+    def iter_subjects(self, project_id=None):
+        """
+        Iterates over the indexed subjects as `SubjectRecord` records (as
+        per `iter_subjects`)
+        """
+        self._check_project(project_id)
+        for subject_id, label in self._conn.execute(
+                "SELECT id, label FROM subjects ORDER BY label"):
+            yield SubjectRecord(subject_id, label, self.project,
+                                '/data/subjects/' + subject_id, None)
+
+    def iter_sessions(self, project_id=None, subject_id=None):
+        """
+        Iterates over the indexed sessions (in a subject) as `SessionRecord`
+        records, which unlike the records listed from the server (see
+        `iter_sessions`) include their scans and resources
+        """
+        self._check_project(project_id)
+        if subject_id is not None:
+            subject_ids = [r[0] for r in self._conn.execute(
+                "SELECT id FROM subjects WHERE id=? OR label=?",
+                (subject_id, subject_id))]
+            if not subject_ids:
+                raise XnatUtilsLookupError(subject_id)
+            where = " WHERE subject_id=?"
+            params = subject_ids[:1]
+        else:
+            where = ""
+            params = []
+        # The scans and resources of all sessions are loaded with one query
+        # each, instead of one per session
+        resources = {}
+        for row in self._conn.execute(
+                "SELECT session_id, scan_id, id, label, format, file_count, "
+                "file_size, uri FROM resources ORDER BY rowid"):
+            session_id, scan_id, resource_id, label = row[:4]
+            resources.setdefault((session_id, scan_id), OrderedDict())[
+                label] = ResourceRecord(resource_id, label, row[4], row[5],
+                                        row[6], row[7], None)
+        scans = {}
+        for session_id, scan_id, scan_type in self._conn.execute(
+                "SELECT session_id, id, type FROM scans ORDER BY rowid"):
+            scans.setdefault(session_id, OrderedDict())[scan_id] = ScanRecord(
+                scan_id, scan_type,
+                '/data/experiments/{}/scans/{}'.format(session_id, scan_id),
+                resources.get((session_id, scan_id), OrderedDict()), None)
+        for session_id, label, subj_id, date in self._conn.execute(
+                "SELECT id, label, subject_id, date FROM sessions" + where +
+                " ORDER BY label", params):
+            yield SessionRecord(
+                session_id, label, self.project, subj_id, _parse_date(date),
+                '/data/experiments/' + session_id,
+                scans.get(session_id, OrderedDict()),
+                resources.get((session_id, None), OrderedDict()), None)
+
+    def _check_project(self, project_id):
+        if project_id is not None and project_id != self.project:
+            raise XnatUtilsLookupError(project_id)
+
+    def _get_meta(self, key):
+        rows = self._conn.execute("SELECT value FROM meta WHERE key=?",
+                                  (key,)).fetchall()
+        return rows[0][0] if rows else None
+
+    def _delete_session(self, session_id):
+        for table, column in (('sessions', 'id'), ('scans', 'session_id'),
+                              ('resources', 'session_id'),
+                              ('files', 'session_id')):
+            self._conn.execute(
+                "DELETE FROM {} WHERE {}=?".format(table, column),
+                (session_id,))
+
+    def _write_session(self, tree, last_modified, file_rows):
+        self._delete_session(tree.id)
+        self._conn.execute(
+            "INSERT INTO sessions VALUES (?, ?, ?, ?, ?)",
+            (tree.id, tree.label, tree.subject_id,
+             tree.date.strftime('%Y-%m-%d') if tree.date else None,
+             last_modified))
+        self._conn.executemany(
+            "INSERT INTO scans VALUES (?, ?, ?)",
+            ((tree.id, s.id, s.type) for s in tree.scans.values()))
+        self._conn.executemany(
+            "INSERT INTO resources VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((r.uri, tree.id, scan_id, r.id, r.label, r.format,
+              r.file_count, r.file_size)
+             for scan_id, r in _iter_tree_resources(tree)))
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+            ((uri, tree.id, name, size, digest)
+             for uri, name, size, digest in file_rows))
+
+
+def _crawl_session(session, files):
+    """
+    Retrieves the tree of a session and (optionally) the names, sizes and
+    digests of the files in each of its resources
+    """
+    tree = fetch_session_tree(session)
+    file_rows = []
+    if files:
+        for _, resource in _iter_tree_resources(tree):
+            for row in iter_table(tree.xnat_session, resource.uri + '/files'):
+                size = row.get('Size')
+                file_rows.append((resource.uri, row['Name'],
+                                  int(size) if size else None,
+                                  row.get('digest') or None))
+    return tree, file_rows
+
+
+def _iter_tree_resources(tree):
+    "Iterates over the session-level and scan resources in a session tree"
+    for resource in tree.resources.values():
+        yield None, resource
+    for scan in tree.scans.values():
+        for resource in scan.resources.values():
+            yield scan.id, resource
+
+
+def _last_modified(row):
+    # Fall back to the time the session was inserted if the server doesn't
+    # report when it was last modified
+    return row.get('last_modified') or row.get('insert_date') or None
+
+
+description = """
+Crawls a project into a local SQLite index of its subjects, sessions, scans
+and resources (and the names, sizes and digests of their files), e.g.
+
+    $ xnat-index build -p MRH017
+
+which 'xnat-ls' can then query offline with the '--index' option, e.g.
+
+    $ xnat-ls -p MRH017 -d session --with_scans 't1.*' 'ep2d_diff.*' \\
+        --without_scans '.*flair.*' --after 2022-01-01 --index
+
+'update' only crawls the sessions that have been added or modified since the
+index was last updated (and drops the ones removed from the server), while
+'build' discards the existing index and crawls the whole project again. The
+index is saved in ~/.xnatutils/index (or $XNATUTILS_CACHE/index) unless a
+path is provided with '--index'.
+"""
+
+ACTIONS = ('build', 'update')
+
+
+def parser():
+    parser = base_parser(description)
+    parser.add_argument('action', type=str, choices=ACTIONS,
+                        help=("Whether to build the index from scratch or "
+                              "update it incrementally"))
+    parser.add_argument('--project', '-p', type=str, required=True,
+                        help="The ID of the project to index")
+    parser.add_argument('--index', type=str, default=None,
+                        help=("Path to the index, defaults to "
+                              "<project>.sqlite in ~/.xnatutils/index"))
+    parser.add_argument('--no_files', action='store_true', default=False,
+                        help=("Don't index the names, sizes and digests of "
+                              "the files in each resource (which takes an "
+                              "additional request per resource)"))
+    parser.add_argument('--crawl_workers', type=int,
+                        default=DEFAULT_CRAWL_WORKERS,
+                        help="The number of sessions to crawl concurrently")
+    add_default_args(parser)
+    return parser
+
+
+def cmd(argv=sys.argv[1:]):
+
+    args = parser().parse_args(argv)
+
+    set_logger(args.loglevel)
+
+    try:
+        result = update_index(
+            args.project, index_path=args.index,
+            rebuild=(args.action == 'build'), files=(not args.no_files),
+            crawl_workers=args.crawl_workers, user=args.user,
+            server=args.server, use_netrc=(not args.no_netrc),
+            cache_session=(not args.no_netrc))
+    except XnatUtilsUsageError as e:
+        print_usage_error(e)
+    except XNATResponseError as e:
+        print_response_error(e)
+    except XnatUtilsException as e:
+        print_info_message(e)
+    else:
+        print("Indexed {} session(s) in {} ({} crawled, {} removed)".format(
+            result.num_sessions, args.project, len(result.crawled),
+            len(result.removed)))
@@ -3,9 +3,11 @@ import sys
 from operator import attrgetter
 import logging
 from .base import (
-    connect, is_regex, matching_subjects, matching_sessions,
-    base_parser, add_default_args, print_response_error, print_usage_error,
-    print_info_message, set_logger)
+    connect, is_regex, matching_subjects, matching_sessions, matching_scans,
+    iter_projects, parse_dicom_filters, prefetch_session_trees, base_parser,
+    add_default_args, print_response_error, print_usage_error,
+    print_info_message, set_logger, ProjectRecord, DEFAULT_CRAWL_WORKERS)
+from .index_ import ProjectIndex
 from xnat.exceptions import XNATResponseError
 from .exceptions import XnatUtilsUsageError, XnatUtilsException
 
@@ -14,7 +16,8 @@ logger = logging.getLogger('xnat-utils')
 
 def ls(xnat_id=(), datatype=None, with_scans=None, without_scans=None,
        return_attr=None, before=None, after=None, project_id=None,
-       subject_id=None, **kwargs):
+       subject_id=None, crawl_workers=DEFAULT_CRAWL_WORKERS, index=None,
+       dicom_filters=None, **kwargs):
     """
     Displays available projects, subjects, sessions and scans from an XNAT instance.
 
@@ -70,7 +73,9 @@ def ls(xnat_id=(), datatype=None, with_scans=None, without_scans=None,
         The attribute name to return for each matching item. If None
         defaults to 'label' for subjects and sessions, 'id' for projects
         and 'type' for scans. If False, then the XnatPy object is returned
-        instead
+        instead. The items are listed as lightweight records (e.g.
+        `SessionRecord`), which are only promoted to XnatPy objects if the
+        attribute isn't in the record or False is passed
     before : str
         Only select sessions before this date in %Y-%m-%d format
         (e.g. 2018-02-27)
@@ -82,6 +87,19 @@ def ls(xnat_id=(), datatype=None, with_scans=None, without_scans=None,
     subject_id : str | None
         The ID of the subject to list the sessions/scans. Requires that
         project ID is also supplied.
+    crawl_workers : int
+        The number of sessions to retrieve the scan listings of concurrently
+    index : bool | str | None
+        Whether to list from the local index of the project built by
+        `update_index` instead of the server, either the default index of
+        the project (if True) or the index at the given path. Only
+        attributes stored in the index can be returned
+    dicom_filters : dict(str, str) | list(str) | None
+        Regexes with which to match fields of the DICOM headers of the scans
+        listed, keyed by the DICOM keyword or tag of the field or given as
+        'field=regex' strings (e.g. 'SeriesDescription=.*MPRAGE.*'). The
+        headers are retrieved from the server's DICOM dump service (only
+        applicable with datatype='scan' and not with an index)
     user : str
         The user to connect to the server with
     loglevel : str
@@ -157,36 +175,103 @@ def ls(xnat_id=(), datatype=None, with_scans=None, without_scans=None,
             raise XnatUtilsUsageError(msg.format('before'))
         if after is not None:
             raise XnatUtilsUsageError(msg.format('after'))
+    if dicom_filters:
+        if datatype != 'scan':
+            raise XnatUtilsUsageError(
+                "'dicom_filters' option is only applicable when "
+                "datatype='scan'")
+        if index:
+            raise XnatUtilsUsageError(
+                "DICOM headers aren't stored in the index so 'dicom_filters' "
+                "can't be used when listing from an index")
+        parse_dicom_filters(dicom_filters)
 
+    if index:
+        if return_attr is False:
+            raise XnatUtilsUsageError(
+                "XnatPy objects can't be returned when listing from an index")
+        if project_id is None or isinstance(project_id, basestring):
+            index_project = project_id
+        elif len(project_id) == 1:
+            index_project = project_id[0]
+        else:
+            raise XnatUtilsUsageError(
+                "Can only list from the index of a single project at a time "
+                "('{}')".format("', '".join(project_id)))
+        with ProjectIndex.open(
+                index_project, path=(index if isinstance(index, basestring)
+                                     else None)) as project_index:
+            return _ls(None, datatype, xnat_id, with_scans, without_scans,
+                       return_attr, before, after,
+                       (project_id if project_id is not None
+                        else project_index.project), subject_id,
+                       crawl_workers, project_index, None)
     with connect(**kwargs) as login:
-        if datatype == 'project':
-            matches = sorted(login.projects.values(),
-                             key=attrgetter('id'))
-            return_attr = 'id' if return_attr is None else return_attr
-        elif datatype == 'subject':
-            matches = matching_subjects(login, xnat_id, project_id=project_id)
-            return_attr = 'label' if return_attr is None else return_attr
-        elif datatype == 'session':
-            matches = matching_sessions(
-                login, xnat_id, with_scans=with_scans,
-                without_scans=without_scans, project_id=project_id,
-                subject_id=subject_id, before=before, after=after)
-            return_attr = 'label' if return_attr is None else return_attr
-        elif datatype == 'scan':
-            matches = set()
-            for session in matching_sessions(login, xnat_id,
-                                             project_id=project_id,
-                                             subject_id=subject_id):
-                matches |= set(session.scans.values())
-            return_attr = 'type' if return_attr is None else return_attr
+        return _ls(login, datatype, xnat_id, with_scans, without_scans,
+                   return_attr, before, after, project_id, subject_id,
+                   crawl_workers, None, dicom_filters)
+
+
+def _ls(login, datatype, xnat_id, with_scans, without_scans, return_attr,
+        before, after, project_id, subject_id, crawl_workers, index,
+        dicom_filters):
+    if datatype == 'project':
+        if index is not None:
+            matches = [ProjectRecord(index.project, None,
+                                     '/data/projects/' + index.project,
+                                     None)]
         else:
-            assert False
-        if return_attr:
-            matches = sorted(getattr(m, return_attr) for m in matches
-                             if getattr(m, return_attr) is not None)
+            matches = sorted(iter_projects(login), key=attrgetter('id'))
+        return_attr = 'id' if return_attr is None else return_attr
+    elif datatype == 'subject':
+        matches = matching_subjects(login, xnat_id, project_id=project_id,
+                                    index=index)
+        return_attr = 'label' if return_attr is None else return_attr
+    elif datatype == 'session':
+        matches = matching_sessions(
+            login, xnat_id, with_scans=with_scans,
+            without_scans=without_scans, project_id=project_id,
+            subject_id=subject_id, before=before, after=after,
+            crawl_workers=crawl_workers, index=index)
+        return_attr = 'label' if return_attr is None else return_attr
+    elif datatype == 'scan':
+        matches = []
+        sessions = matching_sessions(login, xnat_id, project_id=project_id,
+                                     subject_id=subject_id, index=index)
+        if index is None:
+            sessions = prefetch_session_trees(sessions,
+                                              num_workers=crawl_workers)
+        for session in sessions:
+            if dicom_filters:
+                matches.extend(matching_scans(session, None,
+                                              dicom_filters=dicom_filters))
+            else:
+                matches.extend(session.scans.values())
+        return_attr = 'type' if return_attr is None else return_attr
+    else:
+        assert False
+    if return_attr:
+        values = (_get_attr(m, return_attr) for m in matches)
+        matches = sorted(v for v in values if v is not None)
+    elif return_attr is False:
+        matches = [m.promote() for m in matches]
     return matches
 
 
+def _get_attr(record, attr):
+    """
+    Gets an attribute of a record, promoting it to the full XnatPy object if
+    the attribute isn't in the record
+    """
+    try:
+        return getattr(record, attr)
+    except AttributeError:
+        if record.xnat_session is None:
+            raise XnatUtilsUsageError(
+                "'{}' isn't stored in the index".format(attr))
+        return getattr(record.promote(), attr)
+
+
 description = """
 Displays available projects, subjects, sessions and scans from an XNAT instance.
 
@@ -265,6 +350,21 @@ def parser():
     parser.add_argument('--after', '-a', default=None, type=str,
                         help=("Only select sessions after this date "
                               "(in Y-m-d format, e.g. 2018-02-27)"))
+    parser.add_argument('--crawl_workers', type=int,
+                        default=DEFAULT_CRAWL_WORKERS,
+                        help=("The number of sessions to retrieve the "
+                              "metadata of concurrently"))
+    parser.add_argument('--index', type=str, nargs='?', const=True,
+                        default=None, metavar='PATH',
+                        help=("List from the local index of the project "
+                              "built by 'xnat-index' instead of the server "
+                              "(at PATH if provided)"))
+    parser.add_argument('--dicom', type=str, nargs='+', default=None,
+                        metavar='FIELD=REGEX',
+                        help=("Only list scans whose DICOM header fields "
+                              "(given by keyword or tag, e.g. "
+                              "SeriesDescription or 0008,103E) match the "
+                              "regular expressions"))
     add_default_args(parser)
     return parser
 
@@ -283,7 +383,10 @@ def cmd(argv=sys.argv[1:]):
                            subject_id=args.subject,
                            return_attr=args.return_attr, before=args.before,
                            after=args.after,
-                           use_netrc=(not args.no_netrc))))
+                           crawl_workers=args.crawl_workers,
+                           index=args.index, dicom_filters=args.dicom,
+                           use_netrc=(not args.no_netrc),
+                           cache_session=(not args.no_netrc))))
     except XnatUtilsUsageError as e:
         print_usage_error(e)
     except XNATResponseError as e:
@@ -0,0 +1,132 @@
+import sys
+import json
+import logging
+from .base import (
+    base_parser, print_usage_error, print_info_message, set_logger)
+from .exceptions import XnatUtilsUsageError, XnatUtilsException
+
+logger = logging.getLogger('xnat-utils')
+
+
+def merge_manifests(manifest_paths, output=None):
+    """
+    Merges the manifests saved by separate shards of a sharded `get` call
+    (i.e. using the 'shard' and 'manifest' kwargs) into a single manifest,
+    checking that all shards are present and no session has been downloaded
+    by more than one shard.
+
+        >>> xnatutils.merge_manifests(glob('/scratch/MRH017-*.json'),
+                                      output='/scratch/MRH017.json')
+
+    Parameters
+    ----------
+    manifest_paths : list(str)
+        Paths to the manifests saved by each shard
+    output : str | None
+        Path to save the merged manifest to
+
+    Returns
+    -------
+    merged : dict
+        The merged manifest, with the additional keys 'shards' (the indices
+        of the merged shards), 'missing_shards' and 'duplicates' (sessions
+        matched by more than one shard)
+    """
+    if not manifest_paths:
+        raise XnatUtilsUsageError("No manifests provided to merge")
+    num_shards = None
+    shards = []
+    matched = {}
+    sessions = {}
+    duplicates = set()
+    for path in manifest_paths:
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError) as e:
+            raise XnatUtilsUsageError(
+                "Could not read manifest '{}' ({})".format(path, e))
+        if manifest['shard'] is not None:
+            index, count = manifest['shard']
+            if num_shards is None:
+                num_shards = count
+            elif count != num_shards:
+                raise XnatUtilsUsageError(
+                    "Manifest '{}' was generated by a shard of {} not {} "
+                    "shards".format(path, count, num_shards))
+            if index in shards:
+                logger.warning("Shard %s/%s is included more than once "
+                               "('%s')", index, count, path)
+            shards.append(index)
+        for label in manifest['matched']:
+            if label in matched and matched[label] != path:
+                duplicates.add(label)
+            matched[label] = path
+        for label, resources in manifest['sessions'].items():
+            sessions.setdefault(label, [])
+            sessions[label].extend(r for r in resources
+                                   if r not in sessions[label])
+    if num_shards is not None:
+        missing_shards = sorted(set(range(num_shards)) - set(shards))
+    else:
+        missing_shards = []
+    merged = {'shards': sorted(set(shards)),
+              'num_shards': num_shards,
+              'missing_shards': missing_shards,
+              'duplicates': sorted(duplicates),
+              'matched': sorted(matched),
+              'sessions': sessions}
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(merged, f, indent=2)
+    return merged
+
+
+description = """
+Merges the JSON manifests saved by the shards of a sharded 'xnat-get'
+download (i.e. using the '--shard' and '--manifest' options) and prints a
+summary of the combined results, e.g.
+
+    $ xnat-merge-manifests /scratch/MRH017-*.json --output MRH017.json
+
+Missing shards and sessions that were matched by more than one shard are
+reported.
+"""
+
+
+def parser():
+    parser = base_parser(description)
+    parser.add_argument('manifests', type=str, nargs='+',
+                        help="The manifests saved by each shard")
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help="Path to save the merged manifest to")
+    parser.add_argument('--loglevel', type=int, default=logging.INFO,
+                        help="The logging level to use")
+    return parser
+
+
+def cmd(argv=sys.argv[1:]):
+
+    args = parser().parse_args(argv)
+
+    set_logger(args.loglevel)
+
+    try:
+        merged = merge_manifests(args.manifests, output=args.output)
+    except XnatUtilsUsageError as e:
+        print_usage_error(e)
+    except XnatUtilsException as e:
+        print_info_message(e)
+    else:
+        num_resources = sum(len(r) for r in merged['sessions'].values())
+        print("Merged {} manifest(s): {} session(s) matched, {} resource(s) "
+              "downloaded from {} session(s)".format(
+                  len(args.manifests), len(merged['matched']), num_resources,
+                  len(merged['sessions'])))
+        if merged['missing_shards']:
+            print("Missing shard(s) {} of {}".format(
+                ', '.join(str(i) for i in merged['missing_shards']),
+                merged['num_shards']))
+        if merged['duplicates']:
+            print("Session(s) matched by more than one shard:\n{}".format(
+                '\n'.join(merged['duplicates'])))
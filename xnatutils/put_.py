@@ -1,17 +1,43 @@
+from past.builtins import basestring
 import sys
 import os.path
+import csv
+import time
+import shutil
+import logging
+import zlib
 import hashlib
+import threading
+import multiprocessing
+from collections import namedtuple, OrderedDict
+from operator import attrgetter
+from concurrent.futures import ThreadPoolExecutor
 from xnat.exceptions import XNATResponseError
 from .base import (
     sanitize_re, illegal_scan_chars_re, get_resource_name,
     session_modality_re, connect, base_parser, add_default_args,
-    print_response_error, print_usage_error, print_info_message, set_logger)
+    print_response_error, print_usage_error, print_info_message, set_logger,
+    calculate_checksums, iter_concurrent, interleave,
+    TransferScheduler, BandwidthLimiter, DEFAULT_MAX_RETRIES, _list_files)
 from .exceptions import (
-    XnatUtilsUsageError, XnatUtilsError, XnatUtilsDigestCheckFailedError,
-    XnatUtilsDigestCheckError, XnatUtilsException,
+    XnatUtilsUsageError, XnatUtilsDigestCheckError, XnatUtilsException,
     XnatUtilsNoMatchingSessionsException)
 
-HASH_CHUNK_SIZE = 2 ** 20
+logger = logging.getLogger('xnat-utils')
+
+# The resources that uncompressed uploads are stored in when compressed on the
+# fly
+compressed_resources = {'NIFTI': 'NIFTI_GZ', 'MRTRIX': 'MRTRIX_GZ'}
+
+UPLOAD_CHUNK_SIZE = 2 ** 20
+
+GZIP_LEVEL = 6
+
+# Resource names guessed from the extensions of DICOM files
+dicom_resource_names = ('DCM', 'IMA', '')
+
+# The directory within a watched directory that uploaded series are moved to
+UPLOADED_DIR = '.uploaded'
 
 
 def put(session, scan, *filenames, **kwargs):
@@ -43,9 +69,26 @@ def put(session, scan, *filenames, **kwargs):
         Name for the dataset on XNAT
     filenames : list(str)
         Filenames of the dataset(s) to upload to XNAT or a directory containing
-        the datasets.
+        the datasets. Alternatively, a single file-like object (opened in
+        binary mode) or '-' to read the dataset from stdin, which is streamed
+        to the server without being written to disk (requires 'name')
+    name : str
+        The filename to store a dataset read from a file-like object or stdin
+        as. Also used to determine the resource name if not provided
     overwrite : bool
         Allow overwrite of existing dataset
+    resume : bool
+        Upload only the files that are missing from the resource or whose
+        digests don't match the digests of the local files, e.g. to resume
+        an interrupted upload. Only the uploaded files are verified
+    sync : bool
+        As for 'resume' but also delete files in the resource that aren't
+        present locally
+    compress : bool
+        Gzip NIFTI and MRTRIX files (that aren't already gzipped) as they are
+        uploaded, appending '.gz' to their names and storing them in
+        NIFTI_GZ and MRTRIX_GZ resources respectively. Files uploaded to
+        other resources (e.g. DICOM) aren't compressed
     create_session : bool
         Create the required session on XNAT to upload the the dataset to
     resource_name : str
@@ -59,6 +102,15 @@ def put(session, scan, *filenames, **kwargs):
         The ID of the subject to upload the dataset to
     scan_id : str
         The ID for the scan (defaults to the scan type)
+    max_retries : int
+        The number of times to retry requests and uploads that fail with a
+        transient error (e.g. a 502/503 status while the server is under
+        load). Failed uploads are resumed (see 'resume') unless 'overwrite'
+        is set, in which case the resource is uploaded again. Uploads from
+        file-like objects and stdin aren't retried
+    max_bandwidth : str | float | None
+        The maximum bandwidth of the upload in bytes per second, optionally
+        with a 'K', 'M' or 'G' suffix (e.g. '50M')
     user : str
         The user to connect to the server with
     loglevel : str
@@ -87,11 +139,471 @@ def put(session, scan, *filenames, **kwargs):
     project_id = kwargs.pop('project_id', None)
     subject_id = kwargs.pop('subject_id', None)
     scan_id = kwargs.pop('scan_id', None)
+    resume = kwargs.pop('resume', False)
+    sync = kwargs.pop('sync', False)
+    compress = kwargs.pop('compress', False)
+    name = kwargs.pop('name', None)
+    max_retries = kwargs.pop('max_retries', DEFAULT_MAX_RETRIES)
+    limiter = _bandwidth_limiter(kwargs.pop('max_bandwidth', None))
+    _check_resume_args(overwrite, resume, sync)
+    filenames, resource_name = _check_upload_args(
+        session, scan, filenames, resource_name, compress=compress,
+        name=name)
+    scheduler = TransferScheduler(1, max_retries=max_retries)
+    with connect(max_retries=max_retries, **kwargs) as login:
+        _run_upload(scheduler, login, session, scan, filenames,
+                    resource_name, overwrite=overwrite,
+                    create_session=create_session, project_id=project_id,
+                    subject_id=subject_id, scan_id=scan_id, resume=resume,
+                    sync=sync, compress=compress, limiter=limiter)
+
+
+def put_many(rows, num_workers=1, **kwargs):
+    """
+    Uploads datasets to many sessions/scans over a single connection, e.g.
+    to upload derived outputs for a whole study. Each row is uploaded as per
+    `put`, with rows uploaded concurrently if 'num_workers' > 1. Failures
+    are recorded in the returned status table instead of interrupting the
+    remaining uploads.
+
+        >>> xnatutils.put_many(
+                [{'session': 'TEST001_001_MR01', 'scan': 'a_dataset',
+                  'paths': ['test.nii.gz']},
+                 {'session': 'TEST001_002_MR01', 'scan': 'a_dataset',
+                  'paths': ['test2.nii.gz']}],
+                create_session=True, num_workers=4)
+
+    Parameters
+    ----------
+    rows : list(dict) | str
+        The uploads to make, each a dict with the keys 'session', 'scan' and
+        'paths' (a list of filenames or a single directory) and optionally
+        'resource', 'project_id', 'subject_id' and 'scan_id', which override
+        the corresponding kwargs for the row. Alternatively, the path to a
+        CSV manifest with a column for each key, in which multiple paths are
+        separated by ';'
+    num_workers : int
+        The number of rows to upload concurrently
+    overwrite : bool
+        Allow overwrite of existing datasets
+    resume : bool
+        Only upload files missing from the resources (see `put`)
+    sync : bool
+        Only upload files missing from the resources and delete remote files
+        that aren't present locally (see `put`)
+    compress : bool
+        Gzip the files as they are uploaded (see `put`)
+    create_session : bool
+        Create the required sessions (and subjects) on XNAT to upload the
+        datasets to
+    resource_name : str
+        The default name of the resource to upload the datasets to
+    project_id : str
+        The default ID of the project to create sessions in
+    subject_id : str
+        The default ID of the subject to create sessions in
+    max_retries : int
+        The number of times to retry uploads that fail with a transient
+        error (see `put`). The number of concurrent uploads is also reduced
+        below 'num_workers' while the server is struggling (see
+        `TransferScheduler`)
+    max_bandwidth : str | float | None
+        The maximum combined bandwidth of the uploads (see `put`), which is
+        shared evenly between the concurrent uploads. The rows are also
+        interleaved across sessions so that sessions with few rows aren't
+        held up behind sessions with many
+    user : str
+        The user to connect to the server with
+    loglevel : str
+        The logging level to display. In order of increasing verbosity
+        ERROR, WARNING, INFO, DEBUG.
+    connection : xnat.Session
+        An existing XnatPy session that is to be reused instead of
+        creating a new session.
+    server : str | int | None
+        URI of the XNAT server to connect to. If not provided connect
+        will look inside the ~/.netrc file to get a list of saved
+        servers.
+    use_netrc : bool
+        Whether to load and save user credentials from netrc file
+        located at $HOME/.netrc
+
+    Returns
+    -------
+    statuses : list(UploadStatus)
+        The status of the upload of each row, in the order of the rows
+    """
+    overwrite = kwargs.pop('overwrite', False)
+    create_session = kwargs.pop('create_session', False)
+    resource_name = kwargs.pop('resource_name', None)
+    project_id = kwargs.pop('project_id', None)
+    subject_id = kwargs.pop('subject_id', None)
+    resume = kwargs.pop('resume', False)
+    sync = kwargs.pop('sync', False)
+    compress = kwargs.pop('compress', False)
+    max_retries = kwargs.pop('max_retries', DEFAULT_MAX_RETRIES)
+    limiter = _bandwidth_limiter(kwargs.pop('max_bandwidth', None))
+    _check_resume_args(overwrite, resume, sync)
+    if isinstance(rows, basestring):
+        rows = read_manifest(rows)
+    # Check all rows before connecting so that usage errors are raised
+    # before anything is uploaded
+    uploads = OrderedDict()
+    for i, row in enumerate(rows):
+        paths = row['paths']
+        if isinstance(paths, basestring):
+            paths = [paths]
+        filenames, row_resource = _check_upload_args(
+            row['session'], row['scan'], paths,
+            row.get('resource') or resource_name, compress=compress)
+        uploads.setdefault(row['session'], []).append(
+            (i, row, filenames, row_resource))
+    creation_lock = threading.Lock()
+    sessions = {}
+    scheduler = TransferScheduler(num_workers, max_retries=max_retries)
+
+    def upload(i, row, filenames, row_resource):
+        try:
+            _run_upload(scheduler, login, row['session'], row['scan'],
+                        filenames, row_resource, overwrite=overwrite,
+                        create_session=create_session,
+                        project_id=row.get('project_id') or project_id,
+                        subject_id=row.get('subject_id') or subject_id,
+                        scan_id=row.get('scan_id') or None, resume=resume,
+                        sync=sync, compress=compress, limiter=limiter,
+                        creation_lock=creation_lock, sessions=sessions)
+        except (XnatUtilsException, XNATResponseError, IOError) as e:
+            status, message = 'failed', str(e)
+        except Exception as e:
+            # Unexpected errors only fail the row they were raised by
+            logger.debug("Error uploading row %s", i, exc_info=True)
+            status, message = 'failed', '{}: {}'.format(type(e).__name__, e)
+        else:
+            status, message = 'uploaded', ''
+        return UploadStatus(i, row['session'], row['scan'], row_resource,
+                            len(filenames), status, message)
+
+    with connect(max_retries=max_retries, **kwargs) as login:
+        scheduler.attach(login)
+        try:
+            statuses = list(iter_concurrent(
+                upload, interleave(uploads.values()),
+                num_workers=num_workers))
+        finally:
+            scheduler.detach(login)
+    return sorted(statuses, key=attrgetter('row'))
+
+
+class UploadStatus(namedtuple('UploadStatus', (
+        'row', 'session', 'scan', 'resource', 'num_files', 'status',
+        'message'))):
+    """
+    The status of the upload of a row passed to `put_many`
+
+    Parameters
+    ----------
+    row : int | str
+        The index of the row (or the path of the series directory for
+        `watch_put`)
+    session : str
+        The session the row was uploaded to
+    scan : str
+        The scan the row was uploaded to
+    resource : str
+        The resource the row was uploaded to
+    num_files : int
+        The number of files uploaded
+    status : str
+        Either 'uploaded' or 'failed'
+    message : str
+        The error message if the upload failed
+    """
+    __slots__ = ()
+
+
+def read_manifest(path):
+    """
+    Reads a CSV manifest of uploads for `put_many`, which should have the
+    columns 'session', 'scan' and 'paths' (multiple paths separated by ';'),
+    and optionally 'resource', 'project_id', 'subject_id' and 'scan_id'
+    """
+    with open(path) as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        missing = [c for c in ('session', 'scan', 'paths') if not row.get(c)]
+        if missing:
+            raise XnatUtilsUsageError(
+                "Missing value(s) for '{}' in row {} of manifest '{}'".format(
+                    "', '".join(missing), rows.index(row) + 1, path))
+        row['paths'] = [p.strip() for p in row['paths'].split(';')
+                        if p.strip()]
+    return rows
+
+
+def watch_put(watch_dir, interval=10, quiescence=60, num_workers=1,
+              max_in_flight=None, max_polls=None, delete_uploaded=False,
+              **kwargs):
+    """
+    Watches a directory that series are exported into and uploads each
+    series once it has been completely written, yielding an `UploadStatus`
+    for each series as its upload finishes, e.g.
+
+        >>> for status in xnatutils.watch_put('/export', create_session=True):
+        ...     print(status)
+
+    Series are expected to be written to '<watch_dir>/<session>/<scan>/'
+    and are considered complete once none of their files have been modified
+    for 'quiescence' seconds. All files in a series are uploaded to a single
+    resource (as per `put` with 'resume', so a failed upload can be retried
+    without re-sending files that were uploaded) and then moved into
+    '<watch_dir>/.uploaded' (or deleted if 'delete_uploaded' is set). Series
+    that fail to upload are left in place and retried once they are
+    modified.
+
+    Parameters
+    ----------
+    watch_dir : str
+        The directory to watch
+    interval : float
+        The number of seconds between scans of the directory
+    quiescence : float
+        The number of seconds a series must be unmodified for before it is
+        uploaded
+    num_workers : int
+        The number of series to upload concurrently
+    max_in_flight : int | None
+        The maximum number of series queued for upload at a time (defaults
+        to twice 'num_workers'), so that bursts of exports don't overwhelm
+        the server. Further series are picked up once the queue has drained
+    max_polls : int | None
+        The number of times to scan the directory before returning (after
+        the uploads in progress have finished). If None, watches until
+        interrupted
+    delete_uploaded : bool
+        Delete series once they have been uploaded instead of moving them
+    resource_name : str
+        The name of the resource to upload the series to. If not provided it
+        is determined from the file extensions ('DICOM' for '.dcm' and
+        '.ima' files)
+
+    The 'create_session', 'project_id', 'subject_id', 'compress',
+    'max_retries' and 'max_bandwidth' kwargs are used as per `put` and other
+    kwargs are passed to `connect`
+    """
+    resource_name = kwargs.pop('resource_name', None)
+    create_session = kwargs.pop('create_session', False)
+    project_id = kwargs.pop('project_id', None)
+    subject_id = kwargs.pop('subject_id', None)
+    compress = kwargs.pop('compress', False)
+    max_retries = kwargs.pop('max_retries', DEFAULT_MAX_RETRIES)
+    limiter = _bandwidth_limiter(kwargs.pop('max_bandwidth', None))
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+    if not os.path.isdir(watch_dir):
+        raise XnatUtilsUsageError(
+            "Directory to watch, '{}', does not exist".format(watch_dir))
+    creation_lock = threading.Lock()
+    sessions = {}
+    signatures = {}
+    failed = {}
+    in_flight = {}
+    num_polls = 0
+    scheduler = TransferScheduler(num_workers, max_retries=max_retries)
+
+    def upload(series_dir, session, scan):
+        filenames = []
+        series_resource = resource_name
+        try:
+            filenames = sorted(
+                os.path.join(series_dir, f) for f in os.listdir(series_dir)
+                if not f.startswith('.') and
+                os.path.isfile(os.path.join(series_dir, f)))
+            if series_resource is None:
+                series_resource = _series_resource_name(filenames)
+            filenames, series_resource = _check_upload_args(
+                session, scan, filenames, series_resource, compress=compress)
+            _run_upload(scheduler, login, session, scan, filenames,
+                        series_resource, create_session=create_session,
+                        project_id=project_id, subject_id=subject_id,
+                        resume=True, compress=compress, limiter=limiter,
+                        creation_lock=creation_lock, sessions=sessions)
+        except (XnatUtilsException, XNATResponseError, IOError) as e:
+            return UploadStatus(series_dir, session, scan, series_resource,
+                                len(filenames), 'failed', str(e))
+        try:
+            _remove_uploaded(watch_dir, series_dir, session, scan,
+                             delete_uploaded)
+        except OSError as e:
+            # E.g. the scanner is still writing to the series
+            return UploadStatus(
+                series_dir, session, scan, series_resource, len(filenames),
+                'failed', "Uploaded but could not be removed from the watch "
+                "folder ({})".format(e))
+        return UploadStatus(series_dir, session, scan, series_resource,
+                            len(filenames), 'uploaded', '')
+
+    executor = ThreadPoolExecutor(max(num_workers, 1))
+    with connect(max_retries=max_retries, **kwargs) as login:
+        scheduler.attach(login)
+        try:
+            while True:
+                poll_start = time.time()
+                for future in [f for f in in_flight if f.done()]:
+                    series_dir = in_flight.pop(future)
+                    status = future.result()
+                    if status.status == 'failed':
+                        logger.error("Could not upload %s (%s)", series_dir,
+                                     status.message)
+                        failed[series_dir] = signatures.get(series_dir)
+                    else:
+                        signatures.pop(series_dir, None)
+                    yield status
+                if max_polls is not None and num_polls >= max_polls:
+                    if not in_flight:
+                        return
+                    time.sleep(min(interval, 1))
+                    continue
+                num_waiting = 0
+                for series_dir, session, scan in _list_series(watch_dir):
+                    if series_dir in in_flight.values():
+                        continue
+                    signature = _series_signature(series_dir)
+                    previous = signatures.get(series_dir)
+                    signatures[series_dir] = signature
+                    # Only upload once the files are unchanged since the
+                    # previous scan and none have been modified within the
+                    # quiescence window
+                    if (signature is None or signature != previous or
+                            not signature[0] or
+                            time.time() - signature[2] < quiescence or
+                            failed.get(series_dir) == signature):
+                        continue
+                    if len(in_flight) >= max_in_flight:
+                        num_waiting += 1
+                        continue
+                    failed.pop(series_dir, None)
+                    in_flight[executor.submit(
+                        upload, series_dir, session, scan)] = series_dir
+                logger.info("%s series uploading, %s waiting", len(in_flight),
+                            num_waiting)
+                num_polls += 1
+                time.sleep(max(0, interval - (time.time() - poll_start)))
+        finally:
+            executor.shutdown(wait=True)
+            scheduler.detach(login)
+
+
+def _list_series(watch_dir):
+    """
+    Lists the (path, session, scan) of the series directories in a watched
+    directory, i.e. '<watch_dir>/<session>/<scan>'
+    """
+    for session in sorted(os.listdir(watch_dir)):
+        session_dir = os.path.join(watch_dir, session)
+        if session.startswith('.') or not os.path.isdir(session_dir):
+            continue
+        try:
+            scans = sorted(os.listdir(session_dir))
+        except OSError:
+            continue  # The session directory was moved or deleted
+        for scan in scans:
+            series_dir = os.path.join(session_dir, scan)
+            if not scan.startswith('.') and os.path.isdir(series_dir):
+                yield series_dir, session, scan
+
+
+def _series_signature(series_dir):
+    """
+    Returns the number of files in a series directory, their total size and
+    the latest modification time of them, or None if the directory or one of
+    the files is moved or deleted while it is being scanned (in which case
+    the series isn't quiescent)
+    """
+    num_files = total_size = 0
+    latest = 0.0
+    try:
+        fnames = os.listdir(series_dir)
+    except OSError:
+        return None
+    for fname in fnames:
+        if fname.startswith('.'):
+            continue
+        try:
+            fstat = os.stat(os.path.join(series_dir, fname))
+        except OSError:
+            return None
+        num_files += 1
+        total_size += fstat.st_size
+        latest = max(latest, fstat.st_mtime)
+    return (num_files, total_size, latest)
+
+
+def _series_resource_name(filenames):
+    names = set(get_resource_name(f) for f in filenames)
+    names = set(('DICOM' if n in dicom_resource_names else n) for n in names)
+    if len(names) != 1:
+        raise XnatUtilsUsageError(
+            "Could not determine resource name from file extensions ('{}'), "
+            "please provide it explicitly".format("', '".join(sorted(names))))
+    return names.pop()
+
+
+def _remove_uploaded(watch_dir, series_dir, session, scan, delete):
+    if delete:
+        shutil.rmtree(series_dir)
+    else:
+        target = os.path.join(watch_dir, UPLOADED_DIR, session, scan)
+        if os.path.exists(target):
+            target += time.strftime('.%Y%m%d%H%M%S')
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(target)):
+                raise
+        os.rename(series_dir, target)
+    # Remove the session directory if it is now empty
+    try:
+        os.rmdir(os.path.dirname(series_dir))
+    except OSError:
+        pass
+
+
+def _check_resume_args(overwrite, resume, sync):
+    if overwrite and (resume or sync):
+        raise XnatUtilsUsageError(
+            "'overwrite' cannot be used with 'resume' or 'sync'")
+
+
+def _check_upload_args(session, scan, filenames, resource_name,
+                       compress=False, name=None):
+    """
+    Checks the arguments of an upload, expanding a directory into the files
+    within it, wrapping a file-like object or '-' (stdin) in a `StreamSource`
+    and determining the resource name from the file extension if not
+    provided (mapping it to the compressed format if 'compress' is set)
+    """
     # If a single directory is provided, upload all files in it that
     # don't start with '.'
     if len(filenames) == 1 and isinstance(filenames[0], (list, tuple)):
         filenames = filenames[0]
-    if len(filenames) == 1 and os.path.isdir(filenames[0]):
+    if any(_is_stream(f) for f in filenames):
+        if len(filenames) != 1:
+            raise XnatUtilsUsageError(
+                "Only a single file-like object or '-' (stdin) can be "
+                "uploaded at a time")
+        if name is None:
+            raise XnatUtilsUsageError(
+                "A filename to store the uploaded stream as must be provided "
+                "via 'name' when uploading from a file-like object or stdin")
+        fileobj = filenames[0]
+        if fileobj == '-':
+            fileobj = getattr(sys.stdin, 'buffer', sys.stdin)
+        filenames = [StreamSource(name, fileobj)]
+    elif name is not None:
+        raise XnatUtilsUsageError(
+            "'name' can only be provided when uploading from a file-like "
+            "object or stdin")
+    elif len(filenames) == 1 and os.path.isdir(filenames[0]):
         base_dir = filenames[0]
         filenames = [
             os.path.join(base_dir, f) for f in os.listdir(base_dir)
@@ -116,123 +628,336 @@ def put(session, scan, *filenames, **kwargs):
 
     if resource_name is None:
         if len(filenames) == 1:
-            resource_name = get_resource_name(filenames[0])
+            resource_name = get_resource_name(_source_name(filenames[0]))
         else:
             raise XnatUtilsUsageError(
                 "'resource_name' option needs to be provided when uploading "
                 "multiple files")
     else:
         resource_name = resource_name.upper()
-    with connect(**kwargs) as login:
-        match = session_modality_re.match(session)
-        if match is None or match.group(1) == 'MR':
-            session_cls = login.classes.MrSessionData
-            scan_cls = login.classes.MrScanData
-        elif match.group(1) == 'MRPT':
-            session_cls = login.classes.PetmrSessionData
-            scan_cls = login.classes.MrScanData
-        elif match.group(1) == 'EEG':
-            session_cls = login.classes.EegSessionData
-            scan_cls = login.classes.EegScanData  # Not used atm
-        else:
-            # Default to MRSession
-            session_cls = login.classes.MrSessionData
-            scan_cls = login.classes.MrScanData
-        # FIXME: Override datatype to MRScan as EEGScan doesn't work atm
+    if compress:
+        resource_name = compressed_resources.get(resource_name,
+                                                 resource_name)
+    return filenames, resource_name
+
+
+def _run_upload(scheduler, login, session, scan, filenames, resource_name,
+                **kwargs):
+    """
+    Uploads files as per `_upload` through a `TransferScheduler`, which
+    retries uploads that fail with a transient error. Retries resume the
+    upload so only the files that didn't make it to the server are sent
+    again (unless overwriting, in which case the resource is recreated).
+    Streams can't be rewound, so uploads from them are only attempted once.
+    """
+    if any(isinstance(f, StreamSource) for f in filenames):
+        return _upload(login, session, scan, filenames, resource_name,
+                       **kwargs)
+    attempts = []
+
+    def attempt():
+        if attempts and not kwargs.get('overwrite'):
+            kwargs['resume'] = True
+        attempts.append(None)
+        return _upload(login, session, scan, filenames, resource_name,
+                       **kwargs)
+
+    return scheduler.run(attempt)
+
+
+def _upload(login, session, scan, filenames, resource_name, overwrite=False,
+            create_session=False, project_id=None, subject_id=None,
+            scan_id=None, resume=False, sync=False, compress=False,
+            limiter=None, creation_lock=None, sessions=None):
+    """
+    Uploads files to a resource of a scan over an existing connection (see
+    `put`). When called concurrently, 'creation_lock' and 'sessions' (a dict
+    shared between the calls) ensure each session is only created once. If
+    a `BandwidthLimiter` is provided all files are streamed through it.
+    """
+    match = session_modality_re.match(session)
+    if match is None or match.group(1) == 'MR':
+        session_cls = login.classes.MrSessionData
+        scan_cls = login.classes.MrScanData
+    elif match.group(1) == 'MRPT':
+        session_cls = login.classes.PetmrSessionData
+        scan_cls = login.classes.MrScanData
+    elif match.group(1) == 'EEG':
+        session_cls = login.classes.EegSessionData
+        scan_cls = login.classes.EegScanData  # Not used atm
+    else:
+        # Default to MRSession
+        session_cls = login.classes.MrSessionData
         scan_cls = login.classes.MrScanData
+    # FIXME: Override datatype to MRScan as EEGScan doesn't work atm
+    scan_cls = login.classes.MrScanData
+    if creation_lock is None:
+        creation_lock = threading.Lock()
+    if sessions is None:
+        sessions = {}
+    with creation_lock:
         try:
-            xsession = login.experiments[session]
+            xsession = sessions[session]
         except KeyError:
-            if create_session:
-                if project_id is None and subject_id is None:
-                    try:
-                        project_id, subject_id, _ = session.split('_')
-                    except ValueError:
-                        raise XnatUtilsUsageError(
-                            "Must explicitly provide project and subject IDs "
-                            "if session ID ({}) scheme doesn't match "
-                            "<project>_<subject>_<visit> convention, i.e. "
-                            "have exactly 2 underscores".format(session))
-                if project_id is None:
-                    project_id = session.split('_')[0]
-                if subject_id is None:
-                    subject_id = '_'.join(session.split('_')[:2])
-                try:
-                    xproject = login.projects[project_id]
-                except KeyError:
-                    raise XnatUtilsUsageError(
-                        "Cannot create session '{}' as '{}' does not exist "
-                        "(or you don't have access to it)".format(session,
-                                                                  project_id))
-                # Creates a corresponding subject and session if they don't
-                # exist
-                xsubject = login.classes.SubjectData(label=subject_id,
-                                                     parent=xproject)
-                xsession = session_cls(
-                    label=session, parent=xsubject)
-                print("{} session successfully created."
-                      .format(xsession.label))
-            else:
-                raise XnatUtilsNoMatchingSessionsException(
-                    "'{}' session does not exist, to automatically create it "
-                    "please use '--create_session' option."
-                    .format(session))
-        xdataset = scan_cls(id=(scan_id if scan_id is not None else scan),
-                            type=scan, parent=xsession)
-        if overwrite:
-            try:
-                xdataset.resources[resource_name].delete()
-                print("Deleted existing resource at {}:{}/{}".format(
-                    session, scan, resource_name))
-            except KeyError:
-                pass
+            xsession = sessions[session] = _get_session(
+                login, session, session_cls, create_session, project_id,
+                subject_id)
+    xdataset = scan_cls(id=(scan_id if scan_id is not None else scan),
+                        type=scan, parent=xsession)
+    if overwrite:
+        try:
+            xdataset.resources[resource_name].delete()
+            print("Deleted existing resource at {}:{}/{}".format(
+                session, scan, resource_name))
+        except KeyError:
+            pass
+    if compress and resource_name not in compressed_resources.values():
+        # Other formats (e.g. DICOM) can't be read by XNAT and the
+        # converters once gzipped
+        logger.info("Not compressing files uploaded to %s resource of %s:%s",
+                    resource_name, session, scan)
+        compress = False
+    remote_digests = {}
+    if resume or sync:
+        try:
+            resource = xdataset.resources[resource_name]
+        except KeyError:
+            resource = xdataset.create_resource(resource_name)
+        else:
+            # Digests are keyed by the paths of the files within the resource
+            # so files in sub-directories don't clash with uploaded files
+            remote_digests = dict((f.path, f.digest)
+                                  for f in _list_files(resource))
+    else:
         resource = xdataset.create_resource(resource_name)
-        for fname in filenames:
-            resource.upload(fname, os.path.basename(fname))
-            print("{} uploaded to {}:{}".format(
+    remote_names = dict((f, _remote_name(f, compress)) for f in filenames)
+    # Skip files that are already present with matching digests. Streams
+    # can only be read once so are always uploaded
+    if remote_digests:
+        local_digests = _local_digests(
+            [f for f in filenames if not isinstance(f, StreamSource)],
+            compress)
+    to_upload = []
+    for fname in filenames:
+        remote_name = remote_names[fname]
+        if remote_name not in remote_digests:
+            to_upload.append((fname, False))
+        elif (isinstance(fname, StreamSource) or
+              local_digests[fname] != remote_digests[remote_name]):
+            to_upload.append((fname, True))
+        else:
+            print("{} already present in {}:{}, skipping".format(
                 fname, session, scan))
-        print("Uploaded files, checking digests...")
-        # Check uploaded files checksums
-        remote_digests = get_digests(resource)
-        for fname in filenames:
-            remote_digest = remote_digests[
-                os.path.basename(fname).replace(' ', '%20')]
-            local_digest = calculate_checksum(fname)
-            if local_digest != remote_digest:
-                raise XnatUtilsDigestCheckError(
-                    "Remote digest does not match local ({} vs {}) "
-                    "for {}. Please upload your datasets again"
-                    .format(remote_digest, local_digest, fname))
-            print("Successfully checked digest for {}".format(
-                  fname, session, scan))
-
-
-def calculate_checksum(fname):
-    try:
-        file_hash = hashlib.md5()
-        with open(fname, 'rb') as f:
-            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
-                file_hash.update(chunk)
-        return file_hash.hexdigest()
-    except OSError:
-        raise XnatUtilsDigestCheckFailedError(
-            "Could not check digest of '{}' ".format(fname))
+    # The digests of streamed files are calculated as they are uploaded
+    local_digests = {}
+    for fname, replace in to_upload:
+        if isinstance(fname, StreamSource):
+            local_digests[fname] = _upload_stream(
+                login, resource, fname.fileobj, remote_names[fname],
+                overwrite=replace, compress=_compress_file(fname, compress),
+                limiter=limiter)
+        elif _compress_file(fname, compress) or limiter is not None:
+            with open(fname, 'rb') as f:
+                local_digests[fname] = _upload_stream(
+                    login, resource, f, remote_names[fname],
+                    overwrite=replace,
+                    compress=_compress_file(fname, compress),
+                    limiter=limiter)
+        else:
+            resource.upload(fname, remote_names[fname], overwrite=replace)
+        print("{} uploaded to {}:{}".format(
+            _source_name(fname), session, scan))
+    if sync and remote_digests:
+        # Files are deleted by the URIs they are listed with, as files in
+        # sub-directories of the resource can have the same names as the
+        # uploaded files
+        local_names = set(remote_names.values())
+        for remote_file in _list_files(resource):
+            if remote_file.path not in local_names:
+                login.delete(remote_file.uri)
+                print("Deleted {} from {}:{} as it isn't present locally"
+                      .format(remote_file.path, session, scan))
+    if not to_upload:
+        return resource
+    print("Uploaded files, checking digests...")
+    # Check uploaded files checksums
+    remote_digests = dict((f.path, f.digest) for f in _list_files(resource))
+    local_digests.update(calculate_checksums(
+        f for f, _ in to_upload if f not in local_digests))
+    for fname, _ in to_upload:
+        remote_digest = remote_digests.get(remote_names[fname])
+        local_digest = local_digests[fname]
+        if local_digest != remote_digest:
+            raise XnatUtilsDigestCheckError(
+                "Remote digest does not match local ({} vs {}) "
+                "for {}. Please upload your datasets again"
+                .format(remote_digest, local_digest, _source_name(fname)))
+        print("Successfully checked digest for {}".format(
+              _source_name(fname), session, scan))
+    return resource
 
 
-def get_digests(resource):
+class StreamSource(namedtuple('StreamSource', ('name', 'fileobj'))):
     """
-    Downloads the MD5 digests associated with the files in a resource.
-    These are saved with the downloaded files in the cache and used to
-    check if the files have been updated on the server
+    A dataset to upload that is read from a file-like object (e.g. stdin)
+    instead of a file on disk
+
+    Parameters
+    ----------
+    name : str
+        The filename to store the dataset as
+    fileobj : file-like
+        The object to read the dataset from (in binary mode)
     """
-    result = resource.xnat_session.get(resource.uri + '/files')
-    if result.status_code != 200:
-        raise XnatUtilsError(
-            "Could not download metadata for resource {}. Files "
-            "may have been uploaded but cannot check checksums"
-            .format(resource.id))
-    return dict((r['Name'], r['digest'])
-                for r in result.json()['ResultSet']['Result'])
+    __slots__ = ()
+
+
+def _is_stream(fname):
+    return fname == '-' or hasattr(fname, 'read')
+
+
+def _source_name(fname):
+    if isinstance(fname, StreamSource):
+        return fname.name
+    return fname
+
+
+def _compress_file(fname, compress):
+    return compress and not _source_name(fname).endswith('.gz')
+
+
+def _remote_name(fname, compress):
+    name = os.path.basename(_source_name(fname))
+    if _compress_file(fname, compress):
+        name += '.gz'
+    return name
+
+
+def _local_digests(filenames, compress):
+    """
+    Calculates the digests of the files as they will be stored on the server,
+    i.e. of the compressed stream for files that are compressed on upload
+    """
+    to_compress = [f for f in filenames if _compress_file(f, compress)]
+    digests = calculate_checksums(f for f in filenames
+                                  if f not in to_compress)
+    digests.update(iter_concurrent(
+        lambda f: (f, _gzip_digest(f)), ((f,) for f in to_compress),
+        num_workers=min(multiprocessing.cpu_count(), len(to_compress))))
+    return digests
+
+
+def _iter_chunks(fileobj, file_hash=None):
+    """
+    Reads a file object in chunks, updating 'file_hash' with each chunk
+    """
+    for chunk in iter(lambda: fileobj.read(UPLOAD_CHUNK_SIZE), b''):
+        if file_hash is not None:
+            file_hash.update(chunk)
+        yield chunk
+
+
+def _iter_gzip(fileobj, file_hash=None):
+    """
+    Compresses the contents of a file object into a gzip stream, yielding it
+    in chunks and updating 'file_hash' with each chunk. The gzip header
+    omits the filename and modification time so that the stream (and hence
+    its digest) only depends on the contents of the file
+    """
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    for chunk in _iter_chunks(fileobj):
+        compressed = compressor.compress(chunk)
+        if compressed:
+            if file_hash is not None:
+                file_hash.update(compressed)
+            yield compressed
+    compressed = compressor.flush()
+    if file_hash is not None:
+        file_hash.update(compressed)
+    yield compressed
+
+
+def _gzip_digest(fname):
+    file_hash = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for _ in _iter_gzip(f, file_hash):
+            pass
+    return file_hash.hexdigest()
+
+
+def _upload_stream(login, resource, fileobj, remote_name, overwrite=False,
+                   compress=False, limiter=None):
+    """
+    Uploads the contents of a file object to a resource, optionally
+    compressing it on the fly and throttling it with a `BandwidthLimiter`.
+    The contents are read and sent in chunks (with chunked transfer encoding
+    as the size isn't known in advance) so memory use is bounded regardless
+    of their size. Returns the digest of the uploaded stream, calculated as
+    it is sent
+    """
+    file_hash = hashlib.md5()
+    query = {'inbody': 'true'}
+    if overwrite:
+        query['overwrite'] = 'true'
+    if compress:
+        chunks = _iter_gzip(fileobj, file_hash)
+    else:
+        chunks = _iter_chunks(fileobj, file_hash)
+    if limiter is not None:
+        chunks = limiter.throttle(chunks)
+    login.put(resource.uri + '/files/' + remote_name, data=chunks,
+              query=query,
+              headers={'Content-Type': 'application/octet-stream'})
+    return file_hash.hexdigest()
+
+
+def _bandwidth_limiter(max_bandwidth):
+    if max_bandwidth is None:
+        return None
+    return BandwidthLimiter(max_bandwidth)
+
+
+def _get_session(login, session, session_cls, create_session, project_id,
+                 subject_id):
+    try:
+        xsession = login.experiments[session]
+    except KeyError:
+        if create_session:
+            if project_id is None and subject_id is None:
+                try:
+                    project_id, subject_id, _ = session.split('_')
+                except ValueError:
+                    raise XnatUtilsUsageError(
+                        "Must explicitly provide project and subject IDs "
+                        "if session ID ({}) scheme doesn't match "
+                        "<project>_<subject>_<visit> convention, i.e. "
+                        "have exactly 2 underscores".format(session))
+            if project_id is None:
+                project_id = session.split('_')[0]
+            if subject_id is None:
+                subject_id = '_'.join(session.split('_')[:2])
+            try:
+                xproject = login.projects[project_id]
+            except KeyError:
+                raise XnatUtilsUsageError(
+                    "Cannot create session '{}' as '{}' does not exist "
+                    "(or you don't have access to it)".format(session,
+                                                              project_id))
+            # Creates a corresponding subject and session if they don't
+            # exist
+            xsubject = login.classes.SubjectData(label=subject_id,
+                                                 parent=xproject)
+            xsession = session_cls(
+                label=session, parent=xsubject)
+            print("{} session successfully created."
+                  .format(xsession.label))
+        else:
+            raise XnatUtilsNoMatchingSessionsException(
+                "'{}' session does not exist, to automatically create it "
+                "please use '--create_session' option."
+                .format(session))
+    return xsession
 
 
 description = """
@@ -247,7 +972,33 @@ created if they are not already present, e.g.
     $ xnat-put TEST001_001_MR01 a_dataset --create_session test.nii.gz
 
 NB: If the scan already exists the '--overwrite' option must be provided to
-overwrite it.
+overwrite it, or the '--resume' option to upload only the files that are
+missing from it (or whose digests don't match), e.g. to resume an interrupted
+upload. The '--sync' option additionally deletes files that aren't present
+locally from the resource.
+
+Uncompressed NIFTI and MRTRIX datasets can be gzipped as they are uploaded by
+passing the '--compress' option, in which case they are stored in NIFTI_GZ
+and MRTRIX_GZ resources with '.gz' appended to their names. Datasets uploaded
+to other resources (e.g. DICOM) are left uncompressed.
+
+A dataset can also be streamed from stdin by passing '-' as the filename along
+with the name to store it as, e.g.
+
+    $ gzip -dc t1.nii.gz | xnat-put TEST001_001_MR01 t1 - --name t1.nii
+
+Datasets for many sessions can be uploaded over a single connection by listing
+them in a CSV manifest with the columns 'session', 'scan' and 'paths' (multiple
+paths separated by ';'), e.g.
+
+    $ xnat-put --manifest uploads.csv --create_session --num_workers 4
+
+Series exported into a directory by a modality can be uploaded as they arrive
+by watching the directory, into which each series should be written as
+<session>/<scan>/<files>. Each series is uploaded once it hasn't been modified
+for '--quiescence' seconds and is then moved into DIR/.uploaded, e.g.
+
+    $ xnat-put --watch /export --create_session --num_workers 2
 
 User credentials can be stored in a ~/.netrc file so that they don't need to be
 entered each time a command is run. If a new user provided or netrc doesn't
@@ -256,14 +1007,35 @@ credentials.
 """
 
 
+def print_status_table(statuses):
+    """
+    Prints the statuses returned by `put_many` as a table
+    """
+    header = ('row', 'session', 'scan', 'resource', 'files', 'status')
+    table = [header] + [
+        (str(s.row + 1), s.session, s.scan, s.resource, str(s.num_files),
+         s.status) for s in statuses]
+    widths = [max(len(r[i]) for r in table) for i in range(len(header))]
+    for row in table:
+        print('  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip())
+    for status in statuses:
+        if status.message:
+            print("Row {} ({}:{}) failed: {}".format(
+                status.row + 1, status.session, status.scan, status.message))
+
+
 def parser():
     parser = base_parser(description)
-    parser.add_argument('session', type=str,
+    parser.add_argument('session', type=str, nargs='?',
                         help="Name of the session to upload the dataset to")
-    parser.add_argument('scan', type=str,
+    parser.add_argument('scan', type=str, nargs='?',
                         help="Name for the dataset on XNAT")
-    parser.add_argument('filenames', type=str, nargs='+',
-                        help="Filename(s) of the dataset to upload to XNAT")
+    parser.add_argument('filenames', type=str, nargs='*',
+                        help=("Filename(s) of the dataset to upload to XNAT, "
+                              "or '-' to read it from stdin"))
+    parser.add_argument('--name', type=str, default=None,
+                        help=("The filename to store a dataset read from "
+                              "stdin as"))
     parser.add_argument('--overwrite', '-o', action='store_true',
                         default=False,
                         help="Allow overwrite of existing dataset")
@@ -283,6 +1055,54 @@ def parser():
                         help="Provide the subject ID if session doesn't exist")
     parser.add_argument('--scan_id', type=str,
                         help="Provide the scan ID (defaults to the scan type)")
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help=("Only upload files that are missing from the "
+                              "resource or whose digests don't match"))
+    parser.add_argument('--sync', action='store_true', default=False,
+                        help=("As for '--resume' but also delete files in "
+                              "the resource that aren't present locally"))
+    parser.add_argument('--compress', '-z', action='store_true',
+                        default=False,
+                        help=("Gzip NIFTI and MRTRIX datasets as they are "
+                              "uploaded, storing them as NIFTI_GZ and "
+                              "MRTRIX_GZ (other datasets aren't compressed)"))
+    parser.add_argument('--manifest', '-m', type=str, default=None,
+                        help=("Upload the datasets listed in a CSV manifest "
+                              "instead of a single dataset. The manifest "
+                              "should have the columns 'session', 'scan' and "
+                              "'paths' (separated by ';'), and optionally "
+                              "'resource', 'project_id', 'subject_id' and "
+                              "'scan_id'"))
+    parser.add_argument('--num_workers', '-W', type=int, default=1,
+                        help=("The number of manifest rows (or watched "
+                              "series) to upload concurrently"))
+    parser.add_argument('--watch', type=str, default=None, metavar='DIR',
+                        help=("Watch a directory that series are exported "
+                              "into (as DIR/<session>/<scan>/<files>) and "
+                              "upload each series once it is complete"))
+    parser.add_argument('--interval', type=float, default=10,
+                        help=("The number of seconds between scans of the "
+                              "watched directory"))
+    parser.add_argument('--quiescence', type=float, default=60,
+                        help=("The number of seconds a watched series must be "
+                              "unmodified for before it is uploaded"))
+    parser.add_argument('--max_in_flight', type=int, default=None,
+                        help=("The maximum number of watched series queued "
+                              "for upload at a time (default 2 x "
+                              "--num_workers)"))
+    parser.add_argument('--delete_uploaded', action='store_true',
+                        default=False,
+                        help=("Delete watched series once they are uploaded "
+                              "instead of moving them into DIR/.uploaded"))
+    parser.add_argument('--max_retries', type=int,
+                        default=DEFAULT_MAX_RETRIES,
+                        help=("The number of times to retry requests and "
+                              "uploads that fail with a transient error "
+                              "(e.g. 503 while the server is under load)"))
+    parser.add_argument('--max_bandwidth', type=str, default=None,
+                        help=("The maximum combined bandwidth of the uploads "
+                              "in bytes per second, optionally with a K, M "
+                              "or G suffix (e.g. 50M)"))
     add_default_args(parser)
     return parser
 
@@ -294,14 +1114,68 @@ def cmd(argv=sys.argv[1:]):
     set_logger(args.loglevel)
 
     try:
-        put(args.session, args.scan, *args.filenames, overwrite=args.overwrite,
-            create_session=args.create_session, resource_name=args.resource,
-            project_id=args.project_id, subject_id=args.subject_id,
-            scan_id=args.scan_id, user=args.user, server=args.server,
-            use_netrc=(not args.no_netrc))
+        if args.watch is not None:
+            if args.session is not None or args.manifest is not None:
+                raise XnatUtilsUsageError(
+                    "Session, scan, filenames and '--manifest' should not be "
+                    "provided with '--watch'")
+            for status in watch_put(
+                    args.watch, interval=args.interval,
+                    quiescence=args.quiescence, num_workers=args.num_workers,
+                    max_in_flight=args.max_in_flight,
+                    delete_uploaded=args.delete_uploaded,
+                    create_session=args.create_session,
+                    resource_name=args.resource, project_id=args.project_id,
+                    subject_id=args.subject_id, compress=args.compress,
+                    max_retries=args.max_retries,
+                    max_bandwidth=args.max_bandwidth, user=args.user,
+                    server=args.server,
+                    use_netrc=(not args.no_netrc),
+                    cache_session=(not args.no_netrc)):
+                if status.status == 'uploaded':
+                    print("Uploaded {} ({} files) to {}:{}".format(
+                        status.row, status.num_files, status.session,
+                        status.scan))
+        elif args.manifest is not None:
+            if args.session is not None:
+                raise XnatUtilsUsageError(
+                    "Session, scan and filenames should not be provided "
+                    "with '--manifest'")
+            statuses = put_many(
+                args.manifest, num_workers=args.num_workers,
+                overwrite=args.overwrite,
+                create_session=args.create_session,
+                resource_name=args.resource, project_id=args.project_id,
+                subject_id=args.subject_id, resume=args.resume,
+                sync=args.sync, compress=args.compress,
+                max_retries=args.max_retries,
+                max_bandwidth=args.max_bandwidth, user=args.user,
+                server=args.server, use_netrc=(not args.no_netrc),
+                cache_session=(not args.no_netrc))
+            print_status_table(statuses)
+        elif args.session is None or args.scan is None or not args.filenames:
+            raise XnatUtilsUsageError(
+                "Session, scan and filenames must be provided unless a "
+                "manifest is provided with '--manifest'")
+        else:
+            put(args.session, args.scan, *args.filenames,
+                overwrite=args.overwrite,
+                create_session=args.create_session,
+                resource_name=args.resource, project_id=args.project_id,
+                subject_id=args.subject_id, scan_id=args.scan_id,
+                resume=args.resume, sync=args.sync, compress=args.compress,
+                name=args.name, max_retries=args.max_retries,
+                max_bandwidth=args.max_bandwidth, user=args.user,
+                server=args.server,
+                use_netrc=(not args.no_netrc),
+                cache_session=(not args.no_netrc))
     except XnatUtilsUsageError as e:
         print_usage_error(e)
     except XNATResponseError as e:
         print_response_error(e)
     except XnatUtilsException as e:
         print_info_message(e)
+    except KeyboardInterrupt:
+        if args.watch is None:
+            raise
+        print("Stopped watching '{}'".format(args.watch))
@@ -78,7 +78,8 @@ def cmd(argv=sys.argv[1:]):
     try:
         rename(args.session_name, args.new_session_name,
                user=args.user, server=args.server,
-               use_netrc=(not args.no_netrc))
+               use_netrc=(not args.no_netrc),
+               cache_session=(not args.no_netrc))
     except XnatUtilsUsageError as e:
         print_usage_error(e)
     except XNATResponseError as e:
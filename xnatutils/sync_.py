@@ -0,0 +1,407 @@
+import sys
+import os.path
+import json
+import errno
+import hashlib
+import logging
+from collections import namedtuple
+from xnat.exceptions import XNATResponseError
+from .base import (
+    connect, base_parser, add_default_args, print_response_error,
+    print_usage_error, print_info_message, set_logger, get_digests,
+    iter_concurrent, TransferScheduler, BandwidthLimiter, SessionRecord,
+    DEFAULT_CRAWL_WORKERS,
+    DEFAULT_MAX_RETRIES)
+from .get_ import (
+    _iter_resources, _download_resource, _remove_path, conv_choices,
+    converter_choices)
+from .exceptions import XnatUtilsUsageError, XnatUtilsException
+
+logger = logging.getLogger('xnat-utils')
+
+STATE_FILE = '.xnat-sync-{}.json'
+
+
+def sync_pull(project_id, download_dir, scans=None, resource_name=None,
+              convert_to=None, converter=None, subject_dirs=False,
+              strip_name=False, delete=False, match_scan_id=True,
+              num_workers=1, check_digests=True,
+              crawl_workers=DEFAULT_CRAWL_WORKERS, state_path=None,
+              max_retries=DEFAULT_MAX_RETRIES, max_bandwidth=None,
+              **kwargs):
+    """
+    Incrementally mirrors a project into a local directory, in the same
+    layout as `get`. The last-modified time of each session and a signature
+    of the files in each resource are recorded in a state file in the
+    download directory, so that subsequent calls only crawl the sessions
+    that have been modified since the previous call (e.g. by adding scans)
+    and only download the resources that have changed, e.g.
+
+        >>> xnatutils.sync_pull('MRH017', '/scratch/MRH017', delete=True)
+
+    Parameters
+    ----------
+    project_id : str
+        The ID of the project to mirror
+    download_dir : str
+        Path to mirror the project into
+    scans : str | list(str)
+        Name or regular expression of the scans to mirror. If not provided
+        all scans are mirrored
+    resource_name : str
+        The name of the resource to mirror (see `get`)
+    convert_to : str
+        The format to convert the downloaded resources to (see `get`)
+    converter : str
+        The conversion tool to use (see `get`)
+    subject_dirs : bool
+        Whether to organise sessions within subject directories
+    strip_name : bool
+        Whether to strip the default name of each dicom file (see `get`)
+    delete : bool
+        Whether to delete the local copies of resources (and sessions) that
+        have been removed from the server
+    match_scan_id : bool
+        Whether to match scan IDs as well as types
+    num_workers : int
+        The number of resources to download concurrently
+    check_digests : bool
+        Whether to check the downloaded files against the digests stored on
+        the server
+    crawl_workers : int
+        The number of sessions to retrieve the metadata of concurrently
+    state_path : str | None
+        Path to the state file, defaults to '.xnat-sync-<project>.json' in
+        the download directory
+    max_retries : int
+        The number of times to retry requests and downloads that fail with a
+        transient error (see `get`)
+    max_bandwidth : str | float | None
+        The maximum combined bandwidth of the downloads (see `get`)
+    user : str
+        The user to connect to the server with
+    loglevel : str
+        The logging level to display. In order of increasing verbosity
+        ERROR, WARNING, INFO, DEBUG.
+    connection : xnat.Session
+        An existing XnatPy session that is to be reused instead of
+        creating a new session.
+    server : str | int | None
+        URI of the XNAT server to connect to
+    use_netrc : bool
+        Whether to load and save user credentials from netrc file
+        located at $HOME/.netrc
+
+    Returns
+    -------
+    result : SyncResult
+        The resources downloaded and the paths deleted by the call
+    """
+    if isinstance(scans, str):
+        scans = [scans]
+    if state_path is None:
+        state_path = os.path.join(download_dir, STATE_FILE.format(project_id))
+    try:
+        os.makedirs(download_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    state = load_sync_state(state_path, project_id)
+    downloaded = []
+    deleted = []
+    num_unchanged = 0
+    scheduler = TransferScheduler(num_workers, max_retries=max_retries)
+    limiter = (BandwidthLimiter(max_bandwidth)
+               if max_bandwidth is not None else None)
+    with connect(max_retries=max_retries, **kwargs) as login:
+        scheduler.attach(login)
+        if limiter is not None:
+            limiter.attach(login)
+        listing = _list_sessions(login, project_id)
+        modified = sorted(
+            i for i, s in listing.items()
+            if (state['sessions'].get(i, {}).get('last_modified') !=
+                s['last_modified']))
+        removed = sorted(set(state['sessions']) - set(listing))
+        logger.info("%s of %s sessions in %s modified since %s, %s removed",
+                    len(modified), len(listing), project_id,
+                    state['watermark'], len(removed))
+        try:
+            for session_id in removed:
+                if delete:
+                    deleted.extend(_delete_resources(
+                        state['sessions'][session_id]['resources'],
+                        download_dir))
+                del state['sessions'][session_id]
+            # Only the ID and URI of the sessions are needed to retrieve
+            # their trees so records are used instead of XnatPy objects
+            xsessions = [
+                SessionRecord(i, listing[i]['label'], project_id, None, None,
+                              '/data/experiments/' + i, None, None, login)
+                for i in modified]
+            for session_id in modified:
+                state['sessions'].setdefault(session_id, {
+                    'label': listing[session_id]['label'],
+                    'last_modified': None, 'resources': {}})
+            seen = set()
+
+            def pull(resource, scan, session, suffix):
+                signature = _signature(get_digests(resource))
+                entry = state['sessions'][session.id]['resources'].get(
+                    resource.uri)
+                if (entry is not None and entry['signature'] == signature and
+                        entry['path'] is not None and
+                        os.path.exists(entry['path'])):
+                    return session.id, resource.uri, None, signature
+                record = _download_resource(
+                    resource, scan, session, download_dir, subject_dirs,
+                    convert_to, converter, strip_name, suffix=suffix,
+                    check_digests=check_digests)
+                return session.id, resource.uri, record, signature
+
+            tasks = _iter_resources(xsessions, scans, resource_name,
+                                    match_scan_id, crawl_workers)
+            for session_id, uri, record, signature in iter_concurrent(
+                    pull, tasks, num_workers=num_workers,
+                    scheduler=scheduler):
+                seen.add(uri)
+                resources = state['sessions'][session_id]['resources']
+                if record is None:
+                    num_unchanged += 1
+                    continue
+                downloaded.append(record)
+                resources[uri] = {'path': record.path,
+                                  'signature': signature}
+            # Now that all modified sessions have been crawled, remove the
+            # resources that are no longer present and record the sessions
+            # as up to date
+            for session_id in modified:
+                session_state = state['sessions'][session_id]
+                missing = dict((u, r)
+                               for u, r in session_state['resources'].items()
+                               if u not in seen)
+                if delete:
+                    deleted.extend(_delete_resources(missing, download_dir))
+                for uri in missing:
+                    del session_state['resources'][uri]
+                session_state['last_modified'] = (
+                    listing[session_id]['last_modified'])
+            if listing:
+                state['watermark'] = max(
+                    s['last_modified'] or '' for s in listing.values()) or None
+        finally:
+            scheduler.detach(login)
+            if limiter is not None:
+                limiter.detach(login)
+            save_sync_state(state_path, state)
+    logger.info("Downloaded %s resources (%s unchanged) and deleted %s from "
+                "%s", len(downloaded), num_unchanged, len(deleted),
+                download_dir)
+    return SyncResult(downloaded, deleted, num_unchanged)
+
+
+class SyncResult(namedtuple('SyncResult', ('downloaded', 'deleted',
+                                           'num_unchanged'))):
+    """
+    The result of a call to `sync_pull`
+
+    Parameters
+    ----------
+    downloaded : list(DownloadedResource)
+        The resources that were new or had changed and were downloaded
+    deleted : list(str)
+        The local paths that were deleted as they had been removed from the
+        server
+    num_unchanged : int
+        The number of resources in modified sessions that hadn't changed
+    """
+    __slots__ = ()
+
+
+def load_sync_state(path, project_id):
+    """
+    Loads the state saved by a previous call to `sync_pull`, or returns an
+    empty state if there wasn't one
+    """
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {'project': project_id, 'watermark': None, 'sessions': {}}
+    except ValueError as e:
+        raise XnatUtilsUsageError(
+            "Could not read sync state file '{}' ({}), delete it to "
+            "re-mirror the project".format(path, e))
+    if state['project'] != project_id:
+        raise XnatUtilsUsageError(
+            "Sync state file '{}' is for project '{}' not '{}'".format(
+                path, state['project'], project_id))
+    return state
+
+
+def save_sync_state(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _list_sessions(login, project_id):
+    """
+    Lists the sessions in a project along with the time they were last
+    modified (falling back to the time they were inserted if the server
+    doesn't report it), in a single request
+    """
+    result = login.get_json(
+        '/data/projects/{}/experiments'.format(project_id),
+        query={'columns': 'ID,label,insert_date,last_modified',
+               'format': 'json'})
+    return dict(
+        (r['ID'], {'label': r['label'],
+                   'last_modified': (r.get('last_modified') or
+                                     r.get('insert_date') or None)})
+        for r in result['ResultSet']['Result'])
+
+
+def _signature(digests):
+    """
+    Returns a signature of the names and digests of the files in a resource,
+    which changes if any of the files are added, removed or modified
+    """
+    return hashlib.md5(json.dumps(sorted(digests.items())).encode(
+        'utf-8')).hexdigest()
+
+
+def _delete_resources(resources, download_dir):
+    deleted = []
+    for entry in resources.values():
+        path = entry['path']
+        if path is None or not os.path.exists(path):
+            continue
+        _remove_path(path)
+        logger.info("Deleted %s as it was removed from the server", path)
+        deleted.append(path)
+        # Remove the session (and subject) directories if now empty
+        parent = os.path.dirname(os.path.abspath(path))
+        while parent.startswith(os.path.abspath(download_dir) + os.sep):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+    return deleted
+
+
+description = """
+Incrementally mirrors a project into a local directory (in the same layout as
+'xnat-get'), e.g. for nightly replication to a compute cluster
+
+    $ xnat-sync pull MRH017 --target /scratch/MRH017 --delete
+
+The last-modified time of each session and a signature of the files in each
+resource are saved in the target directory, so that subsequent runs only crawl
+the sessions that have been modified since the previous run (including
+sessions that have had scans added) and only download the resources that have
+changed. If the '--delete' option is provided, local copies of resources and
+sessions that have been removed from the server are deleted.
+"""
+
+
+def parser():
+    parser = base_parser(description)
+    parser.add_argument('direction', type=str, choices=('pull',),
+                        help="The direction to sync in")
+    parser.add_argument('project', type=str,
+                        help="The ID of the project to mirror")
+    parser.add_argument('--target', '-t', type=str, default=None,
+                        help=("Path to mirror the project into. If not "
+                              "provided the current working directory will "
+                              "be used"))
+    parser.add_argument('--scans', '-x', type=str, default=None, nargs='+',
+                        help=("Name of the scans to mirror. If not provided "
+                              "all scans are mirrored"))
+    parser.add_argument('--resource', '-r', type=str, default=None,
+                        help="The name of the resource to mirror")
+    parser.add_argument('--convert_to', '-c', type=str, default=None,
+                        choices=conv_choices,
+                        help=("Runs a conversion script on the downloaded "
+                              "scans to convert them to a given format if "
+                              "required"))
+    parser.add_argument('--converter', '-v', type=str, default=None,
+                        choices=converter_choices,
+                        help="The conversion tool to convert the datasets")
+    parser.add_argument('--subject_dirs', '-d', action='store_true',
+                        default=False, help=(
+                            "Whether to organise sessions within subject "
+                            "directories to hold the sessions in or not"))
+    parser.add_argument('--strip_name', '-i', action='store_true',
+                        default=False,
+                        help=("Whether to strip the default name of each "
+                              "dicom file to have just a number"))
+    parser.add_argument('--delete', action='store_true', default=False,
+                        help=("Delete local copies of resources that have "
+                              "been removed from the server"))
+    parser.add_argument('--dont_match_scan_id', action='store_true',
+                        default=False, help=(
+                            "To disable matching on scan ID if the scan "
+                            "type is None"))
+    parser.add_argument('--state', type=str, default=None,
+                        help=("Path to the sync state file (defaults to "
+                              "'.xnat-sync-<project>.json' in the target "
+                              "directory)"))
+    parser.add_argument('--num_workers', '-W', type=int, default=1,
+                        help=("The number of resources to download "
+                              "concurrently"))
+    parser.add_argument('--crawl_workers', type=int,
+                        default=DEFAULT_CRAWL_WORKERS,
+                        help=("The number of sessions to retrieve the "
+                              "metadata of concurrently"))
+    parser.add_argument('--dont_check_digests', action='store_true',
+                        default=False,
+                        help=("Don't check the downloaded files against the "
+                              "digests stored on the server"))
+    parser.add_argument('--max_retries', type=int,
+                        default=DEFAULT_MAX_RETRIES,
+                        help=("The number of times to retry requests and "
+                              "downloads that fail with a transient error "
+                              "(e.g. 503 while the server is under load)"))
+    parser.add_argument('--max_bandwidth', type=str, default=None,
+                        help=("The maximum combined bandwidth of the "
+                              "downloads in bytes per second, optionally "
+                              "with a K, M or G suffix (e.g. 50M)"))
+    add_default_args(parser)
+    return parser
+
+
+def cmd(argv=sys.argv[1:]):
+
+    args = parser().parse_args(argv)
+
+    set_logger(args.loglevel)
+
+    if args.target is None:
+        download_dir = os.getcwd()
+    else:
+        download_dir = os.path.expanduser(args.target)
+    try:
+        sync_pull(args.project, download_dir, scans=args.scans,
+                  resource_name=args.resource, convert_to=args.convert_to,
+                  converter=args.converter, subject_dirs=args.subject_dirs,
+                  strip_name=args.strip_name, delete=args.delete,
+                  match_scan_id=(not args.dont_match_scan_id),
+                  num_workers=args.num_workers,
+                  check_digests=(not args.dont_check_digests),
+                  crawl_workers=args.crawl_workers, state_path=args.state,
+                  max_retries=args.max_retries,
+                  max_bandwidth=args.max_bandwidth, user=args.user,
+                  server=args.server,
+                  use_netrc=(not args.no_netrc),
+                  cache_session=(not args.no_netrc))
+    except XnatUtilsUsageError as e:
+        print_usage_error(e)
+    except XNATResponseError as e:
+        print_response_error(e)
+    except XnatUtilsException as e:
+        print_info_message(e)
@@ -96,7 +96,8 @@ def cmd(argv=sys.argv[1:]):
     try:
         print(varget(args.subject_or_session_id, args.variable,
                      default=args.default, user=args.user,
-                     server=args.server, use_netrc=(not args.no_netrc)),
+                     server=args.server, use_netrc=(not args.no_netrc),
+                     cache_session=(not args.no_netrc)),
                      end='')
     except XnatUtilsUsageError as e:
         print_usage_error(e)